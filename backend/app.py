@@ -1,23 +1,60 @@
 from flask import Flask, request, jsonify, send_file, Response
 from flask_cors import CORS
 import io
-import base64
-from PIL import Image
 import os
+import mimetypes
 import uuid
 from datetime import datetime
 import logging
 import requests
 import json
 import random
-import re
 import time
+import hmac
+from functools import wraps
+from contextlib import closing
 
 # 导入配置和路由
-from config import FLASK_HOST, FLASK_PORT, FLASK_DEBUG
+from config import (
+    FLASK_HOST, FLASK_PORT, FLASK_DEBUG,
+    MODELSCOPE_POOL_SIZE, IMAGE_DOWNLOAD_POOL_SIZE, DEEPSEEK_POOL_SIZE,
+    IMAGE_DOWNLOAD_MAX_AGE, IMAGE_DOWNLOAD_CHUNK_SIZE, IMAGE_DOWNLOAD_MAX_BYTES,
+    BATCH_MAX_ITEMS, BATCH_MAX_CONCURRENCY,
+    MODELSCOPE_SLOW_CALL_SECONDS, DEEPSEEK_SLOW_CALL_SECONDS, FAIR_QUEUE_TIMEOUT, ADMIN_TOKEN,
+    IMAGE_GENERATION_DEADLINE, IMAGE_BATCH_DEADLINE, LEARNING_PATH_DEADLINE, CHAT_DEADLINE
+)
 from routes.analytics import analytics_bp
-from routes.auth import auth_bp
+from routes.auth import auth_bp, verify_token
 from database import db
+from jobs import job_manager, BatchRunner, JobQueueFullError, JOB_PENDING, JOB_SUCCEEDED, JOB_FAILED
+from task_poller import TaskPoller, TASK_SUCCEED, TASK_FAILED
+from upstream import UpstreamClient, UpstreamError
+from circuit_breaker import CircuitBreaker, CircuitOpenError, retry_budget
+from concurrency_limiter import AdaptiveLimiter, LimiterTimeoutError
+from singleflight import SingleFlight
+from hedging import Hedger
+from json_stream import JsonStreamScanner
+from event_stream import learning_path_streams, parse_event_id
+from learning_path_cache import learning_path_cache, LearningPathCache
+from learning_path_store import learning_path_store
+from conversation_store import conversation_store
+from chat_answer_cache import chat_answer_cache
+from similarity_index import image_prompt_index, chat_question_index
+from prompts import build_messages, record_usage, get_stats as get_prompt_stats
+from fair_scheduler import (
+    image_scheduler, chat_scheduler, SchedulerTimeoutError,
+    PRIORITY_INTERACTIVE, PRIORITY_STANDARD, PRIORITY_BATCH
+)
+from metrics import metrics
+from disconnect import disconnect_watcher, CancelToken, ClientDisconnected
+from deadline import (
+    Deadline, DeadlineExceeded, DEADLINE_HEADER, deadline_scope, remaining_timeout,
+    has_time_left, iter_before_deadline, parse_deadline
+)
+from job_store import job_store
+from image_cache import image_cache, ImageCache
+from image_store import image_store, InvalidFilenameError, ImageTooLargeError
+from image_variants import image_variants, InvalidVariantError
 
 
 
@@ -50,6 +87,33 @@ DEEPSEEK_HEADERS = {
     "Content-Type": "application/json",
 }
 
+# 上游连接池（图像下载地址是CDN，不携带API鉴权头）
+# 每个上游配有独立的熔断器，故障时快速失败；并发上限随上游负载自动调整，最多用满连接池
+modelscope_client = UpstreamClient(
+    'modelscope', headers=COMMON_HEADERS, pool_size=MODELSCOPE_POOL_SIZE,
+    breaker=CircuitBreaker('modelscope', slow_call_seconds=MODELSCOPE_SLOW_CALL_SECONDS),
+    limiter=AdaptiveLimiter('modelscope', max_limit=MODELSCOPE_POOL_SIZE)
+)
+image_download_client = UpstreamClient(
+    'image_download', pool_size=IMAGE_DOWNLOAD_POOL_SIZE,
+    breaker=CircuitBreaker('image_download', slow_call_seconds=MODELSCOPE_SLOW_CALL_SECONDS),
+    limiter=AdaptiveLimiter('image_download', max_limit=IMAGE_DOWNLOAD_POOL_SIZE)
+)
+deepseek_client = UpstreamClient(
+    'deepseek', headers=DEEPSEEK_HEADERS, pool_size=DEEPSEEK_POOL_SIZE,
+    breaker=CircuitBreaker('deepseek', slow_call_seconds=DEEPSEEK_SLOW_CALL_SECONDS),
+    limiter=AdaptiveLimiter('deepseek', max_limit=DEEPSEEK_POOL_SIZE)
+)
+UPSTREAM_CLIENTS = (modelscope_client, image_download_client, deepseek_client)
+
+# 相同请求合并
+learning_path_flight = SingleFlight('learning_path')
+chat_flight = SingleFlight('chat')
+
+# DeepSeek长尾延迟：首段内容超过近期P95仍未返回时发出对冲请求
+learning_path_hedger = Hedger('learning_path')
+chat_hedger = Hedger('chat')
+
 # 图像比例配置
 ASPECT_RATIOS = {
     "1:1": (1328, 1328),
@@ -74,8 +138,53 @@ def check_api_config():
         return False
     return True
 
-def generate_image_via_api(prompt, aspect_ratio="1:1", num_inference_steps=20, guidance_scale=7.5):
-    """通过ModelScope API生成图像，带重试机制"""
+def fetch_modelscope_task(task_id):
+    """查询ModelScope异步任务状态"""
+    result = modelscope_client.get(
+        f"{API_BASE_URL}v1/tasks/{task_id}",
+        headers={"X-ModelScope-Task-Type": "image_generation"},
+        timeout=10,
+        retry_deposit=False  # 轮询不是用户请求，不为重试攒预算
+    )
+    result.raise_for_status()
+    return result.json()
+
+# 所有进行中的图像任务共用一个轮询器
+task_poller = TaskPoller(fetch_modelscope_task)
+
+def download_image_to_store(image_url, filename):
+    """分块下载生成的图像并直接写入存储，内存占用不随图像大小增长"""
+    start = time.perf_counter()
+    with image_download_client.get(image_url, timeout=30, stream=True) as img_response:
+        img_response.raise_for_status()
+        
+        content_length = img_response.headers.get('Content-Length')
+        if content_length and content_length.isdigit() and int(content_length) > IMAGE_DOWNLOAD_MAX_BYTES:
+            raise ImageTooLargeError(f"图像大小 {content_length} 字节超过上限")
+        
+        image_path, size = image_store.write_stream(
+            filename,
+            iter_before_deadline(img_response, img_response.iter_content(chunk_size=IMAGE_DOWNLOAD_CHUNK_SIZE)),
+            max_bytes=IMAGE_DOWNLOAD_MAX_BYTES
+        )
+    
+    duration = time.perf_counter() - start
+    metrics.incr('image_download.count')
+    metrics.incr('image_download.bytes', size)
+    metrics.observe('image_download.size', size)
+    metrics.observe('image_download.duration', duration)
+    logger.info(f"图像下载完成: {filename}, {size} 字节, 耗时 {duration:.2f}s")
+    return image_path
+
+def generate_image_via_api(prompt, filename, aspect_ratio="1:1", num_inference_steps=20, guidance_scale=7.5,
+                           resume_task_id=None, on_task_submitted=None):
+    """通过ModelScope API生成图像并保存到图像存储，带重试机制
+
+    resume_task_id 用于重启后继续等待已提交的上游任务；on_task_submitted(task_id)
+    在每次提交上游任务后回调，便于持久化task_id。
+    提交、轮询、下载和重试共用当前的请求截止时间，时间用完立即停止。
+    成功返回 (存储路径, None)，失败返回 (None, 错误信息)
+    """
     if not check_api_config():
         return None, "API配置无效，请检查API密钥"
     
@@ -85,66 +194,59 @@ def generate_image_via_api(prompt, aspect_ratio="1:1", num_inference_steps=20, g
     
     for retry_count in range(max_retries):
         try:
+            # 截止时间已过（如任务排队太久）时不再提交
+            remaining_timeout()
             if retry_count > 0:
+                if not has_time_left(retry_delay * retry_count):
+                    logger.warning("剩余时间不足，放弃重试图像生成")
+                    return None, "图像生成超时，请稍后重试"
+                if not retry_budget.try_acquire():
+                    logger.warning("重试预算已耗尽，放弃重试图像生成")
+                    return None, "图像服务繁忙，请稍后再试"
                 logger.info(f"第 {retry_count + 1} 次尝试生成图像...")
                 time.sleep(retry_delay * retry_count)  # 递增延迟
             
-            # 发起异步图像生成请求
-            response = requests.post(
-                f"{API_BASE_URL}v1/images/generations",
-                headers={**COMMON_HEADERS, "X-ModelScope-Async-Mode": "true"},
-                data=json.dumps({
-                    "model": "Qwen/Qwen-Image",  # ModelScope Model-Id
-                    "prompt": prompt
-                }, ensure_ascii=False).encode('utf-8'),
-                timeout=30  # 添加超时
-            )
-            
-            response.raise_for_status()
-            task_id = response.json()["task_id"]
-            logger.info(f"图像生成任务已提交，任务ID: {task_id}")
+            if retry_count == 0 and resume_task_id:
+                # 重启前已提交过，直接继续等待原任务
+                task_id = resume_task_id
+                logger.info(f"恢复等待图像生成任务，任务ID: {task_id}")
+            else:
+                # 发起异步图像生成请求
+                response = modelscope_client.post(
+                    f"{API_BASE_URL}v1/images/generations",
+                    headers={"X-ModelScope-Async-Mode": "true"},
+                    data=json.dumps({
+                        "model": "Qwen/Qwen-Image",  # ModelScope Model-Id
+                        "prompt": prompt
+                    }, ensure_ascii=False).encode('utf-8'),
+                    timeout=30,  # 添加超时
+                    retry_deposit=retry_count == 0  # 只有首次提交计入重试预算
+                )
+                
+                response.raise_for_status()
+                task_id = response.json()["task_id"]
+                logger.info(f"图像生成任务已提交，任务ID: {task_id}")
+                if on_task_submitted:
+                    on_task_submitted(task_id)
             
-            # 轮询任务状态
-            max_attempts = 60  # 最多等待5分钟
-            attempt = 0
+            # 交给共享轮询器检查任务状态，任务结束时唤醒当前线程
+            # 轮询器也只在截止时间之前查询这个任务
+            handle = task_poller.watch(task_id, max_wait=remaining_timeout(task_poller.max_wait))
+            if not handle.wait(remaining_timeout()):
+                raise DeadlineExceeded()
             
-            while attempt < max_attempts:
-                try:
-                    result = requests.get(
-                        f"{API_BASE_URL}v1/tasks/{task_id}",
-                        headers={**COMMON_HEADERS, "X-ModelScope-Task-Type": "image_generation"},
-                        timeout=10
-                    )
-                    result.raise_for_status()
-                    data = result.json()
-                    
-                    logger.info(f"任务状态检查 {attempt + 1}/{max_attempts}: {data.get('task_status', 'UNKNOWN')}")
-                    
-                    if data["task_status"] == "SUCCEED":
-                        # 下载生成的图像
-                        image_url = data["output_images"][0]
-                        logger.info(f"图像生成成功，下载URL: {image_url}")
-                        
-                        img_response = requests.get(image_url, timeout=30)
-                        img_response.raise_for_status()
-                        
-                        # 转换为base64
-                        img_base64 = base64.b64encode(img_response.content).decode('utf-8')
-                        return img_base64, None
-                    
-                    elif data["task_status"] == "FAILED":
-                        error_msg = data.get("error", "图像生成失败")
-                        logger.error(f"图像生成失败: {error_msg}")
-                        break  # 跳出状态检查循环，进入重试
-                    
-                    attempt += 1
-                    time.sleep(5)  # 等待5秒后重试
+            if handle.status == TASK_SUCCEED:
+                # 下载生成的图像
+                image_url = handle.data["output_images"][0]
+                logger.info(f"图像生成成功，下载URL: {image_url}")
                 
-                except requests.exceptions.RequestException as e:
-                    logger.warning(f"状态检查请求失败: {e}")
-                    attempt += 1
-                    time.sleep(5)
-                    continue
+                image_path = download_image_to_store(image_url, filename)
+                return image_path, None
+            elif handle.status == TASK_FAILED:
+                error_msg = handle.data.get("error", "图像生成失败")
+                logger.error(f"图像生成失败: {error_msg}")
+            else:
+                logger.error(f"等待图像生成任务超时: {task_id}")
             
             # 如果到这里说明任务失败或超时，尝试重试
             if retry_count < max_retries - 1:
@@ -153,6 +255,17 @@ def generate_image_via_api(prompt, aspect_ratio="1:1", num_inference_steps=20, g
             else:
                 return None, "图像生成超时或失败，请稍后重试"
                 
+        except (CircuitOpenError, LimiterTimeoutError) as e:
+            # 上游已熔断或排队等待并发名额超时，立即失败
+            logger.warning(f"图像生成被上游保护拒绝: {e}")
+            return None, str(e)
+        except DeadlineExceeded:
+            logger.warning(f"图像生成超过截止时间，停止等待: {filename}")
+            return None, "图像生成超时，请稍后重试"
+        except ImageTooLargeError as e:
+            # 图像本身超限，重试也无济于事
+            logger.error(f"图像下载被拒绝: {e}")
+            return None, str(e)
         except requests.exceptions.RequestException as e:
             logger.error(f"网络请求错误 (尝试 {retry_count + 1}/{max_retries}): {e}")
             if retry_count < max_retries - 1:
@@ -166,6 +279,45 @@ def generate_image_via_api(prompt, aspect_ratio="1:1", num_inference_steps=20, g
     
     return None, "所有重试均失败，请稍后再试"
 
+def get_request_user_key():
+    """公平调度使用的用户标识：登录用户按用户ID，未登录按IP"""
+    auth_header = request.headers.get('Authorization', '')
+    if auth_header.startswith('Bearer '):
+        payload = verify_token(auth_header.split(' ')[1])
+        if payload and payload.get('user_id') is not None:
+            return f"user:{payload['user_id']}"
+    return f"ip:{request.remote_addr}"
+
+def request_deadline(default):
+    """本次请求的截止时间：请求头 X-Request-Timeout 指定的剩余秒数，没有时使用接口默认值"""
+    return parse_deadline(request.headers.get(DEADLINE_HEADER), default)
+
+def deadline_exceeded_response():
+    return jsonify({
+        'success': False,
+        'error': '请求处理超时，请稍后再试'
+    }), 504
+
+def client_closed_response():
+    """客户端已断开时的响应，不会被读取，只用于访问日志（沿用nginx的499约定）"""
+    return jsonify({
+        'success': False,
+        'error': '客户端已断开连接'
+    }), 499
+
+def admin_required(func):
+    """管理接口校验请求头 X-Admin-Token，未配置ADMIN_TOKEN时管理接口不可用"""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        token = request.headers.get('X-Admin-Token', '')
+        if not ADMIN_TOKEN or not hmac.compare_digest(token.encode('utf-8'), ADMIN_TOKEN.encode('utf-8')):
+            return jsonify({
+                'success': False,
+                'error': '无权访问'
+            }), 403
+        return func(*args, **kwargs)
+    return wrapper
+
 def detect_language(text):
     """简单的语言检测"""
     # 检测中文字符
@@ -191,6 +343,26 @@ def health_check():
         'timestamp': datetime.now().isoformat()
     })
 
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """性能指标端点"""
+    return jsonify({
+        **metrics.snapshot(),
+        'jobs': job_manager.get_stats(),
+        'task_poller': task_poller.get_stats(),
+        'image_cache': image_cache.get_stats(),
+        'circuit_breakers': {client.name: client.breaker.get_state() for client in UPSTREAM_CLIENTS},
+        'concurrency_limits': {client.name: client.limiter.get_stats() for client in UPSTREAM_CLIENTS},
+        'retry_budget': retry_budget.get_state(),
+        'learning_path_cache': learning_path_cache.get_stats(),
+        'learning_path_streams': learning_path_streams.get_stats(),
+        'chat_answer_cache': chat_answer_cache.get_stats(),
+        'similarity_index': {index.name: index.get_stats() for index in (image_prompt_index, chat_question_index)},
+        'prompts': get_prompt_stats(),
+        'schedulers': {scheduler.name: scheduler.get_stats() for scheduler in (image_scheduler, chat_scheduler)},
+        'timestamp': datetime.now().isoformat()
+    })
+
 @app.route('/test-new-route', methods=['GET'])
 def test_new_route():
     """全新的测试路由"""
@@ -200,6 +372,124 @@ def test_new_route():
         'timestamp': datetime.now().isoformat()
     })
 
+def build_image_result(params, cached=False):
+    """组装图像生成结果"""
+    return {
+        'success': True,
+        'image_url': f"/download/{params['filename']}",
+        'filename': params['filename'],
+        'prompt': params['prompt'],
+        'optimized_prompt': params['optimized_prompt'],
+        'parameters': {
+            'aspect_ratio': params['aspect_ratio'],
+            'num_inference_steps': params['num_inference_steps'],
+            'true_cfg_scale': params['true_cfg_scale'],
+            'seed': params['seed']
+        },
+        'cached': cached,
+        'timestamp': datetime.now().isoformat()
+    }
+
+def run_image_generation_job(job_id, params):
+    """后台任务：调用ModelScope生成图像，成功后写入结果缓存
+
+    受提交请求的截止时间约束（排队时间也计算在内），单次执行最多占用工作线程
+    IMAGE_GENERATION_DEADLINE 秒。
+    """
+    def on_task_submitted(task_id):
+        job_manager.update(job_id, progress={'task_id': task_id})
+        job_manager.persist_fields(job_id, task_id=task_id)
+    
+    submit_deadline = Deadline(params['deadline']) if params.get('deadline') else None
+    with deadline_scope(submit_deadline), deadline_scope(Deadline.after(IMAGE_GENERATION_DEADLINE)):
+        image_path, error = generate_image_via_api(
+            params['optimized_prompt'],
+            params['filename'],
+            params['aspect_ratio'],
+            params['num_inference_steps'],
+            params['true_cfg_scale'],
+            resume_task_id=params.get('resume_task_id'),
+            on_task_submitted=on_task_submitted
+        )
+    
+    if error:
+        raise Exception(error)
+    
+    logger.info(f"图像生成成功！任务ID: {job_id}")
+    image_cache.put_file(params['cache_key'], image_path)
+    image_prompt_index.add(params['prompt'], params['cache_key'], namespace=image_similarity_namespace(params))
+    
+    return build_image_result(params)
+
+def prepare_image_params(data):
+    """校验单个图像生成请求并组装任务参数，返回 (参数, 错误信息)"""
+    prompt = str(data.get('prompt', '')).strip()
+    if not prompt:
+        return None, '提示词不能为空'
+    
+    aspect_ratio = data.get('aspect_ratio', '16:9')
+    num_inference_steps = data.get('num_inference_steps', 50)
+    true_cfg_scale = data.get('true_cfg_scale', 4.0)
+    seed = data.get('seed', None)
+    
+    # 验证比例参数
+    if aspect_ratio not in ASPECT_RATIOS:
+        return None, f'不支持的图像比例: {aspect_ratio}'
+    
+    # 检测语言并添加优化后缀
+    lang = detect_language(prompt)
+    optimized_prompt = prompt + POSITIVE_MAGIC[lang]
+    
+    # 生成唯一文件名
+    filename = f"qwen_image_{uuid.uuid4().hex[:8]}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.png"
+    
+    return {
+        'prompt': prompt,
+        'optimized_prompt': optimized_prompt,
+        'aspect_ratio': aspect_ratio,
+        'num_inference_steps': num_inference_steps,
+        'true_cfg_scale': true_cfg_scale,
+        'seed': seed,
+        'filename': filename,
+        'cache_key': ImageCache.make_key(optimized_prompt, aspect_ratio, seed, num_inference_steps, true_cfg_scale)
+    }, None
+
+def image_similarity_namespace(params):
+    """只有比例、种子、步数和CFG都相同的图像才能按提示词相似度复用"""
+    return (params['aspect_ratio'], params['seed'], params['num_inference_steps'], params['true_cfg_scale'])
+
+def load_cached_image(params):
+    """相同参数已生成过时从缓存复制一份到图像存储，返回结果；未命中返回None
+
+    精确未命中时，再找其他参数相同、提示词只多了几个词或标点不同的缓存图像。
+    """
+    namespace = image_similarity_namespace(params)
+    cache_key = params['cache_key']
+    cached_path = image_cache.get_path(cache_key)
+    if cached_path is not None:
+        # 重启后相似度索引为空，精确命中时顺便补上
+        image_prompt_index.add(params['prompt'], cache_key, namespace=namespace)
+    else:
+        similar_key = image_prompt_index.nearest(params['prompt'], namespace=namespace)
+        if similar_key is None:
+            return None
+        cache_key = similar_key
+        cached_path = image_cache.get_path(cache_key)
+        if cached_path is None:
+            return None
+    
+    try:
+        image_store.import_file(params['filename'], cached_path)
+    except OSError as e:
+        # 缓存文件恰好被淘汰，按未命中处理
+        logger.warning(f"读取缓存图像失败: {e}")
+        return None
+    
+    logger.info(f"图像缓存命中: {cache_key[:12]}{'（相似提示词）' if cache_key != params['cache_key'] else ''}")
+    result = build_image_result(params, cached=True)
+    result['similar_match'] = cache_key != params['cache_key']
+    return result
+
 @app.route('/generate', methods=['POST'])
 def generate_image():
     """图像生成API端点"""
@@ -212,190 +502,355 @@ def generate_image():
                 'success': False
             }), 400
         
-        prompt = data.get('prompt', '').strip()
-        if not prompt:
+        params, error = prepare_image_params(data)
+        if error:
             return jsonify({
-                'error': '提示词不能为空',
+                'error': error,
                 'success': False
             }), 400
         
-        aspect_ratio = data.get('aspect_ratio', '16:9')
-        negative_prompt = data.get('negative_prompt', '')
-        num_inference_steps = data.get('num_inference_steps', 50)
-        true_cfg_scale = data.get('true_cfg_scale', 4.0)
-        seed = data.get('seed', None)
+        logger.info(f"开始生成图像 - 提示词: {params['prompt'][:50]}...")
+        logger.info(f"参数: aspect_ratio: {params['aspect_ratio']}, steps: {params['num_inference_steps']}, cfg: {params['true_cfg_scale']}")
         
-        # 验证比例参数
-        if aspect_ratio not in ASPECT_RATIOS:
+        # 相同参数已生成过，直接返回缓存结果
+        cached_result = load_cached_image(params)
+        if cached_result is not None:
             return jsonify({
-                'error': f'不支持的图像比例: {aspect_ratio}',
+                'success': True,
+                'job_id': None,
+                'status': JOB_SUCCEEDED,
+                'result': cached_result,
+                'timestamp': datetime.now().isoformat()
+            })
+        
+        # 提交后台任务，立即返回任务ID；相同参数的在途任务直接复用
+        params['user_key'] = get_request_user_key()
+        params['priority'] = PRIORITY_INTERACTIVE
+        params['deadline'] = request_deadline(IMAGE_GENERATION_DEADLINE).at
+        try:
+            job_id, coalesced = job_manager.submit(
+                'image_generation', run_image_generation_job, params,
+                dedupe_key=params['cache_key'], persist=True,
+                user_key=params['user_key'], priority=PRIORITY_INTERACTIVE
+            )
+        except JobQueueFullError as e:
+            return jsonify({
+                'error': str(e),
                 'success': False
-            }), 400
+            }), 503
         
-        # 检测语言并添加优化后缀
-        lang = detect_language(prompt)
-        optimized_prompt = prompt + POSITIVE_MAGIC[lang]
+        return jsonify({
+            'success': True,
+            'job_id': job_id,
+            'status': JOB_PENDING,
+            'status_url': f'/jobs/{job_id}',
+            'coalesced': coalesced,
+            'timestamp': datetime.now().isoformat()
+        }), 202
         
-        logger.info(f"开始生成图像 - 提示词: {prompt[:50]}...")
-        logger.info(f"参数: aspect_ratio: {aspect_ratio}, steps: {num_inference_steps}, cfg: {true_cfg_scale}")
+    except Exception as e:
+        logger.error(f"图像生成失败: {str(e)}")
+        return jsonify({
+            'error': f'图像生成失败: {str(e)}',
+            'success': False
+        }), 500
+
+@app.route('/generate/batch', methods=['POST'])
+def generate_image_batch():
+    """批量图像生成：在并发上限内同时提交，进度通过任务ID或SSE获取"""
+    try:
+        data = request.get_json()
+        items = data.get('items') if data else None
+        if not items or not isinstance(items, list):
+            return jsonify({
+                'error': 'items 必须是非空列表',
+                'success': False
+            }), 400
         
-        # 通过API生成图像
-        image_base64, error = generate_image_via_api(
-            optimized_prompt,
-            aspect_ratio,
-            num_inference_steps,
-            true_cfg_scale
-        )
+        if len(items) > BATCH_MAX_ITEMS:
+            return jsonify({
+                'error': f'单次最多提交 {BATCH_MAX_ITEMS} 个提示词',
+                'success': False
+            }), 400
         
-        if error:
+        try:
+            concurrency = int(data.get('concurrency', BATCH_MAX_CONCURRENCY))
+        except (TypeError, ValueError):
             return jsonify({
-                'error': error,
+                'error': 'concurrency 必须是整数',
                 'success': False
-            }), 500
+            }), 400
+        concurrency = max(1, min(concurrency, BATCH_MAX_CONCURRENCY))
+        
+        # 先全部校验，任何一项不合法都不提交
+        user_key = get_request_user_key()
+        deadline = request_deadline(IMAGE_BATCH_DEADLINE)
+        batch_items = []
+        for index, item in enumerate(items):
+            if not isinstance(item, dict):
+                item = {'prompt': item}
+            params, error = prepare_image_params(item)
+            if error:
+                return jsonify({
+                    'error': f'第 {index + 1} 项: {error}',
+                    'success': False
+                }), 400
+            
+            cached_result = load_cached_image(params)
+            if cached_result is not None:
+                batch_items.append({'status': JOB_SUCCEEDED, 'result': cached_result})
+            else:
+                params['user_key'] = user_key
+                params['priority'] = PRIORITY_BATCH
+                params['deadline'] = deadline.at
+                batch_items.append({
+                    'task': ('image_generation', run_image_generation_job, params, params['cache_key'])
+                })
         
-        # 生成唯一文件名
-        filename = f"qwen_image_{uuid.uuid4().hex[:8]}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.png"
+        batch_id = BatchRunner(
+            job_manager, 'image_batch', batch_items, concurrency, persist=True,
+            user_key=user_key, priority=PRIORITY_BATCH
+        ).start()
         
-        logger.info("图像生成成功！")
+        logger.info(f"批量图像生成任务已提交: {batch_id}, 共 {len(batch_items)} 项, 并发 {concurrency}")
         
         return jsonify({
             'success': True,
-            'image_base64': image_base64,
-            'filename': filename,
-            'prompt': prompt,
-            'optimized_prompt': optimized_prompt,
-            'parameters': {
-                'aspect_ratio': aspect_ratio,
-                'num_inference_steps': num_inference_steps,
-                'true_cfg_scale': true_cfg_scale,
-                'seed': seed
-            },
+            'job_id': batch_id,
+            'status_url': f'/jobs/{batch_id}',
+            'events_url': f'/jobs/{batch_id}/events',
+            'total': len(batch_items),
+            'concurrency': concurrency,
             'timestamp': datetime.now().isoformat()
-        })
+        }), 202
         
+    except (TypeError, ValueError) as e:
+        return jsonify({
+            'error': f'请求参数错误: {str(e)}',
+            'success': False
+        }), 400
     except Exception as e:
-        logger.error(f"图像生成失败: {str(e)}")
+        logger.error(f"批量图像生成失败: {str(e)}")
         return jsonify({
-            'error': f'图像生成失败: {str(e)}',
+            'error': f'批量图像生成失败: {str(e)}',
             'success': False
         }), 500
 
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """查询后台任务状态和结果"""
+    job = job_manager.get(job_id)
+    if job is None:
+        # 内存中没有（如服务重启过），再查持久化记录
+        stored = job_store.get(job_id)
+        if stored is None:
+            return jsonify({
+                'error': '任务不存在或已过期',
+                'success': False
+            }), 404
+        job = {key: stored.get(key) for key in ('job_id', 'kind', 'status', 'result', 'error', 'finished_at')}
+    
+    return jsonify({
+        'success': True,
+        **job
+    })
+
+@app.route('/jobs/<job_id>/events', methods=['GET'])
+def stream_job_events(job_id):
+    """以SSE推送任务进度，批量任务中每完成一项推送一次item事件"""
+    if job_manager.get(job_id) is None:
+        return jsonify({
+            'error': '任务不存在或已过期',
+            'success': False
+        }), 404
+    
+    def generate_events():
+        try:
+            yield from job_events()
+        except GeneratorExit:
+            # 客户端断开，任务本身继续执行
+            metrics.incr('cancelled.job_events')
+            raise
+    
+    def job_events():
+        version = -1
+        sent_items = set()
+        while True:
+            job, version = job_manager.wait_for_change(job_id, version, timeout=15)
+            if job is None:
+                yield f"data: {json.dumps({'type': 'error', 'message': '任务不存在或已过期'}, ensure_ascii=False)}\n\n"
+                return
+            
+            items = (job.get('result') or {}).get('items', []) if job['kind'] == 'image_batch' else []
+            for item in items:
+                if item['index'] not in sent_items and item['status'] in (JOB_SUCCEEDED, JOB_FAILED):
+                    sent_items.add(item['index'])
+                    yield f"data: {json.dumps({'type': 'item', 'item': item}, ensure_ascii=False)}\n\n"
+            
+            if job['status'] in (JOB_SUCCEEDED, JOB_FAILED):
+                yield f"data: {json.dumps({'type': 'complete', 'job': job}, ensure_ascii=False)}\n\n"
+                return
+            
+            yield f"data: {json.dumps({'type': 'progress', 'status': job['status'], 'progress': job['progress']}, ensure_ascii=False)}\n\n"
+    
+    return Response(
+        generate_events(),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'Connection': 'keep-alive'
+        }
+    )
+
 @app.route('/download/<filename>', methods=['GET'])
 def download_image(filename):
-    """图像下载端点（如果需要文件下载功能）"""
-    # 这里可以实现文件下载逻辑
-    # 目前主要通过base64返回图像数据
-    return jsonify({
-        'error': '请使用base64数据下载图像',
-        'success': False
-    }), 404
+    """图像下载端点，支持ETag、Range和长期缓存
 
-def generate_learning_path_with_deepseek_stream(subject, level, time_available, goal, preferences=""):
-    """使用DeepSeek API流式生成个性化学习路径"""
+    带 w（宽度）或 format（webp/jpeg/png）参数时返回按需生成的预览变体
+    """
+    width = request.args.get('w')
+    variant_format = request.args.get('format')
+    
+    if width is not None:
+        try:
+            width = int(width)
+        except ValueError:
+            width = 0
+        if width <= 0:
+            return jsonify({
+                'error': f"非法宽度: {request.args.get('w')}",
+                'success': False
+            }), 400
+    
+    try:
+        if width is not None or variant_format:
+            image_path, mime_type = image_variants.get_variant(filename, width, variant_format or 'webp')
+        else:
+            image_path = image_store.path_for(filename)
+            mime_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    except InvalidFilenameError:
+        return jsonify({
+            'error': '非法文件名',
+            'success': False
+        }), 400
+    except InvalidVariantError as e:
+        return jsonify({
+            'error': str(e),
+            'success': False
+        }), 400
+    except FileNotFoundError:
+        image_path = None
+    except Exception as e:
+        logger.error(f"生成图像变体失败 {filename}: {e}")
+        return jsonify({
+            'error': '生成图像预览失败',
+            'success': False
+        }), 500
+    
+    if not image_path or not os.path.isfile(image_path):
+        return jsonify({
+            'error': '图像不存在',
+            'success': False
+        }), 404
+    
+    # 文件名唯一且内容不再变化，可以让浏览器长期缓存
+    response = send_file(
+        image_path,
+        mimetype=mime_type,
+        as_attachment=request.args.get('download') == '1',
+        download_name=os.path.basename(image_path),
+        conditional=True,
+        etag=True,
+        max_age=IMAGE_DOWNLOAD_MAX_AGE
+    )
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+def build_learning_path_event(event):
+    """把增量解析得到的字段转换成流式事件，不需要单独下发的字段返回None"""
+    if event['kind'] == 'item' and event['key'] == 'stages':
+        return {'type': 'stage', 'index': event['index'], 'data': event['value']}
+    if event['kind'] == 'field' and event['key'] in ('overview', 'additional_resources'):
+        return {'type': event['key'], 'data': event['value']}
+    if event['kind'] == 'field' and event['key'] in ('total_duration', 'difficulty_level'):
+        return {'type': 'field', 'key': event['key'], 'data': event['value']}
+    return None
+
+def build_learning_path_messages(template, subject, level, time_available, goal, preferences=""):
+    """学习路径生成的提示词：template 为 learning_path 或 learning_path_stream，两者共用固定前缀，输出格式各自独立"""
+    return build_messages(
+        template,
+        subject=subject,
+        level=level,
+        time_available=time_available,
+        goal=goal,
+        preferences=preferences if preferences else '暂无特殊偏好，请根据领域特点推荐最佳学习方式'
+    )
+
+def replay_learning_path_events(learning_path):
+    """把缓存的学习路径按流式生成时的事件顺序重新下发"""
+    for key, value in learning_path.items():
+        if key == 'stages' and isinstance(value, list):
+            for index, stage in enumerate(value):
+                yield build_learning_path_event({'kind': 'item', 'key': key, 'index': index, 'value': stage})
+        event = build_learning_path_event({'kind': 'field', 'key': key, 'value': value})
+        if event is not None:
+            yield event
+    yield {'type': 'complete', 'data': learning_path}
+
+def iter_deepseek_deltas(response, template_name, cancel_token=None):
+    """逐段产出DeepSeek流式响应中的文本内容，并记录token用量
+
+    cancel_token 被取消（客户端断开）时立即关闭上游连接，随后抛出ClientDisconnected；
+    每次读取的超时都不超过请求截止时间的剩余时间，到期抛出DeadlineExceeded。
+    """
+    if cancel_token is not None:
+        cancel_token.add_callback(response.close)
+    try:
+        for line in iter_before_deadline(response, response.iter_lines()):
+            if not line:
+                continue
+            line = line.decode('utf-8')
+            if not line.startswith('data: '):
+                continue
+            data = line[6:]  # 移除'data: '前缀
+            if data.strip() == '[DONE]':
+                break
+            try:
+                chunk_data = json.loads(data)
+            except json.JSONDecodeError:
+                continue
+            record_usage(template_name, chunk_data.get('usage'))
+            choices = chunk_data.get('choices') or []
+            if choices and choices[0].get('delta', {}).get('content'):
+                yield choices[0]['delta']['content']
+    except Exception:
+        # 连接被取消回调关闭时读取会报错，按客户端断开处理
+        if cancel_token is None or not cancel_token.cancelled:
+            raise
+    finally:
+        if cancel_token is not None:
+            cancel_token.remove_callback(response.close)
+        response.close()
+    if cancel_token is not None:
+        cancel_token.raise_if_cancelled()
+
+def generate_learning_path_with_deepseek_stream(subject, level, time_available, goal, preferences="", cancel_token=None):
+    """使用DeepSeek API流式生成个性化学习路径，客户端断开时传入的cancel_token会中止上游调用"""
     try:
-        # 构建完整的提示词，支持联网搜索
-        prompt = f"""
-你是一位世界顶级的个性化学习规划专家，拥有丰富的教育心理学和认知科学背景。请为用户制定一份科学、实用、高度个性化的学习路径。
-
-**重要：请使用你的联网搜索功能，查找并提供真实存在的、当前可访问的课程和学习资源链接。所有资源必须是真实有效的，不允许使用虚构或示例链接。**
-
-## 用户画像分析
-- 🎯 学习领域：{subject}
-- 📊 当前水平：{level}
-- ⏰ 时间投入：{time_available}
-- 🚀 学习目标：{goal}
-- 💡 学习偏好：{preferences if preferences else '暂无特殊偏好，请根据领域特点推荐最佳学习方式'}
-
-## 任务要求
-请基于认知负荷理论、间隔重复原理和刻意练习方法，设计一份循序渐进的学习路径：
-
-### 路径设计原则：
-1. **认知递进**：从具体到抽象，从简单到复杂
-2. **实践导向**：理论与实践并重，每个阶段都有动手环节
-3. **资源真实性**：**必须通过联网搜索验证所有资源链接的真实性和可访问性**
-4. **时间科学**：根据用户时间合理分配学习强度
-5. **反馈机制**：每阶段都有明确的检验标准
-
-### 输出格式要求：
-请严格按照以下JSON结构返回，确保数据完整且格式正确：
-
-```json
-{{
-  "overview": "简洁有力的学习路径总览，说明整体学习策略和预期成果",
-  "total_duration": "基于用户时间投入的总预计用时（如：6-8周）",
-  "difficulty_level": "整体难度评估（beginner/intermediate/advanced）",
-  "stages": [
-    {{
-      "title": "阶段名称（体现核心学习内容）",
-      "duration": "该阶段预计用时",
-      "description": "详细描述该阶段的学习重点、方法和预期成果",
-      "learning_objectives": ["具体的学习目标1", "具体的学习目标2", "具体的学习目标3"],
-      "resources": [
-        {{
-          "title": "资源名称",
-          "type": "video/course/article/book/practice/project/tool",
-          "url": "具体的资源链接（优先知名平台）",
-          "description": "资源特点和学习价值说明",
-          "estimated_time": "预计学习时长",
-          "difficulty": "easy/medium/hard"
-        }}
-      ],
-      "practice_projects": [
-        {{
-          "title": "实践项目名称",
-          "description": "项目详细描述和学习价值",
-          "estimated_time": "预计完成时间",
-          "skills_practiced": ["技能1", "技能2"]
-        }}
-      ],
-      "assessment_criteria": ["评估标准1", "评估标准2"]
-    }}
-  ],
-  "additional_resources": [
-    {{
-      "title": "补充资源名称",
-      "type": "community/tool/reference",
-      "url": "资源链接",
-      "description": "资源用途说明"
-    }}
-  ],
-  "success_metrics": ["成功指标1", "成功指标2", "成功指标3"]
-}}
-```
-
-**再次强调：所有URL必须是真实有效的链接，请通过联网搜索验证每个资源的可访问性。**
-        """
-        
         payload = {
             "model": "deepseek-chat",  # 使用deepseek-chat模型
-            "messages": [
-                {
-                    "role": "user",
-                    "content": prompt
-                }
-            ],
+            "messages": build_learning_path_messages('learning_path_stream', subject, level, time_available, goal, preferences),
             "stream": True,  # 启用流式输出
+            "stream_options": {"include_usage": True},  # 最后一个chunk返回token用量
             "temperature": 0.7,
             "max_tokens": 4000
         }
         
-        # 发送思考开始信号
-        yield {'type': 'thinking', 'message': '🤖 DeepSeek AI开始深度思考...'}
-        time.sleep(0.5)
-        
-        yield {'type': 'thinking', 'message': '🔍 正在联网搜索最新学习资源...'}
-        time.sleep(1.0)
-        
-        yield {'type': 'thinking', 'message': '📚 分析认知科学理论应用...'}
-        time.sleep(0.8)
-        
-        yield {'type': 'thinking', 'message': '⚡ 构建个性化学习策略...'}
-        time.sleep(0.8)
-        
         # 调用DeepSeek API
-        response = requests.post(
+        response = deepseek_client.post(
             DEEPSEEK_API_URL,
-            headers=DEEPSEEK_HEADERS,
             json=payload,
             timeout=120,  # 增加超时时间
             stream=True
@@ -403,100 +858,33 @@ def generate_learning_path_with_deepseek_stream(subject, level, time_available,
         
         if response.status_code == 200:
             content_buffer = ""
-            thinking_messages = [
-                '💡 AI正在整合多维度学习理论...',
-                '🎯 优化学习路径的认知负荷分布...',
-                '📋 验证学习资源的真实性和有效性...',
-                '🚀 调整学习节奏和实践项目难度...',
-                '✨ 完善个性化推荐算法...',
-                '🔧 优化学习反馈机制设计...'
-            ]
-            
-            message_index = 0
-            chunk_count = 0
             
-            for line in response.iter_lines():
-                if line:
-                    line = line.decode('utf-8')
-                    if line.startswith('data: '):
-                        chunk_count += 1
-                        
-                        # 每处理几个chunk就发送一个思考消息
-                        if chunk_count % 3 == 0 and message_index < len(thinking_messages):
-                            yield {'type': 'thinking', 'message': thinking_messages[message_index]}
-                            message_index += 1
-                            time.sleep(0.6)
-                        
-                        data = line[6:]  # 移除'data: '前缀
-                        if data.strip() == '[DONE]':
-                            break
-                        
-                        try:
-                            chunk_data = json.loads(data)
-                            if 'choices' in chunk_data and len(chunk_data['choices']) > 0:
-                                delta = chunk_data['choices'][0].get('delta', {})
-                                if 'content' in delta:
-                                    content_buffer += delta['content']
-                        except json.JSONDecodeError:
-                            continue
-            
-            # 发送最终思考消息
-            yield {'type': 'thinking', 'message': '🎉 学习路径生成即将完成...'}
-            time.sleep(0.5)
+            # 上游每返回一段内容就立即转发给客户端，同时增量解析，
+            # overview、每个完整的阶段和additional_resources一结束就单独下发
+            scanner = JsonStreamScanner(item_keys=('stages',))
+            for content in iter_deepseek_deltas(response, 'learning_path_stream', cancel_token):
+                content_buffer += content
+                yield {'type': 'delta', 'content': content}
+                for event in scanner.feed(content):
+                    partial = build_learning_path_event(event)
+                    if partial is not None:
+                        yield partial
             
             # 解析完整响应
             if content_buffer:
-                # 清理markdown代码块标记
-                content_buffer = re.sub(r'^```json\s*', '', content_buffer, flags=re.MULTILINE)
-                content_buffer = re.sub(r'\s*```$', '', content_buffer, flags=re.MULTILINE)
-                content_buffer = content_buffer.strip()
-                
-                # 尝试提取JSON部分
-                json_content = None
-                
-                # 方法1: 寻找第一个{到最后一个}的内容
-                first_brace = content_buffer.find('{')
-                last_brace = content_buffer.rfind('}')
-                
-                if first_brace != -1 and last_brace != -1 and last_brace > first_brace:
-                    json_content = content_buffer[first_brace:last_brace+1]
-                    
-                    try:
-                        learning_path = json.loads(json_content)
-                        yield {'type': 'complete', 'data': learning_path}
-                    except json.JSONDecodeError as e:
-                        # 方法2: 如果直接解析失败，尝试修复常见的JSON格式问题
+                learning_path = scanner.result()
+                if learning_path is None:
+                    # 流式解析没有得到完整对象（如模型输出了不合法的JSON），按首尾大括号再试一次
+                    first_brace = content_buffer.find('{')
+                    last_brace = content_buffer.rfind('}')
+                    if first_brace != -1 and last_brace > first_brace:
                         try:
-                            # 移除可能的多余文本
-                            lines = content_buffer.split('\n')
-                            json_lines = []
-                            in_json = False
-                            brace_count = 0
-                            
-                            for line in lines:
-                                if '{' in line and not in_json:
-                                    in_json = True
-                                    json_lines.append(line[line.find('{'):])
-                                    brace_count += line.count('{') - line.count('}')
-                                elif in_json:
-                                    json_lines.append(line)
-                                    brace_count += line.count('{') - line.count('}')
-                                    if brace_count <= 0:
-                                        break
-                            
-                            if json_lines:
-                                json_content = '\n'.join(json_lines)
-                                learning_path = json.loads(json_content)
-                                yield {'type': 'complete', 'data': learning_path}
-                            else:
-                                raise json.JSONDecodeError("无法找到有效的JSON内容", content_buffer, 0)
-                                
-                        except json.JSONDecodeError as e2:
-                            logger.error(f"JSON解析错误: {e2}")
-                            logger.error(f"原始内容: {content_buffer[:500]}...")
-                            # 返回原始内容作为文本响应
-                            yield {'type': 'content', 'content': content_buffer}
-                            yield {'type': 'complete', 'message': '学习路径生成完成（文本格式）'}
+                            learning_path = json.loads(content_buffer[first_brace:last_brace + 1])
+                        except json.JSONDecodeError as e:
+                            logger.error(f"JSON解析错误: {e}")
+                
+                if learning_path is not None:
+                    yield {'type': 'complete', 'data': learning_path}
                 else:
                     logger.error("未找到有效的JSON结构")
                     logger.error(f"原始内容: {content_buffer[:500]}...")
@@ -506,10 +894,16 @@ def generate_learning_path_with_deepseek_stream(subject, level, time_available,
             else:
                 yield {'type': 'error', 'message': 'AI响应内容为空'}
         else:
+            response.close()
             error_msg = f"DeepSeek API调用失败，状态码: {response.status_code}"
             logger.error(error_msg)
             yield {'type': 'error', 'message': error_msg}
             
+    except ClientDisconnected:
+        raise
+    except DeadlineExceeded:
+        logger.warning("学习路径生成超过截止时间，已停止")
+        yield {'type': 'error', 'message': '生成学习路径超时，请稍后重试'}
     except requests.exceptions.Timeout:
         error_msg = "DeepSeek API调用超时，请稍后重试"
         logger.error(error_msg)
@@ -519,256 +913,171 @@ def generate_learning_path_with_deepseek_stream(subject, level, time_available,
         logger.error(error_msg)
         yield {'type': 'error', 'message': error_msg}
 
-def generate_learning_path_with_deepseek(subject, level, time_available, goal, preferences=""):
-    """使用DeepSeek API生成个性化学习路径"""
-    try:
-        # 构建完整的提示词，支持联网搜索
-        prompt = f"""
-你是一位世界顶级的个性化学习规划专家，拥有丰富的教育心理学和认知科学背景。请为用户制定一份科学、实用、高度个性化的学习路径。
-
-**重要：请使用你的联网搜索功能，查找并提供真实存在的、当前可访问的课程和学习资源链接。所有资源必须是真实有效的，不允许使用虚构或示例链接。**
-
-## 用户画像分析
-- 🎯 学习领域：{subject}
-- 📊 当前水平：{level}
-- ⏰ 时间投入：{time_available}
-- 🚀 学习目标：{goal}
-- 💡 学习偏好：{preferences if preferences else '暂无特殊偏好，请根据领域特点推荐最佳学习方式'}
-
-## 任务要求
-请基于认知负荷理论、间隔重复原理和刻意练习方法，设计一份循序渐进的学习路径：
-
-### 路径设计原则：
-1. **认知递进**：从具体到抽象，从简单到复杂
-2. **实践导向**：理论与实践并重，每个阶段都有动手环节
-3. **资源真实性**：**必须通过联网搜索验证所有资源链接的真实性和可访问性**
-4. **时间科学**：根据用户时间合理分配学习强度
-5. **反馈机制**：每阶段都有明确的检验标准
-
-### 输出格式要求：
-请严格按照以下JSON结构返回，确保数据完整且格式正确：
-
-```json
-{{
-  "overview": "简洁有力的学习路径总览，说明整体学习策略和预期成果",
-  "total_duration": "基于用户时间投入的总预计用时（如：6-8周）",
-  "difficulty_level": "整体难度评估（beginner/intermediate/advanced）",
-  "stages": [
-    {{
-      "title": "阶段名称（体现核心学习内容）",
-      "duration": "该阶段预计用时",
-      "description": "详细描述该阶段的学习重点、方法和预期成果",
-      "learning_objectives": ["具体的学习目标1", "具体的学习目标2", "具体的学习目标3"],
-      "resources": [
-        {{
-          "title": "资源名称",
-          "type": "video/course/article/book/practice/project/tool",
-          "url": "具体的资源链接（优先知名平台）",
-          "description": "资源特点和学习价值说明",
-          "estimated_time": "预计学习时长",
-          "difficulty": "easy/medium/hard"
-        }}
-      ],
-      "milestone": "该阶段完成标志和自检方法",
-      "tips": "学习建议和注意事项"
-    }}
-  ],
-  "success_metrics": "整体学习成功的衡量标准",
-  "next_steps": "完成此路径后的进阶建议"
-}}
-```
-
-## 特别要求：
-**🔍 联网搜索要求（必须执行）：**
-- **必须使用联网搜索功能**查找当前可用的真实课程和学习资源
-- **验证所有链接的有效性**，确保用户可以直接访问
-- 优先搜索并推荐：Coursera、edX、Udemy、YouTube、GitHub、官方文档、知名大学公开课等
-- **禁止使用任何虚构、示例或占位符链接**
-
-**📚 资源质量要求：**
-- 每个阶段至少包含3-5个不同类型的真实学习资源
-- 根据用户水平调整起点，避免过于简单或困难
-- 考虑学习曲线，合理安排难度递增
-- 提供具体的实践项目和练习建议
-- 所有推荐的课程、教程、工具都必须是当前可访问的
-
-**⚠️ 重要提醒：如果无法进行联网搜索或验证链接，请在资源描述中明确说明这是基于知识库的推荐，并建议用户自行验证链接有效性。**
-
-请直接返回JSON格式的学习路径，不要包含任何解释文字。
-        """
+def generate_learning_path_with_deepseek(subject, level, time_available, goal, preferences="", cancel_token=None):
+    """使用DeepSeek API生成个性化学习路径
 
+    上游按流式读取再拼接完整内容，这样客户端断开（cancel_token被取消）时可以随时中止。
+    """
+    try:
         # 调用DeepSeek API (使用chat模型)
         payload = {
             "model": "deepseek-chat",
-            "messages": [
-                {
-                    "role": "system",
-                    "content": "你是一个专业的学习规划助手，擅长为用户制定个性化的学习计划。请始终以JSON格式返回结构化的学习路径。"
-                },
-                {
-                    "role": "user",
-                    "content": prompt
-                }
-            ],
+            "messages": build_learning_path_messages('learning_path', subject, level, time_available, goal, preferences),
+            "stream": True,
+            "stream_options": {"include_usage": True},
             "temperature": 0.7,
             "max_tokens": 4000
         }
 
-        # 增加超时时间并添加重试机制
+        def open_stream(token, hedge):
+            response = deepseek_client.post(
+                DEEPSEEK_API_URL,
+                json=payload,
+                timeout=60,  # 增加到60秒
+                stream=True,
+                retry_deposit=not hedge and attempt == 0  # 重试和对冲请求不计入重试预算
+            )
+            if response.status_code != 200:
+                logger.error(f"DeepSeek API请求失败: {response.status_code}, {response.text}")
+                response.close()
+                raise Exception(f"AI服务暂时不可用，请稍后重试")
+            return iter_deepseek_deltas(response, 'learning_path', token)
+
+        # 增加超时时间并添加重试机制；首段内容迟迟不到时先发出对冲请求
         max_retries = 2
         for attempt in range(max_retries + 1):
             try:
-                response = requests.post(
-                    DEEPSEEK_API_URL,
-                    headers=DEEPSEEK_HEADERS,
-                    json=payload,
-                    timeout=60  # 增加到60秒
-                )
+                content = ''.join(learning_path_hedger.stream(open_stream, cancel_token))
                 break  # 成功则跳出重试循环
             except requests.exceptions.Timeout as e:
-                if attempt < max_retries:
+                # 重试需要从全局预算中申请，上游整体变慢或剩余时间不够时不再盲目重试
+                if attempt < max_retries and has_time_left(2) and retry_budget.try_acquire():
                     logger.warning(f"DeepSeek API超时，正在重试 ({attempt + 1}/{max_retries})...")
                     time.sleep(2)  # 等待2秒后重试
                     continue
                 else:
                     logger.error(f"DeepSeek API多次超时失败: {str(e)}")
                     raise Exception("AI服务响应超时，请稍后重试")
+            except (CircuitOpenError, LimiterTimeoutError, ClientDisconnected, DeadlineExceeded):
+                raise
             except Exception as e:
                 logger.error(f"DeepSeek API请求异常: {str(e)}")
                 raise e
 
-        if response.status_code == 200:
-            result = response.json()
-            content = result['choices'][0]['message']['content']
+        # 尝试解析JSON
+        try:
+            # 清理可能的markdown代码块标记
+            content = content.strip()
+            if content.startswith('```json'):
+                content = content[7:]
+            if content.endswith('```'):
+                content = content[:-3]
+            content = content.strip()
             
-            # 尝试解析JSON
-            try:
-                # 清理可能的markdown代码块标记
-                content = content.strip()
-                if content.startswith('```json'):
-                    content = content[7:]
-                if content.endswith('```'):
-                    content = content[:-3]
-                content = content.strip()
-                
-                learning_path = json.loads(content)
-                return learning_path
-            except json.JSONDecodeError as e:
-                logger.error(f"JSON解析失败: {e}, 原始内容: {content}")
-                raise Exception(f"AI返回的数据格式错误，无法解析学习路径")
-        else:
-            logger.error(f"DeepSeek API请求失败: {response.status_code}, {response.text}")
-            raise Exception(f"AI服务暂时不可用，请稍后重试")
+            learning_path = json.loads(content)
+            return learning_path
+        except json.JSONDecodeError as e:
+            logger.error(f"JSON解析失败: {e}, 原始内容: {content}")
+            raise Exception(f"AI返回的数据格式错误，无法解析学习路径")
             
+    except (ClientDisconnected, DeadlineExceeded):
+        raise
     except Exception as e:
         logger.error(f"生成学习路径失败: {str(e)}")
         raise e
 
 
 
-def adjust_learning_path_with_deepseek(original_path, completed_stages, feedback, difficulty_feedback="", time_feedback=""):
-    """使用DeepSeek API调整学习路径"""
-    try:
-        # 构建调整提示词
-        prompt = f"""
-你是一名经验丰富的学习规划导师。用户已经开始了学习路径，现在需要根据学习进度和反馈来调整后续的学习计划。
-
-原始学习路径：
-{json.dumps(original_path, ensure_ascii=False, indent=2)}
-
-用户反馈信息：
-- 已完成阶段：{completed_stages}
-- 学习反馈：{feedback}
-- 难度反馈：{difficulty_feedback if difficulty_feedback else '无'}
-- 时间反馈：{time_feedback if time_feedback else '无'}
-
-请根据用户的学习进度和反馈，调整后续的学习路径。调整原则：
-1. 保持已完成的阶段不变
-2. 根据难度反馈调整后续阶段的难度和内容
-3. 根据时间反馈调整后续阶段的时间安排
-4. 根据学习反馈优化学习资源和方法
-5. 确保调整后的路径更符合用户的实际情况
-
-请以JSON格式返回调整后的完整学习路径，结构与原路径相同：
-{{
-  "overview": "调整后的学习路径总览",
-  "total_duration": "调整后的总预计用时",
-  "adjustment_summary": "本次调整的主要变化说明",
-  "stages": [
-    {{
-      "title": "阶段标题",
-      "duration": "预计用时",
-      "description": "阶段详细描述",
-      "status": "completed/current/upcoming",
-      "resources": [
-        {{
-          "title": "资源标题",
-          "type": "资源类型",
-          "url": "资源链接",
-          "description": "资源描述"
-        }}
-      ]
-    }}
-  ]
-}}
-
-请确保返回的是有效的JSON格式，不要包含任何其他文本。
-        """
-
-        # 调用DeepSeek API
-        payload = {
-            "model": "deepseek-chat",
-            "messages": [
-                {
-                    "role": "system",
-                    "content": "你是一个专业的学习规划助手，擅长根据用户反馈调整学习计划。请始终以JSON格式返回结构化的学习路径。"
-                },
-                {
-                    "role": "user",
-                    "content": prompt
-                }
-            ],
-            "temperature": 0.7,
-            "max_tokens": 4000
-        }
-
-        response = requests.post(
-            DEEPSEEK_API_URL,
-            headers=DEEPSEEK_HEADERS,
-            json=payload,
-            timeout=30
-        )
-
-        if response.status_code == 200:
-            result = response.json()
-            content = result['choices'][0]['message']['content']
-            
-            # 尝试解析JSON
-            try:
-                # 清理可能的markdown代码块标记
-                content = content.strip()
-                if content.startswith('```json'):
-                    content = content[7:]
-                if content.endswith('```'):
-                    content = content[:-3]
-                content = content.strip()
-                
-                adjusted_path = json.loads(content)
-                return adjusted_path
-            except json.JSONDecodeError as e:
-                logger.error(f"JSON解析失败: {e}, 原始内容: {content}")
-                # 如果JSON解析失败，返回原始路径并添加调整说明
-                original_path["adjustment_summary"] = "调整失败，保持原计划"
-                return original_path
-        else:
-            logger.error(f"DeepSeek API请求失败: {response.status_code}, {response.text}")
-            original_path["adjustment_summary"] = "调整失败，保持原计划"
-            return original_path
-            
-    except Exception as e:
-        logger.error(f"调整学习路径失败: {str(e)}")
-        original_path["adjustment_summary"] = "调整失败，保持原计划"
-        return original_path
+def resolve_completed_stages(stages, completed_stages):
+    """把客户端提交的已完成阶段（下标列表、阶段标题列表或已完成数量）转换成下标集合"""
+    if isinstance(completed_stages, int):
+        return set(range(min(completed_stages, len(stages))))
+    if not isinstance(completed_stages, list):
+        completed_stages = [completed_stages]
+    
+    titles = {stage.get('title'): index for index, stage in enumerate(stages)}
+    completed = set()
+    for item in completed_stages:
+        if isinstance(item, int) and 0 <= item < len(stages):
+            completed.add(item)
+        elif isinstance(item, str) and item in titles:
+            completed.add(titles[item])
+    return completed
+
+def compact_stage(stage):
+    """只保留调整时模型需要参考的字段"""
+    return {
+        'title': stage.get('title'),
+        'duration': stage.get('duration'),
+        'description': stage.get('description'),
+        'learning_objectives': stage.get('learning_objectives', []),
+        'resources': [
+            {'title': resource.get('title'), 'type': resource.get('type'), 'url': resource.get('url')}
+            for resource in stage.get('resources', [])
+        ]
+    }
+
+def adjust_learning_path_with_deepseek(original_path, completed_indices, feedback, difficulty_feedback="", time_feedback="", cancel_token=None):
+    """使用DeepSeek API调整学习路径
+
+    只把未完成的阶段以紧凑JSON发给模型，模型返回调整后的剩余阶段，
+    再与已完成阶段合并成完整路径。失败时抛出异常。
+    """
+    stages = original_path.get('stages', [])
+    completed = [stages[index] for index in sorted(completed_indices)]
+    remaining = [stage for index, stage in enumerate(stages) if index not in completed_indices]
+    
+    def compact(value):
+        return json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+    
+    # 调用DeepSeek API
+    payload = {
+        "model": "deepseek-chat",
+        "messages": build_messages(
+            'learning_path_adjust',
+            overview=original_path.get('overview', ''),
+            completed=compact([stage.get('title') for stage in completed]),
+            remaining=compact([compact_stage(stage) for stage in remaining]),
+            feedback=feedback,
+            difficulty_feedback=difficulty_feedback if difficulty_feedback else '无',
+            time_feedback=time_feedback if time_feedback else '无'
+        ),
+        "stream": True,
+        "stream_options": {"include_usage": True},
+        "temperature": 0.7,
+        "max_tokens": 2500
+    }
+
+    response = deepseek_client.post(
+        DEEPSEEK_API_URL,
+        json=payload,
+        timeout=60,
+        stream=True
+    )
+
+    if response.status_code != 200:
+        logger.error(f"DeepSeek API请求失败: {response.status_code}, {response.text}")
+        response.close()
+        raise UpstreamError(f"DeepSeek API错误: {response.status_code}", status_code=response.status_code)
+    
+    content = ''.join(iter_deepseek_deltas(response, 'learning_path_adjust', cancel_token)).strip()
+    # 清理可能的markdown代码块标记
+    if content.startswith('```json'):
+        content = content[7:]
+    if content.endswith('```'):
+        content = content[:-3]
+    adjustment = json.loads(content.strip())
+    
+    # 合并：已完成阶段保持不变，后续阶段使用调整结果
+    adjusted_path = dict(original_path)
+    adjusted_path['stages'] = (
+        [dict(stage, status='completed') for stage in completed]
+        + list(adjustment.get('stages', remaining))
+    )
+    for key in ('total_duration', 'adjustment_summary'):
+        if adjustment.get(key):
+            adjusted_path[key] = adjustment[key]
+    return adjusted_path
 
 @app.route('/generate_learning_path', methods=['POST'])
 def generate_learning_path():
@@ -793,16 +1102,53 @@ def generate_learning_path():
         
         logger.info(f"生成学习路径请求: {subject}, {level}, {time_available}")
         
-        # 生成学习路径
-        learning_path = generate_learning_path_with_deepseek(
-            subject, level, time_available, goal, preferences
-        )
+        # 规范化后相同的需求直接返回缓存结果
+        cache_key = LearningPathCache.make_key(subject, level, time_available, goal, preferences, template='learning_path')
+        request_info = {'subject': subject, 'level': level, 'time_available': time_available, 'goal': goal, 'preferences': preferences}
+        learning_path = learning_path_cache.get(cache_key)
+        if learning_path is not None:
+            return jsonify({
+                "success": True,
+                "learning_path": learning_path,
+                "path_id": learning_path_store.save(learning_path, request_info),
+                "cached": True
+            })
+        
+        user_key = get_request_user_key()
+        # 所有等待这次生成的客户端都断开后才取消上游调用
+        upstream_token = CancelToken()
+        
+        def generate():
+            with chat_scheduler.slot(user_key, PRIORITY_STANDARD, timeout=FAIR_QUEUE_TIMEOUT, cancel_token=upstream_token):
+                result = generate_learning_path_with_deepseek(
+                    subject, level, time_available, goal, preferences, cancel_token=upstream_token
+                )
+            learning_path_cache.put(cache_key, result)
+            return result
+        
+        # 生成学习路径，同时到达的相同请求共享一次DeepSeek调用
+        with deadline_scope(request_deadline(LEARNING_PATH_DEADLINE)), \
+                disconnect_watcher.watch(request.environ, 'learning_path') as client_token:
+            learning_path, shared = learning_path_flight.do(
+                cache_key, generate, cancel_token=client_token, upstream_token=upstream_token
+            )
         
         return jsonify({
             "success": True,
-            "learning_path": learning_path
+            "learning_path": learning_path,
+            "path_id": learning_path_store.save(learning_path, request_info),
+            "cached": False
         })
         
+    except ClientDisconnected:
+        return client_closed_response()
+    except DeadlineExceeded:
+        return deadline_exceeded_response()
+    except (CircuitOpenError, LimiterTimeoutError, SchedulerTimeoutError) as e:
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 503
     except Exception as e:
         logger.error(f"生成学习路径失败: {str(e)}")
         return jsonify({
@@ -810,87 +1156,105 @@ def generate_learning_path():
             "error": "生成学习路径时发生错误，请稍后重试"
         }), 500
 
+def format_sse_event(event, event_id=None):
+    """格式化一条SSE事件，带id的事件可以在断线重连时通过Last-Event-ID续传"""
+    prefix = f"id: {event_id}\n" if event_id else ""
+    return f"{prefix}data: {json.dumps(event, ensure_ascii=False)}\n\n"
+
 @app.route('/generate_learning_path_stream', methods=['POST'])
 def generate_learning_path_stream():
-    """流式生成个性化学习路径的API端点"""
+    """流式生成个性化学习路径的API端点
+
+    每条事件带 id（"<stream_id>:<序号>"）。断线后重新提交同样的请求并带上
+    Last-Event-ID 请求头（或请求体中的 lastEventId），会补发错过的事件并继续接收
+    仍在进行的生成；缓冲已过期时按普通请求处理（结果已生成的会命中缓存）。
+    """
     try:
-        data = request.get_json()
+        data = request.get_json() or {}
+        request_info = {
+            'subject': data.get('subject'), 'level': data.get('level'), 'time_available': data.get('timeAvailable'),
+            'goal': data.get('goal'), 'preferences': data.get('preferences', '')
+        }
         
-        # 验证必需字段
-        required_fields = ['subject', 'level', 'timeAvailable', 'goal']
-        for field in required_fields:
-            if not data.get(field):
-                return jsonify({
-                    "success": False, 
-                    "error": f"缺少必需字段: {field}"
-                }), 400
+        # 断线重连：续传仍在缓冲中的事件流
+        stream_id, last_seq = parse_event_id(request.headers.get('Last-Event-ID') or data.get('lastEventId'))
+        stream = learning_path_streams.get(stream_id) if stream_id else None
+        if stream is None:
+            last_seq = 0
+            
+            # 验证必需字段
+            required_fields = ['subject', 'level', 'timeAvailable', 'goal']
+            for field in required_fields:
+                if not data.get(field):
+                    return jsonify({
+                        "success": False, 
+                        "error": f"缺少必需字段: {field}"
+                    }), 400
+            
+            subject = data['subject']
+            level = data['level']
+            time_available = data['timeAvailable']
+            goal = data['goal']
+            preferences = data.get('preferences', '')
+            user_key = get_request_user_key()
+            cache_key = LearningPathCache.make_key(
+                subject, level, time_available, goal, preferences, template='learning_path_stream'
+            )
+            deadline = request_deadline(LEARNING_PATH_DEADLINE)
+            
+            def produce_events(cancel_token):
+                # 在事件流的后台线程中运行，需要自己进入请求的截止时间
+                with deadline_scope(deadline):
+                    # 缓存命中时按生成顺序快速回放
+                    cached_path = learning_path_cache.get(cache_key)
+                    if cached_path is not None:
+                        yield {'type': 'start', 'message': '⚡ 已找到相同需求的学习路径', 'cached': True}
+                        yield from replay_learning_path_events(cached_path)
+                        return
+                
+                    # 发送开始信号，之后直接转发DeepSeek的流式输出
+                    yield {'type': 'start', 'message': '🚀 AI正在生成您的专属学习路径...'}
+                
+                    # 流式调用DeepSeek API（按用户公平排队，整个流式响应期间占用名额）
+                    with chat_scheduler.slot(user_key, PRIORITY_STANDARD, timeout=FAIR_QUEUE_TIMEOUT, cancel_token=cancel_token), \
+                            closing(generate_learning_path_with_deepseek_stream(
+                                subject, level, time_available, goal, preferences, cancel_token=cancel_token
+                            )) as chunks:
+                        for chunk in chunks:
+                            if chunk['type'] in ('delta', 'thinking', 'overview', 'stage', 'additional_resources', 'field'):
+                                yield chunk
+                            elif chunk['type'] == 'complete':
+                                # 安全地获取data字段
+                                chunk_data = chunk.get('data', chunk.get('content', '学习路径生成完成'))
+                                if isinstance(chunk_data, dict):
+                                    learning_path_cache.put(cache_key, chunk_data)
+                                yield {'type': 'complete', 'message': '✅ 学习路径生成完成！', 'data': chunk_data}
+                                break
+                            elif chunk['type'] == 'content':
+                                # 处理内容类型的chunk
+                                yield {'type': 'content', 'message': '📝 正在生成学习内容...', 'content': chunk.get('content', '')}
+                            elif chunk['type'] == 'error':
+                                yield chunk
+                                break
+            
+            # 相同需求正在生成时直接加入，从第一条事件开始接收
+            stream = learning_path_streams.find_active(cache_key)
+            if stream is None:
+                stream = learning_path_streams.start(produce_events, key=cache_key)
         
-        subject = data['subject']
-        level = data['level']
-        time_available = data['timeAvailable']
-        goal = data['goal']
-        preferences = data.get('preferences', '')
+        environ = request.environ
         
         def generate_stream():
-            try:
-                # 发送开始信号
-                yield f"data: {json.dumps({'type': 'start', 'message': '🤔 开始分析您的学习需求...'}, ensure_ascii=False)}\n\n"
-                time.sleep(0.5)
-                
-                # 发送分析阶段信息
-                yield f"data: {json.dumps({'type': 'thinking', 'message': f'📚 正在分析学习领域：{subject}'}, ensure_ascii=False)}\n\n"
-                time.sleep(0.8)
-                
-                yield f"data: {json.dumps({'type': 'thinking', 'message': f'📊 评估当前水平：{level}'}, ensure_ascii=False)}\n\n"
-                time.sleep(0.8)
-                
-                yield f"data: {json.dumps({'type': 'thinking', 'message': f'⏰ 规划时间安排：{time_available}'}, ensure_ascii=False)}\n\n"
-                time.sleep(0.8)
-                
-                yield f"data: {json.dumps({'type': 'thinking', 'message': f'🎯 明确学习目标：{goal}'}, ensure_ascii=False)}\n\n"
-                time.sleep(0.8)
-                
-                if preferences:
-                    yield f"data: {json.dumps({'type': 'thinking', 'message': f'💡 考虑学习偏好：{preferences}'}, ensure_ascii=False)}\n\n"
-                    time.sleep(0.8)
-                
-                # 发送AI思考过程
-                yield f"data: {json.dumps({'type': 'thinking', 'message': '🧠 正在运用认知科学理论设计学习路径...'}, ensure_ascii=False)}\n\n"
-                time.sleep(1.0)
-                
-                yield f"data: {json.dumps({'type': 'thinking', 'message': '🔍 搜索最新的优质学习资源...'}, ensure_ascii=False)}\n\n"
-                time.sleep(1.2)
-                
-                yield f"data: {json.dumps({'type': 'thinking', 'message': '📋 构建循序渐进的学习阶段...'}, ensure_ascii=False)}\n\n"
-                time.sleep(1.0)
-                
-                yield f"data: {json.dumps({'type': 'thinking', 'message': '⚡ 优化学习效率和实践项目...'}, ensure_ascii=False)}\n\n"
-                time.sleep(1.0)
-                
-                # 调用AI生成学习路径（流式）
-                yield f"data: {json.dumps({'type': 'generating', 'message': '🚀 AI正在生成您的专属学习路径...'}, ensure_ascii=False)}\n\n"
-                
-                # 流式调用DeepSeek API
-                for chunk in generate_learning_path_with_deepseek_stream(
-                    subject, level, time_available, goal, preferences
-                ):
-                    if chunk['type'] == 'thinking':
-                        yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
-                    elif chunk['type'] == 'complete':
-                        # 安全地获取data字段
-                        chunk_data = chunk.get('data', chunk.get('content', '学习路径生成完成'))
-                        yield f"data: {json.dumps({'type': 'complete', 'message': '✅ 学习路径生成完成！', 'data': chunk_data}, ensure_ascii=False)}\n\n"
-                        break
-                    elif chunk['type'] == 'content':
-                        # 处理内容类型的chunk
-                        yield f"data: {json.dumps({'type': 'content', 'message': '📝 正在生成学习内容...', 'content': chunk.get('content', '')}, ensure_ascii=False)}\n\n"
-                    elif chunk['type'] == 'error':
-                        yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
-                        break
-                
-            except Exception as e:
-                logger.error(f"流式生成学习路径时发生错误: {str(e)}")
-                yield f"data: {json.dumps({'type': 'error', 'message': f'生成过程中出现错误: {str(e)}'}, ensure_ascii=False)}\n\n"
+            # 客户端断开只结束本次订阅，生成在宽限期内继续进行，等待重连
+            with disconnect_watcher.watch(environ) as client_token:
+                for seq, event in learning_path_streams.subscribe(stream, last_seq, cancel_token=client_token):
+                    if event is None:
+                        yield ": keep-alive\n\n"
+                        continue
+                    if event.get('type') == 'complete' and isinstance(event.get('data'), dict):
+                        # 同一次生成可能被不同用户共享，每个订阅方各自保存一份路径，之后的调整互不影响
+                        event = dict(event, path_id=learning_path_store.save(event['data'], request_info))
+                    yield format_sse_event(event, stream.event_id(seq))
         
         return Response(
             generate_stream(),
@@ -898,8 +1262,9 @@ def generate_learning_path_stream():
             headers={
                 'Cache-Control': 'no-cache',
                 'Connection': 'keep-alive',
+                'X-Accel-Buffering': 'no',  # 禁止nginx缓冲，逐段下发
                 'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Headers': 'Content-Type',
+                'Access-Control-Allow-Headers': f'Content-Type, Last-Event-ID, {DEADLINE_HEADER}',
                 'Access-Control-Allow-Methods': 'POST, OPTIONS'
             }
         )
@@ -913,37 +1278,79 @@ def generate_learning_path_stream():
 
 @app.route('/adjust_learning_path', methods=['POST'])
 def adjust_learning_path():
-    """调整学习路径"""
+    """调整学习路径
+
+    推荐提交 pathId（生成接口返回的path_id）+ completedStages；
+    兼容旧客户端直接提交 originalPath，此时先保存路径并在响应中返回path_id。
+    """
     try:
-        data = request.get_json()
+        data = request.get_json() or {}
         
         # 验证必需字段
-        required_fields = ['originalPath', 'completedStages', 'feedback']
-        for field in required_fields:
-            if not data.get(field):
+        for field in ('completedStages', 'feedback'):
+            if field not in data or data[field] in (None, ''):
                 return jsonify({
                     "success": False,
                     "error": f"缺少必需字段: {field}"
                 }), 400
         
-        original_path = data['originalPath']
-        completed_stages = data['completedStages']
-        feedback = data['feedback']
-        difficulty_feedback = data.get('difficultyFeedback', '')
-        time_feedback = data.get('timeFeedback', '')
+        path_id = data.get('pathId')
+        if path_id:
+            record = learning_path_store.get(path_id)
+            if record is None:
+                return jsonify({
+                    "success": False,
+                    "error": "学习路径不存在"
+                }), 404
+            original_path = record['learning_path']
+            version = record.get('version', 1)
+        elif data.get('originalPath'):
+            original_path = data['originalPath']
+            path_id = learning_path_store.save(original_path)
+            version = 1
+        else:
+            return jsonify({
+                "success": False,
+                "error": "缺少必需字段: pathId"
+            }), 400
         
-        logger.info(f"调整学习路径请求: 已完成阶段数: {len(completed_stages)}")
+        completed_indices = resolve_completed_stages(original_path.get('stages', []), data['completedStages'])
+        logger.info(f"调整学习路径请求: {path_id}, 已完成阶段数: {len(completed_indices)}")
         
         # 调整学习路径
-        adjusted_path = adjust_learning_path_with_deepseek(
-            original_path, completed_stages, feedback, difficulty_feedback, time_feedback
-        )
+        try:
+            with deadline_scope(request_deadline(LEARNING_PATH_DEADLINE)), \
+                    disconnect_watcher.watch(request.environ, 'adjust_learning_path') as client_token, \
+                    chat_scheduler.slot(get_request_user_key(), PRIORITY_STANDARD, timeout=FAIR_QUEUE_TIMEOUT, cancel_token=client_token):
+                adjusted_path = adjust_learning_path_with_deepseek(
+                    original_path, completed_indices, data['feedback'],
+                    data.get('difficultyFeedback', ''), data.get('timeFeedback', ''),
+                    cancel_token=client_token
+                )
+        except (SchedulerTimeoutError, ClientDisconnected):
+            raise
+        except Exception as e:
+            logger.error(f"调整学习路径失败: {str(e)}")
+            adjusted_path = dict(original_path, adjustment_summary="调整失败，保持原计划")
+        else:
+            version += 1
+            if path_id:
+                learning_path_store.update(path_id, adjusted_path, version)
         
         return jsonify({
             "success": True,
+            "path_id": path_id,
+            "version": version,
             "adjusted_path": adjusted_path
         })
         
+    except ClientDisconnected:
+        return client_closed_response()
+    except SchedulerTimeoutError as e:
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 503
     except Exception as e:
         logger.error(f"调整学习路径失败: {str(e)}")
         return jsonify({
@@ -966,6 +1373,75 @@ def model_info():
         'capabilities': ['图像生成', '学习路径规划']
     })
 
+def stream_chat_reply(messages, cancel_token=None, template_name='chat', max_tokens=None):
+    """流式调用DeepSeek，逐段产出回复内容，上游返回错误时抛出UpstreamError
+
+    cancel_token被取消时中止并抛出ClientDisconnected。
+    """
+    # 调用DeepSeek API
+    payload = {
+        "model": "deepseek-chat",
+        "messages": messages,
+        "stream": True,
+        "stream_options": {"include_usage": True}
+    }
+    if max_tokens:
+        payload["max_tokens"] = max_tokens
+    
+    def open_stream(token, hedge):
+        response = deepseek_client.post(
+            DEEPSEEK_API_URL,
+            json=payload,
+            timeout=30,
+            stream=True,
+            retry_deposit=not hedge  # 对冲请求不计入重试预算
+        )
+        
+        if response.status_code == 200:
+            return iter_deepseek_deltas(response, template_name, token)
+        
+        error_msg = f"DeepSeek API错误: {response.status_code}"
+        if response.text:
+            try:
+                error_data = response.json()
+                error_msg += f" - {error_data.get('error', {}).get('message', response.text)}"
+            except:
+                error_msg += f" - {response.text[:200]}"
+        response.close()
+        raise UpstreamError(error_msg, status_code=response.status_code)
+    
+    # 首段内容迟迟不到时发出对冲请求，先返回的一方胜出
+    return chat_hedger.stream(open_stream, cancel_token)
+
+def request_chat_reply(user_message, cancel_token=None):
+    """调用DeepSeek获取小智的回复（无会话记忆），上游返回错误时抛出UpstreamError"""
+    return ''.join(stream_chat_reply(build_messages('chat', message=user_message), cancel_token)).strip()
+
+def summarize_conversation(summary, messages, user_key):
+    """把旧摘要和若干条旧消息压缩成新的摘要（在后台线程中调用）"""
+    transcript = '\n'.join(
+        f"{'学生' if message['role'] == 'user' else '小智'}：{message['content']}" for message in messages
+    )
+    # 摘要不影响当前回复，按批量优先级排队，不挤占交互请求
+    with chat_scheduler.slot(user_key, PRIORITY_BATCH, timeout=FAIR_QUEUE_TIMEOUT):
+        return ''.join(stream_chat_reply(
+            build_messages('chat_summary', summary=summary or '无', transcript=transcript),
+            template_name='chat_summary', max_tokens=500
+        )).strip()
+
+def lookup_chat_answer(question):
+    """先按规范化后的问题精确查找缓存的回答，未命中再找只多了几个词的相似问题"""
+    reply = chat_answer_cache.get(question)
+    if reply is None:
+        similar_key = chat_question_index.nearest(question)
+        if similar_key is not None:
+            reply = chat_answer_cache.get_by_key(similar_key)
+    return reply
+
+def store_chat_answer(question, reply):
+    chat_answer_cache.put(question, reply)
+    chat_question_index.add(question, chat_answer_cache.make_key(question))
+
 # 聊天功能API
 @app.route('/chat_with_deepseek', methods=['POST'])
 def chat_with_deepseek():
@@ -979,79 +1455,51 @@ def chat_with_deepseek():
                 'error': '消息不能为空'
             }), 400
         
-        # 构建聊天提示词
-        chat_prompt = f"""
-你是一位友善、专业的卷王AI助手，名字叫小智。你的任务是帮助学生解决学习相关的问题，激励他们成为学习卷王。
-
-## 角色设定：
-- 🎓 你是一位经验丰富的学习顾问
-- 😊 性格友善、耐心，善于鼓励学生
-- 🧠 擅长各个学科领域的知识
-- 💡 能提供实用的学习方法和建议
-- 🔍 可以帮助学生分析问题、制定学习计划
-
-## 回答要求：
-1. **语言风格**：亲切友好，像学长学姐一样
-2. **内容质量**：准确、实用、有针对性
-3. **格式要求**：结构清晰，适当使用emoji增加亲和力，避免使用过多的markdown符号如#
-4. **长度控制**：回答要详细但不冗长，一般200-500字
-5. **互动性**：适当提出后续问题，引导深入交流
-6. **数学公式**：当涉及数学内容时，请使用LaTeX格式：
-   - 行内公式使用 \\( 和 \\) 包围
-   - 独立公式使用 \\[ 和 \\] 包围
-
-## 特别注意：
-- 如果问题涉及具体的学习资源，请尽量推荐真实存在的网站、课程或书籍
-- 对于学习困难，要给予鼓励和具体的解决方案
-- 如果问题超出学习范畴，礼貌地引导回到学习话题
-- 回答中尽量少用标题符号#，用简洁的文字和emoji来组织内容
-
-学生问题：{user_message}
-
-请作为小智回答这个问题：
-        """
-        
-        # 调用DeepSeek API
-        payload = {
-            "model": "deepseek-chat",
-            "messages": [
-                {
-                    "role": "user",
-                    "content": chat_prompt
-                }
-            ],
-            "stream": False
-        }
-        
-        response = requests.post(
-            DEEPSEEK_API_URL,
-            headers=DEEPSEEK_HEADERS,
-            json=payload,
-            timeout=30
-        )
-        
-        if response.status_code == 200:
-            result = response.json()
-            ai_reply = result['choices'][0]['message']['content'].strip()
-            
+        # 常见问题直接返回缓存的回答
+        cached_reply = lookup_chat_answer(user_message)
+        if cached_reply is not None:
             return jsonify({
                 'success': True,
-                'reply': ai_reply
+                'reply': cached_reply,
+                'cached': True
             })
-        else:
-            error_msg = f"DeepSeek API错误: {response.status_code}"
-            if response.text:
-                try:
-                    error_data = response.json()
-                    error_msg += f" - {error_data.get('error', {}).get('message', response.text)}"
-                except:
-                    error_msg += f" - {response.text[:200]}"
-            
-            return jsonify({
-                'success': False,
-                'error': error_msg
-            }), 500
+        
+        user_key = get_request_user_key()
+        upstream_token = CancelToken()
+        
+        def reply():
+            with chat_scheduler.slot(user_key, PRIORITY_INTERACTIVE, timeout=FAIR_QUEUE_TIMEOUT, cancel_token=upstream_token):
+                result = request_chat_reply(user_message, cancel_token=upstream_token)
+            store_chat_answer(user_message, result)
+            return result
+        
+        # 同时到达的相同问题（规范化后）只调用一次DeepSeek，提问的客户端都断开后取消上游调用
+        with deadline_scope(request_deadline(CHAT_DEADLINE)), \
+                disconnect_watcher.watch(request.environ, 'chat') as client_token:
+            ai_reply, shared = chat_flight.do(
+                chat_answer_cache.make_key(user_message), reply, cancel_token=client_token, upstream_token=upstream_token
+            )
+        
+        return jsonify({
+            'success': True,
+            'reply': ai_reply,
+            'cached': False
+        })
             
+    except ClientDisconnected:
+        return client_closed_response()
+    except DeadlineExceeded:
+        return deadline_exceeded_response()
+    except (CircuitOpenError, LimiterTimeoutError, SchedulerTimeoutError) as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 503
+    except UpstreamError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
     except requests.exceptions.Timeout:
         return jsonify({
             'success': False,
@@ -1068,6 +1516,216 @@ def chat_with_deepseek():
             'error': f'服务器内部错误: {str(e)}'
         }), 500
 
+@app.route('/chat_with_deepseek/stream', methods=['POST'])
+def chat_with_deepseek_stream():
+    """流式聊天，服务端保存会话
+
+    请求体：{message, conversationId?}；不带conversationId或会话不存在时新建会话。
+    SSE事件：start（含conversation_id）、delta（回复片段）、complete（完整回复）、error。
+    """
+    data = request.get_json() or {}
+    user_message = (data.get('message') or '').strip()
+    if not user_message:
+        return jsonify({
+            'success': False,
+            'error': '消息不能为空'
+        }), 400
+    
+    user_key = get_request_user_key()
+    conversation = None
+    if data.get('conversationId'):
+        conversation = conversation_store.get(data['conversationId'], user_key)
+    try:
+        if conversation is None:
+            conversation = conversation_store.create(user_key)
+    except Exception as e:
+        logger.error(f"创建会话失败: {e}")
+        return jsonify({
+            'success': False,
+            'error': '创建会话失败，请稍后重试'
+        }), 500
+    
+    conversation_id = conversation['conversation_id']
+    history, trimmed = conversation_store.build_history(conversation)
+    messages = build_messages('chat', history=history, message=user_message)
+    environ = request.environ
+    deadline = request_deadline(CHAT_DEADLINE)
+    # 只有会话的第一个问题与上下文无关，可以使用答案缓存
+    cacheable = not history
+    cached_reply = lookup_chat_answer(user_message) if cacheable else None
+    
+    def generate_stream():
+        yield format_sse_event({'type': 'start', 'conversation_id': conversation_id, 'cached': cached_reply is not None})
+        if cached_reply is not None:
+            yield format_sse_event({'type': 'delta', 'content': cached_reply})
+            conversation_store.append_turn(conversation_id, user_message, cached_reply)
+            yield format_sse_event({'type': 'complete', 'conversation_id': conversation_id, 'reply': cached_reply})
+            return
+        
+        reply = ''
+        with deadline_scope(deadline), disconnect_watcher.watch(environ, 'chat_stream') as client_token:
+            try:
+                with chat_scheduler.slot(user_key, PRIORITY_INTERACTIVE, timeout=FAIR_QUEUE_TIMEOUT, cancel_token=client_token), \
+                        closing(stream_chat_reply(messages, client_token)) as chunks:
+                    for content in chunks:
+                        reply += content
+                        yield format_sse_event({'type': 'delta', 'content': content})
+            except GeneratorExit:
+                client_token.cancel()
+                raise
+            except ClientDisconnected:
+                return
+            except DeadlineExceeded:
+                yield format_sse_event({'type': 'error', 'message': '回复超时，请稍后再试'})
+                return
+            except (CircuitOpenError, LimiterTimeoutError, SchedulerTimeoutError, UpstreamError) as e:
+                yield format_sse_event({'type': 'error', 'message': str(e)})
+                return
+            except Exception as e:
+                logger.error(f"流式聊天失败: {e}")
+                yield format_sse_event({'type': 'error', 'message': 'AI服务暂时不可用，请稍后再试'})
+                return
+        
+        reply = reply.strip()
+        # 客户端已断开或上游没有返回任何内容时不保存这一轮，避免会话中出现空回复
+        if client_token.cancelled:
+            return
+        if not reply:
+            yield format_sse_event({'type': 'error', 'message': 'AI服务暂时不可用，请稍后再试'})
+            return
+        if cacheable:
+            store_chat_answer(user_message, reply)
+        try:
+            conversation_store.append_turn(conversation_id, user_message, reply)
+        except Exception as e:
+            logger.error(f"保存会话失败 {conversation_id}: {e}")
+        # 超出预算的旧消息在后台并入摘要，下一轮提示词随之变短
+        if trimmed:
+            conversation_store.summarize_async(
+                conversation_id, trimmed,
+                lambda summary, old_messages: summarize_conversation(summary, old_messages, user_key)
+            )
+        yield format_sse_event({'type': 'complete', 'conversation_id': conversation_id, 'reply': reply})
+    
+    return Response(
+        generate_stream(),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'Connection': 'keep-alive',
+            'X-Accel-Buffering': 'no'
+        }
+    )
+
+@app.route('/admin/chat_cache', methods=['GET'])
+@admin_required
+def list_chat_cache():
+    """查看聊天答案缓存"""
+    return jsonify({
+        'success': True,
+        'stats': chat_answer_cache.get_stats(),
+        'entries': chat_answer_cache.list_entries()
+    })
+
+@app.route('/admin/chat_cache/pin', methods=['POST'])
+@admin_required
+def pin_chat_answer():
+    """固定问题的回答：{question, answer?}，不传answer时固定当前缓存的回答"""
+    data = request.get_json() or {}
+    question = (data.get('question') or '').strip()
+    if not question:
+        return jsonify({
+            'success': False,
+            'error': '缺少必需字段: question'
+        }), 400
+    
+    entry = chat_answer_cache.pin(question, data.get('answer') or None)
+    if entry is None:
+        return jsonify({
+            'success': False,
+            'error': '该问题没有缓存的回答，请提供answer'
+        }), 404
+    chat_question_index.add(question, entry['key'])
+    return jsonify({
+        'success': True,
+        'entry': entry
+    })
+
+@app.route('/admin/chat_cache/unpin', methods=['POST'])
+@admin_required
+def unpin_chat_answer():
+    """取消固定：{question}"""
+    data = request.get_json() or {}
+    question = (data.get('question') or '').strip()
+    if not question:
+        return jsonify({
+            'success': False,
+            'error': '缺少必需字段: question'
+        }), 400
+    
+    if not chat_answer_cache.unpin(question):
+        return jsonify({
+            'success': False,
+            'error': '该问题没有固定的回答'
+        }), 404
+    return jsonify({'success': True})
+
+@app.route('/admin/chat_cache/invalidate', methods=['POST'])
+@admin_required
+def invalidate_chat_answer():
+    """删除缓存的回答：{question} 删除单个问题，{all: true, includePinned?} 清空缓存"""
+    data = request.get_json() or {}
+    if data.get('all'):
+        removed = chat_answer_cache.clear(include_pinned=bool(data.get('includePinned')))
+        return jsonify({
+            'success': True,
+            'removed': removed
+        })
+    
+    question = (data.get('question') or '').strip()
+    if not question:
+        return jsonify({
+            'success': False,
+            'error': '缺少必需字段: question'
+        }), 400
+    return jsonify({
+        'success': True,
+        'removed': 1 if chat_answer_cache.invalidate(question) else 0
+    })
+
+def resume_generation_jobs():
+    """恢复重启前未完成的图像生成任务：已提交到ModelScope的继续轮询，未提交的重新提交
+
+    批量任务不恢复，标记为中断；其中已提交的子任务按单个任务恢复。
+    """
+    resumed = 0
+    for document in job_store.load_unfinished():
+        if document.get('kind') == 'image_batch':
+            job_store.update(
+                document['job_id'], status=JOB_FAILED, finished_at=datetime.now().isoformat(),
+                error='服务重启，批量任务已中断；已提交的子任务会继续完成，可按子任务ID查询'
+            )
+            continue
+        if document.get('kind') != 'image_generation' or not document.get('params'):
+            continue
+        # 重启前的截止时间已经没有调用方在等，恢复的任务重新计时
+        params = {
+            **document['params'], 'resume_task_id': document.get('task_id'),
+            'deadline': Deadline.after(IMAGE_GENERATION_DEADLINE).at
+        }
+        try:
+            job_manager.submit(
+                'image_generation', run_image_generation_job, params,
+                dedupe_key=params.get('cache_key'), persist=True, job_id=document['job_id'],
+                user_key=params.get('user_key'), priority=params.get('priority', PRIORITY_STANDARD)
+            )
+            resumed += 1
+        except JobQueueFullError:
+            logger.warning("任务队列已满，剩余未完成任务暂不恢复")
+            break
+    if resumed:
+        logger.info(f"已恢复 {resumed} 个未完成的图像生成任务")
+
 # 注册路由
 app.register_blueprint(analytics_bp, url_prefix='/api/analytics')
 app.register_blueprint(auth_bp, url_prefix='/api/auth')
@@ -1076,8 +1734,12 @@ if __name__ == '__main__':
     # 启动时检查API配置
     logger.info("启动Qwen-Image API服务器...")
     
-    # 创建输出目录
-    os.makedirs('generated_images', exist_ok=True)
+    # 恢复重启前未完成的任务（调试模式下只在实际服务请求的子进程中执行）
+    if not FLASK_DEBUG or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        resume_generation_jobs()
+        chat_answer_cache.load_pins()
+        for entry in chat_answer_cache.list_entries():
+            chat_question_index.add(entry['question'], entry['key'])
     
     # 检查API配置
     if check_api_config():
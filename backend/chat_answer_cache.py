@@ -0,0 +1,206 @@
+# 聊天答案缓存
+# 高频问题（规范化后相同）直接返回已有回答，按LRU和TTL淘汰；
+# 管理员可以固定条目（不过期、不淘汰，重启后仍然有效）或删除条目
+
+import hashlib
+import re
+import threading
+import time
+import unicodedata
+import logging
+from collections import OrderedDict
+
+from config import CHAT_ANSWER_CACHE_MAX_ENTRIES, CHAT_ANSWER_CACHE_TTL
+from database import db
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+PINS_COLLECTION = 'chat_answer_pins'
+
+_LEADING_PATTERN = re.compile(r'^(?:小智|请问|请教一下|问一下|我想问)+')
+_TRAILING_PATTERN = re.compile(r'(?:吗|呢|呀|啊|吧|哦)+$')
+_CJK_SPACE_PATTERN = re.compile(r'(?<=[^\x00-\x7f]) | (?=[^\x00-\x7f])')
+
+
+def normalize_question(question):
+    """问题的规范形式：统一全半角和大小写，去掉标点（保留C#、C++中的符号）、多余空白和常见的开头/结尾语气词"""
+    text = unicodedata.normalize('NFKC', str(question or '')).casefold()
+    text = ''.join(
+        ' ' if ch.isspace() else ch
+        for ch in text
+        if ch.isspace() or ch == '#' or not unicodedata.category(ch).startswith('P')
+    )
+    # 中文之间的空格没有意义，英文单词之间保留一个空格
+    text = _CJK_SPACE_PATTERN.sub('', ' '.join(text.split()))
+    text = _LEADING_PATTERN.sub('', text).strip()
+    return _TRAILING_PATTERN.sub('', text).strip()
+
+
+class ChatAnswerCache:
+    """内存中的聊天答案缓存
+
+    普通条目超过TTL在读取时丢弃，条目数超过上限时淘汰最久未访问的普通条目；
+    固定条目不受这两条限制，并保存在数据库中。
+    """
+
+    def __init__(self, max_entries=CHAT_ANSWER_CACHE_MAX_ENTRIES, ttl=CHAT_ANSWER_CACHE_TTL,
+                 database=db, pins_collection=PINS_COLLECTION):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.db = database
+        self.pins_collection = pins_collection
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> {question, answer, created_at, pinned, hits}
+
+    @staticmethod
+    def make_key(question):
+        return hashlib.sha256(normalize_question(question).encode('utf-8')).hexdigest()
+
+    def get(self, question):
+        """返回缓存的回答，未命中或已过期返回None"""
+        return self.get_by_key(self.make_key(question))
+
+    def get_by_key(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and not entry['pinned'] and time.time() - entry['created_at'] > self.ttl:
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                metrics.incr('chat_answer_cache.misses')
+                return None
+            entry['hits'] += 1
+            self.entries.move_to_end(key)
+        metrics.incr('chat_answer_cache.hits')
+        return entry['answer']
+
+    def put(self, question, answer):
+        """缓存模型的回答，不覆盖固定条目"""
+        if not answer:
+            return
+        key = self.make_key(question)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry['pinned']:
+                return
+            self.entries[key] = {
+                'question': question, 'answer': answer, 'created_at': time.time(), 'pinned': False, 'hits': 0
+            }
+            self.entries.move_to_end(key)
+            self._evict()
+
+    def _evict(self):
+        """淘汰最久未访问的普通条目（调用方需持有锁）"""
+        unpinned = sum(1 for entry in self.entries.values() if not entry['pinned'])
+        for key in list(self.entries):
+            if unpinned <= self.max_entries:
+                break
+            if not self.entries[key]['pinned']:
+                del self.entries[key]
+                unpinned -= 1
+                metrics.incr('chat_answer_cache.evictions')
+
+    def pin(self, question, answer=None):
+        """固定条目；不传answer时固定当前缓存的回答，没有可固定的回答返回None"""
+        key = self.make_key(question)
+        with self.lock:
+            entry = self.entries.get(key)
+            if answer is None:
+                if entry is None:
+                    return None
+                answer = entry['answer']
+            pinned = {
+                'question': question, 'answer': answer, 'created_at': time.time(),
+                'pinned': True, 'hits': entry['hits'] if entry else 0
+            }
+            self.entries[key] = pinned
+            self.entries.move_to_end(key)
+        try:
+            self.db.delete_many(self.pins_collection, {'key': key})
+            self.db.insert(self.pins_collection, {'key': key, 'question': question, 'answer': answer})
+        except Exception as e:
+            logger.error(f"保存固定答案失败: {e}")
+        return self._describe(key, pinned)
+
+    def unpin(self, question):
+        """取消固定，条目按普通条目继续缓存；条目不存在或未固定返回False"""
+        key = self.make_key(question)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or not entry['pinned']:
+                return False
+            entry['pinned'] = False
+            entry['created_at'] = time.time()
+            self._evict()
+        self._delete_pin(key)
+        return True
+
+    def invalidate(self, question):
+        """删除条目（包括固定条目），返回是否存在"""
+        key = self.make_key(question)
+        with self.lock:
+            entry = self.entries.pop(key, None)
+        if entry is not None and entry['pinned']:
+            self._delete_pin(key)
+        return entry is not None
+
+    def clear(self, include_pinned=False):
+        """清空普通条目，include_pinned=True 时连固定条目一起删除，返回删除的条目数"""
+        with self.lock:
+            keys = [key for key, entry in self.entries.items() if include_pinned or not entry['pinned']]
+            pinned = [key for key in keys if self.entries[key]['pinned']]
+            for key in keys:
+                del self.entries[key]
+        for key in pinned:
+            self._delete_pin(key)
+        return len(keys)
+
+    def _delete_pin(self, key):
+        try:
+            self.db.delete_many(self.pins_collection, {'key': key})
+        except Exception as e:
+            logger.error(f"删除固定答案失败: {e}")
+
+    def load_pins(self):
+        """启动时从数据库恢复固定条目"""
+        try:
+            documents = self.db.find(self.pins_collection)
+        except Exception as e:
+            logger.error(f"读取固定答案失败: {e}")
+            return 0
+        with self.lock:
+            for document in documents:
+                if document.get('key') and document.get('answer'):
+                    self.entries[document['key']] = {
+                        'question': document.get('question', ''), 'answer': document['answer'],
+                        'created_at': time.time(), 'pinned': True, 'hits': 0
+                    }
+        return len(documents)
+
+    @staticmethod
+    def _describe(key, entry):
+        return {
+            'key': key,
+            'question': entry['question'],
+            'answer': entry['answer'],
+            'pinned': entry['pinned'],
+            'hits': entry['hits'],
+            'age': round(time.time() - entry['created_at'], 1)
+        }
+
+    def list_entries(self):
+        """按最近访问时间倒序列出条目"""
+        with self.lock:
+            return [self._describe(key, entry) for key, entry in reversed(self.entries.items())]
+
+    def get_stats(self):
+        with self.lock:
+            pinned = sum(1 for entry in self.entries.values() if entry['pinned'])
+            return {'entries': len(self.entries), 'pinned': pinned, 'max_entries': self.max_entries}
+
+
+# 全局聊天答案缓存
+chat_answer_cache = ChatAnswerCache()
+
+__all__ = ['chat_answer_cache', 'ChatAnswerCache', 'normalize_question']
@@ -0,0 +1,169 @@
+# 熔断器与重试预算
+# 上游服务持续出错或变慢时快速失败，重试次数受全局预算约束，避免故障期间占满工作线程
+
+import threading
+import time
+import logging
+from collections import deque
+
+from config import (
+    CIRCUIT_FAILURE_RATE, CIRCUIT_MIN_CALLS, CIRCUIT_WINDOW_SIZE,
+    CIRCUIT_OPEN_SECONDS, CIRCUIT_HALF_OPEN_PROBES,
+    RETRY_BUDGET_RATIO, RETRY_BUDGET_MIN_PER_SECOND, RETRY_BUDGET_MAX_TOKENS
+)
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+STATE_CLOSED = 'closed'
+STATE_OPEN = 'open'
+STATE_HALF_OPEN = 'half_open'
+
+
+class CircuitOpenError(Exception):
+    """熔断器处于打开状态，请求未发往上游"""
+
+    def __init__(self, name, retry_after):
+        super().__init__(f"{name} 服务暂时不可用，请 {int(retry_after) + 1} 秒后再试")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """基于最近N次调用的熔断器
+
+    最近 window_size 次调用中失败（异常、5xx/429或超过慢调用阈值）比例达到
+    failure_rate 时打开；打开 open_seconds 后进入半开状态，只放行少量探测请求，
+    探测全部成功则关闭，任何一次失败重新打开。
+    """
+
+    def __init__(self, name, slow_call_seconds,
+                 failure_rate=CIRCUIT_FAILURE_RATE,
+                 min_calls=CIRCUIT_MIN_CALLS,
+                 window_size=CIRCUIT_WINDOW_SIZE,
+                 open_seconds=CIRCUIT_OPEN_SECONDS,
+                 half_open_probes=CIRCUIT_HALF_OPEN_PROBES):
+        self.name = name
+        self.slow_call_seconds = slow_call_seconds
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.open_seconds = open_seconds
+        self.half_open_probes = half_open_probes
+
+        self.lock = threading.Lock()
+        self.state = STATE_CLOSED
+        self.results = deque(maxlen=window_size)  # True表示失败
+        self.opened_at = 0
+        self.probes_in_flight = 0
+        self.probe_successes = 0
+
+    def before_call(self):
+        """请求发出前调用，熔断时抛出CircuitOpenError"""
+        with self.lock:
+            if self.state == STATE_OPEN:
+                remaining = self.opened_at + self.open_seconds - time.time()
+                if remaining > 0:
+                    metrics.incr(f'circuit.{self.name}.rejected')
+                    raise CircuitOpenError(self.name, remaining)
+                self._transition(STATE_HALF_OPEN)
+
+            if self.state == STATE_HALF_OPEN:
+                if self.probes_in_flight >= self.half_open_probes:
+                    metrics.incr(f'circuit.{self.name}.rejected')
+                    raise CircuitOpenError(self.name, self.open_seconds)
+                self.probes_in_flight += 1
+
+    def record(self, failed, elapsed):
+        """请求结束后记录结果"""
+        failed = failed or elapsed > self.slow_call_seconds
+        with self.lock:
+            if self.state == STATE_HALF_OPEN:
+                self.probes_in_flight = max(0, self.probes_in_flight - 1)
+                if failed:
+                    self._transition(STATE_OPEN)
+                else:
+                    self.probe_successes += 1
+                    if self.probe_successes >= self.half_open_probes:
+                        self._transition(STATE_CLOSED)
+                return
+
+            if self.state == STATE_OPEN:
+                # 打开前已经发出的请求，结果不再影响状态
+                return
+
+            self.results.append(failed)
+            if len(self.results) >= self.min_calls:
+                rate = sum(self.results) / len(self.results)
+                if rate >= self.failure_rate:
+                    logger.warning(f"{self.name} 最近 {len(self.results)} 次调用失败率 {rate:.0%}，熔断器打开")
+                    self._transition(STATE_OPEN)
+
+    def _transition(self, state):
+        """切换状态（调用方需持有锁）"""
+        self.state = state
+        self.probes_in_flight = 0
+        self.probe_successes = 0
+        if state == STATE_OPEN:
+            self.opened_at = time.time()
+            metrics.incr(f'circuit.{self.name}.opened')
+        elif state == STATE_CLOSED:
+            self.results.clear()
+            logger.info(f"{self.name} 熔断器已关闭，服务恢复")
+        metrics.set_gauge(f'circuit.{self.name}.state', state)
+
+    def get_state(self):
+        with self.lock:
+            return {
+                'state': self.state,
+                'recent_calls': len(self.results),
+                'recent_failures': sum(self.results)
+            }
+
+
+class RetryBudget:
+    """全局重试预算
+
+    每个上游请求存入 ratio 个令牌，每次重试消耗1个；另外按 min_per_second 的速度
+    补充少量令牌，保证低流量时也能重试。令牌耗尽时重试直接放弃。
+    """
+
+    def __init__(self, ratio=RETRY_BUDGET_RATIO, min_per_second=RETRY_BUDGET_MIN_PER_SECOND,
+                 max_tokens=RETRY_BUDGET_MAX_TOKENS):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+        self.updated_at = time.time()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.max_tokens, self.tokens + (now - self.updated_at) * self.min_per_second)
+        self.updated_at = now
+
+    def record_request(self):
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def try_acquire(self):
+        """申请一次重试，预算不足返回False"""
+        with self.lock:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                metrics.incr('retry_budget.granted')
+                return True
+        metrics.incr('retry_budget.denied')
+        return False
+
+    def get_state(self):
+        with self.lock:
+            self._refill()
+            return {'tokens': round(self.tokens, 2), 'max_tokens': self.max_tokens}
+
+
+# 所有上游共享一个重试预算
+retry_budget = RetryBudget()
+
+__all__ = ['CircuitBreaker', 'CircuitOpenError', 'RetryBudget', 'retry_budget']
@@ -0,0 +1,153 @@
+# 自适应并发限制
+# 按上游服务动态调整同时在途的请求数（AIMD）：响应正常时缓慢放宽，出现429/5xx、
+# 超时或延迟明显变长时成倍收紧；超出限制的调用排队等待，超过期限仍拿不到名额则失败
+
+import math
+import threading
+import time
+import logging
+
+from config import (
+    UPSTREAM_LIMIT_INITIAL, UPSTREAM_LIMIT_MIN, UPSTREAM_LIMIT_QUEUE_TIMEOUT,
+    UPSTREAM_LIMIT_BACKOFF, UPSTREAM_LIMIT_LATENCY_TOLERANCE
+)
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class LimiterTimeoutError(Exception):
+    """排队超过期限仍未拿到并发名额，请求未发往上游"""
+
+    def __init__(self, name, waited):
+        super().__init__(f"{name} 服务繁忙，排队 {waited:.1f} 秒后仍未轮到，请稍后再试")
+        self.name = name
+        self.waited = waited
+
+
+class AdaptiveLimiter:
+    """加性增、乘性减的并发限制器
+
+    每次调用结束后用结果调整上限：429、5xx、异常，或耗时超过基线的 latency_tolerance 倍
+    视为过载，上限乘以 backoff（同一时间窗内只收紧一次，避免一批同时失败的请求把上限压到底）；
+    正常完成且这次调用拿到名额时在途数已达上限（名额确实被用满）时，上限增加 1/当前上限，
+    约每一轮满载调用加一。
+    基线是非过载调用耗时的慢速指数移动平均，收集到 min_samples 个样本前不按延迟判断过载。
+    """
+
+    def __init__(self, name, max_limit, initial_limit=UPSTREAM_LIMIT_INITIAL, min_limit=UPSTREAM_LIMIT_MIN,
+                 queue_timeout=UPSTREAM_LIMIT_QUEUE_TIMEOUT, backoff=UPSTREAM_LIMIT_BACKOFF,
+                 latency_tolerance=UPSTREAM_LIMIT_LATENCY_TOLERANCE, min_samples=20, baseline_alpha=0.05):
+        self.name = name
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.queue_timeout = queue_timeout
+        self.backoff = backoff
+        self.latency_tolerance = latency_tolerance
+        self.min_samples = min_samples
+        self.baseline_alpha = baseline_alpha
+
+        self.condition = threading.Condition()
+        self.limit = float(min(self.max_limit, max(self.min_limit, initial_limit)))
+        self.in_flight = 0
+        self.waiting = 0
+        self.baseline = None
+        self.samples = 0
+        self.last_decrease = 0
+        self._publish()
+
+    def _publish(self):
+        """更新指标（调用方需持有锁）"""
+        metrics.set_gauge(f'limiter.{self.name}.limit', int(self.limit))
+        metrics.set_gauge(f'limiter.{self.name}.in_flight', self.in_flight)
+        metrics.set_gauge(f'limiter.{self.name}.waiting', self.waiting)
+
+    def acquire(self, timeout=None):
+        """拿到一个并发名额，返回拿到名额后的在途数（含本次调用），传给 record 用于判断是否满载
+
+        超过 timeout（默认 queue_timeout）秒仍未拿到抛出LimiterTimeoutError。
+        """
+        timeout = self.queue_timeout if timeout is None else timeout
+        start = time.monotonic()
+        deadline = start + timeout
+        with self.condition:
+            self.waiting += 1
+            try:
+                while self.in_flight >= int(self.limit):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        metrics.incr(f'limiter.{self.name}.timeouts')
+                        raise LimiterTimeoutError(self.name, time.monotonic() - start)
+                    self.condition.wait(remaining)
+                self.in_flight += 1
+                in_flight = self.in_flight
+            finally:
+                self.waiting -= 1
+                self._publish()
+        metrics.observe(f'limiter.{self.name}.queue_wait', time.monotonic() - start)
+        return in_flight
+
+    def release(self):
+        """归还名额"""
+        with self.condition:
+            self.in_flight = max(0, self.in_flight - 1)
+            self.condition.notify()
+            self._publish()
+
+    def record(self, elapsed, overloaded, in_flight):
+        """用一次调用的结果调整上限
+
+        overloaded 表示上游明确过载（429、5xx、超时等），in_flight 是 acquire 返回的在途数。
+        """
+        with self.condition:
+            slow = (
+                self.samples >= self.min_samples
+                and elapsed > self.baseline * self.latency_tolerance
+            )
+            if not overloaded:
+                # 慢调用也计入基线，上游整体变慢后基线随之上移，上限不会一直被压在最低值
+                self._update_baseline(elapsed)
+            if overloaded or slow:
+                self._decrease(elapsed)
+            else:
+                # 只有名额确实被用满时才放宽，避免低负载期间上限无限增长
+                if in_flight >= int(self.limit) and self.limit < self.max_limit:
+                    previous = int(self.limit)
+                    self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+                    if int(self.limit) > previous:
+                        metrics.incr(f'limiter.{self.name}.increases')
+                        self.condition.notify()
+            self._publish()
+
+    def _update_baseline(self, elapsed):
+        if self.baseline is None:
+            self.baseline = elapsed
+        else:
+            self.baseline += self.baseline_alpha * (elapsed - self.baseline)
+        self.samples += 1
+
+    def _decrease(self, elapsed):
+        """成倍收紧上限（调用方需持有锁）；距上次收紧不足一个调用耗时的不再重复收紧"""
+        now = time.monotonic()
+        if now - self.last_decrease < max(elapsed, 1.0):
+            return
+        self.last_decrease = now
+        previous = int(self.limit)
+        self.limit = max(float(self.min_limit), math.floor(self.limit * self.backoff))
+        metrics.incr(f'limiter.{self.name}.decreases')
+        if int(self.limit) < previous:
+            logger.warning(f"{self.name} 上游过载，并发上限 {previous} -> {int(self.limit)}")
+
+    def get_stats(self):
+        with self.condition:
+            return {
+                'limit': int(self.limit),
+                'min_limit': self.min_limit,
+                'max_limit': self.max_limit,
+                'in_flight': self.in_flight,
+                'waiting': self.waiting,
+                'baseline_latency': round(self.baseline, 3) if self.baseline is not None else None
+            }
+
+
+__all__ = ['AdaptiveLimiter', 'LimiterTimeoutError']
@@ -1,6 +1,8 @@
 # API配置文件
 # 请在这里设置您的API密钥
 
+import os
+
 # 阿里云DashScope API配置
 # 获取API密钥：https://dashscope.console.aliyun.com/
 API_KEY = "your-api-key-here"
@@ -17,6 +19,114 @@ FLASK_HOST = "0.0.0.0"
 FLASK_PORT = 5000
 FLASK_DEBUG = True
 
+# 后台任务配置（图像生成等耗时任务）
+IMAGE_JOB_WORKERS = int(os.getenv('IMAGE_JOB_WORKERS', '8'))  # 后台工作线程数
+IMAGE_JOB_MAX_PENDING = int(os.getenv('IMAGE_JOB_MAX_PENDING', '200'))  # 排队+执行中的任务上限
+JOB_RESULT_TTL = int(os.getenv('JOB_RESULT_TTL', '3600'))  # 已完成任务保留时间（秒）
+BATCH_MAX_ITEMS = int(os.getenv('BATCH_MAX_ITEMS', '20'))  # 批量生成单次最多提示词数
+BATCH_MAX_CONCURRENCY = int(os.getenv('BATCH_MAX_CONCURRENCY', '4'))  # 单个批量任务的并发上限
+
+# 按用户公平调度配置（AI上游调用）
+FAIR_MODELSCOPE_CAPACITY = int(os.getenv('FAIR_MODELSCOPE_CAPACITY', str(IMAGE_JOB_WORKERS)))  # 同时进行的图像生成数
+FAIR_DEEPSEEK_CAPACITY = int(os.getenv('FAIR_DEEPSEEK_CAPACITY', '8'))  # 同时进行的DeepSeek调用数
+FAIR_PER_USER_LIMIT = int(os.getenv('FAIR_PER_USER_LIMIT', '2'))  # 单个用户同时占用的名额上限
+FAIR_QUEUE_TIMEOUT = float(os.getenv('FAIR_QUEUE_TIMEOUT', '60'))  # 同步请求最长排队时间（秒）
+
+# ModelScope任务轮询配置（秒）
+TASK_POLL_INITIAL_INTERVAL = float(os.getenv('TASK_POLL_INITIAL_INTERVAL', '1.0'))  # 首次检查间隔
+TASK_POLL_MAX_INTERVAL = float(os.getenv('TASK_POLL_MAX_INTERVAL', '8.0'))  # 退避后的最大间隔
+TASK_POLL_BACKOFF = float(os.getenv('TASK_POLL_BACKOFF', '1.5'))  # 间隔增长倍数
+TASK_POLL_JITTER = float(os.getenv('TASK_POLL_JITTER', '0.2'))  # 抖动比例
+TASK_POLL_MAX_WAIT = float(os.getenv('TASK_POLL_MAX_WAIT', '300'))  # 单个任务最长等待时间
+TASK_POLL_WORKERS = int(os.getenv('TASK_POLL_WORKERS', '4'))  # 并发检查线程数
+
+# 上游HTTP连接池配置
+MODELSCOPE_POOL_SIZE = int(os.getenv('MODELSCOPE_POOL_SIZE', '20'))  # ModelScope API连接数
+IMAGE_DOWNLOAD_POOL_SIZE = int(os.getenv('IMAGE_DOWNLOAD_POOL_SIZE', '20'))  # 图像下载连接数
+DEEPSEEK_POOL_SIZE = int(os.getenv('DEEPSEEK_POOL_SIZE', '20'))  # DeepSeek API连接数
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv('UPSTREAM_CONNECT_TIMEOUT', '5'))  # 连接超时（秒）
+UPSTREAM_READ_TIMEOUT = float(os.getenv('UPSTREAM_READ_TIMEOUT', '30'))  # 默认读超时（秒）
+
+# 上游熔断与重试预算配置
+CIRCUIT_FAILURE_RATE = float(os.getenv('CIRCUIT_FAILURE_RATE', '0.5'))  # 触发熔断的失败率
+CIRCUIT_MIN_CALLS = int(os.getenv('CIRCUIT_MIN_CALLS', '10'))  # 统计失败率所需的最少调用数
+CIRCUIT_WINDOW_SIZE = int(os.getenv('CIRCUIT_WINDOW_SIZE', '20'))  # 统计最近多少次调用
+CIRCUIT_OPEN_SECONDS = float(os.getenv('CIRCUIT_OPEN_SECONDS', '30'))  # 熔断后多久进入半开状态
+CIRCUIT_HALF_OPEN_PROBES = int(os.getenv('CIRCUIT_HALF_OPEN_PROBES', '2'))  # 半开状态放行的探测请求数
+MODELSCOPE_SLOW_CALL_SECONDS = float(os.getenv('MODELSCOPE_SLOW_CALL_SECONDS', '20'))  # ModelScope慢调用阈值
+DEEPSEEK_SLOW_CALL_SECONDS = float(os.getenv('DEEPSEEK_SLOW_CALL_SECONDS', '90'))  # DeepSeek慢调用阈值
+RETRY_BUDGET_RATIO = float(os.getenv('RETRY_BUDGET_RATIO', '0.2'))  # 每个请求可换取的重试次数
+RETRY_BUDGET_MIN_PER_SECOND = float(os.getenv('RETRY_BUDGET_MIN_PER_SECOND', '0.2'))  # 低流量时的保底重试速率
+RETRY_BUDGET_MAX_TOKENS = float(os.getenv('RETRY_BUDGET_MAX_TOKENS', '10'))  # 重试令牌上限
+
+# 上游自适应并发限制配置（上限不超过各上游的连接池大小）
+UPSTREAM_LIMIT_INITIAL = int(os.getenv('UPSTREAM_LIMIT_INITIAL', '8'))  # 初始并发上限
+UPSTREAM_LIMIT_MIN = int(os.getenv('UPSTREAM_LIMIT_MIN', '1'))  # 收紧后的最低并发上限
+UPSTREAM_LIMIT_QUEUE_TIMEOUT = float(os.getenv('UPSTREAM_LIMIT_QUEUE_TIMEOUT', '30'))  # 等待并发名额的最长时间（秒）
+UPSTREAM_LIMIT_BACKOFF = float(os.getenv('UPSTREAM_LIMIT_BACKOFF', '0.7'))  # 过载时上限乘以的系数
+UPSTREAM_LIMIT_LATENCY_TOLERANCE = float(os.getenv('UPSTREAM_LIMIT_LATENCY_TOLERANCE', '2.0'))  # 耗时超过基线多少倍视为过载
+
+# DeepSeek对冲请求配置（对冲请求与重试共用重试预算）
+HEDGE_ENABLED = os.getenv('HEDGE_ENABLED', '1') == '1'  # 是否启用对冲请求
+HEDGE_PERCENTILE = float(os.getenv('HEDGE_PERCENTILE', '95'))  # 首段内容耗时超过该百分位数时发出对冲请求
+HEDGE_MIN_DELAY = float(os.getenv('HEDGE_MIN_DELAY', '2'))  # 对冲前最少等待时间（秒）
+HEDGE_DEFAULT_DELAY = float(os.getenv('HEDGE_DEFAULT_DELAY', '10'))  # 样本不足时的等待时间（秒）
+HEDGE_MIN_SAMPLES = int(os.getenv('HEDGE_MIN_SAMPLES', '20'))  # 按百分位数计算等待时间所需的最少样本数
+HEDGE_MAX_CONCURRENT = int(os.getenv('HEDGE_MAX_CONCURRENT', '8'))  # 同时进行的对冲请求上限
+HEDGE_WORKERS = int(os.getenv('HEDGE_WORKERS', '32'))  # 原请求和对冲请求共用的线程池大小
+
+# 请求截止时间配置（秒，客户端可以用请求头 X-Request-Timeout 指定剩余时间）
+REQUEST_DEADLINE_MAX = float(os.getenv('REQUEST_DEADLINE_MAX', '1800'))  # 请求头允许指定的最长时间
+IMAGE_GENERATION_DEADLINE = float(os.getenv('IMAGE_GENERATION_DEADLINE', '300'))  # 单张图像生成（排队、提交、轮询、下载和重试合计），也是单个任务占用工作线程的上限
+IMAGE_BATCH_DEADLINE = float(os.getenv('IMAGE_BATCH_DEADLINE', '1800'))  # 整个批量生成任务
+LEARNING_PATH_DEADLINE = float(os.getenv('LEARNING_PATH_DEADLINE', '150'))  # 学习路径生成/调整
+CHAT_DEADLINE = float(os.getenv('CHAT_DEADLINE', '60'))  # 聊天回复
+
+# 生成图像存储配置
+IMAGE_STORE_DIR = os.getenv('IMAGE_STORE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'generated_images'))
+IMAGE_DOWNLOAD_MAX_AGE = int(os.getenv('IMAGE_DOWNLOAD_MAX_AGE', str(365 * 24 * 3600)))  # 浏览器缓存时间（秒）
+IMAGE_DOWNLOAD_CHUNK_SIZE = int(os.getenv('IMAGE_DOWNLOAD_CHUNK_SIZE', str(64 * 1024)))  # 下载时每个请求占用的内存上限（字节）
+IMAGE_DOWNLOAD_MAX_BYTES = int(os.getenv('IMAGE_DOWNLOAD_MAX_BYTES', str(32 * 1024 * 1024)))  # 单张图像大小上限（字节）
+
+# 图像预览变体配置
+IMAGE_VARIANT_WIDTHS = [int(w) for w in os.getenv('IMAGE_VARIANT_WIDTHS', '160,320,640,960,1280').split(',')]  # 允许的宽度档位
+IMAGE_VARIANT_WORKERS = int(os.getenv('IMAGE_VARIANT_WORKERS', '2'))  # 变体编码线程数
+
+# 图像结果缓存配置
+IMAGE_CACHE_DIR = os.getenv('IMAGE_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache', 'images'))
+IMAGE_CACHE_MAX_BYTES = int(os.getenv('IMAGE_CACHE_MAX_BYTES', str(1024 * 1024 * 1024)))  # 缓存总大小上限（字节）
+IMAGE_CACHE_TTL = int(os.getenv('IMAGE_CACHE_TTL', str(7 * 24 * 3600)))  # 缓存有效期（秒）
+
+# 学习路径结果缓存配置
+LEARNING_PATH_CACHE_MAX_ENTRIES = int(os.getenv('LEARNING_PATH_CACHE_MAX_ENTRIES', '500'))  # 最多缓存的学习路径数
+LEARNING_PATH_CACHE_TTL = int(os.getenv('LEARNING_PATH_CACHE_TTL', str(24 * 3600)))  # 缓存有效期（秒）
+LEARNING_PATH_STORE_TTL = int(os.getenv('LEARNING_PATH_STORE_TTL', str(30 * 24 * 3600)))  # 保存的学习路径最后一次写入后的保留时间（秒）
+LEARNING_PATH_STORE_CLEANUP_INTERVAL = int(os.getenv('LEARNING_PATH_STORE_CLEANUP_INTERVAL', '3600'))  # 清理过期学习路径的间隔（秒）
+
+# 聊天会话记忆配置
+CHAT_HISTORY_TOKEN_BUDGET = int(os.getenv('CHAT_HISTORY_TOKEN_BUDGET', '1500'))  # 每次发给模型的历史消息token预算（估算值）
+CHAT_MAX_STORED_MESSAGES = int(os.getenv('CHAT_MAX_STORED_MESSAGES', '100'))  # 每个会话最多保存的未摘要消息数
+
+# 聊天答案缓存配置
+CHAT_ANSWER_CACHE_MAX_ENTRIES = int(os.getenv('CHAT_ANSWER_CACHE_MAX_ENTRIES', '1000'))  # 最多缓存的回答数（不含固定条目）
+CHAT_ANSWER_CACHE_TTL = int(os.getenv('CHAT_ANSWER_CACHE_TTL', str(6 * 3600)))  # 回答缓存有效期（秒）
+
+# 近似重复请求复用缓存配置
+SIMILARITY_CACHE_ENABLED = os.getenv('SIMILARITY_CACHE_ENABLED', '1') == '1'  # 是否按相似度复用缓存
+SIMILARITY_DIM = int(os.getenv('SIMILARITY_DIM', '1024'))  # n-gram哈希向量维度
+SIMILARITY_MAX_ENTRIES = int(os.getenv('SIMILARITY_MAX_ENTRIES', '2000'))  # 每个索引最多保存的条目数
+SIMILARITY_IMAGE_THRESHOLD = float(os.getenv('SIMILARITY_IMAGE_THRESHOLD', '0.85'))  # 图像提示词的相似度阈值（余弦，另需只差插入的内容）
+SIMILARITY_CHAT_THRESHOLD = float(os.getenv('SIMILARITY_CHAT_THRESHOLD', '0.85'))  # 聊天问题的相似度阈值（余弦，另需只差插入的内容）
+SIMILARITY_MAX_INSERTED_TOKENS = int(os.getenv('SIMILARITY_MAX_INSERTED_TOKENS', '6'))  # 近似重复最多允许插入的词数（中文按字计）
+SIMILARITY_MAX_INSERTED_RATIO = float(os.getenv('SIMILARITY_MAX_INSERTED_RATIO', '0.3'))  # 插入的词数占较短一方词数的上限
+
+# 管理接口令牌（请求头 X-Admin-Token），为空时管理接口不可用
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN', '')
+
+# 可续传SSE配置
+SSE_RECONNECT_GRACE = float(os.getenv('SSE_RECONNECT_GRACE', '30'))  # 客户端全部断开后继续生成、等待重连的时间（秒）
+SSE_BUFFER_TTL = int(os.getenv('SSE_BUFFER_TTL', '300'))  # 生成结束后事件缓冲的保留时间（秒）
+
 # 使用说明：
 # 1. 访问 https://dashscope.console.aliyun.com/
 # 2. 注册/登录阿里云账号
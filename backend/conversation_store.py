@@ -0,0 +1,157 @@
+# 聊天会话记忆
+# 每个会话的消息保存在数据库中；发给模型的历史按token预算只保留最近几轮，
+# 更早的轮次在后台压缩成摘要，提示词长度不会随对话变长而无限增长
+
+import threading
+import uuid
+import logging
+from datetime import datetime
+
+from config import CHAT_HISTORY_TOKEN_BUDGET, CHAT_MAX_STORED_MESSAGES
+from database import db
+from metrics import metrics
+from prompts import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+COLLECTION = 'conversations'
+
+
+def message_tokens(message):
+    """单条消息的估算token数（含角色等固定开销）"""
+    return estimate_tokens(message.get('content', '')) + 4
+
+
+class ConversationStore:
+    """会话读写和上下文裁剪
+
+    会话文档：{conversation_id, user_key, summary, messages}。messages 只保存
+    还没有被摘要覆盖的消息；摘要完成后对应的旧消息从文档中移除。
+    """
+
+    def __init__(self, database=db, collection=COLLECTION,
+                 token_budget=CHAT_HISTORY_TOKEN_BUDGET, max_messages=CHAT_MAX_STORED_MESSAGES):
+        self.db = database
+        self.collection = collection
+        self.token_budget = token_budget
+        self.max_messages = max_messages
+        self.lock = threading.Lock()
+        self.summarizing = set()
+
+    def create(self, user_key):
+        """新建会话，返回会话文档"""
+        conversation = {
+            'conversation_id': uuid.uuid4().hex,
+            'user_key': user_key,
+            'summary': '',
+            'messages': []
+        }
+        self.db.insert(self.collection, dict(conversation))
+        metrics.incr('conversations.created')
+        return conversation
+
+    def get(self, conversation_id, user_key=None):
+        """读取会话；登录用户的会话只允许本人读取，不存在或无权访问返回None"""
+        try:
+            conversation = self.db.find_one(self.collection, {'conversation_id': conversation_id})
+        except Exception as e:
+            logger.error(f"读取会话失败 {conversation_id}: {e}")
+            return None
+        if conversation is None:
+            return None
+        owner = conversation.get('user_key') or ''
+        if owner.startswith('user:') and owner != user_key:
+            return None
+        return conversation
+
+    def build_history(self, conversation):
+        """返回 (发给模型的历史消息, 超出预算的旧消息数)
+
+        从最近的消息往前按整轮（用户+助手）保留，直到用完token预算；
+        已有摘要时作为一条system消息放在最前面。
+        """
+        messages = conversation.get('messages', [])
+        summary = conversation.get('summary')
+        budget = self.token_budget
+        history = []
+        if summary:
+            history.append({'role': 'system', 'content': f'之前对话的摘要：{summary}'})
+            budget -= message_tokens(history[0])
+
+        kept = 0
+        used = 0
+        while kept + 2 <= len(messages):
+            turn = messages[len(messages) - kept - 2:len(messages) - kept]
+            cost = sum(message_tokens(message) for message in turn)
+            if used + cost > budget:
+                break
+            used += cost
+            kept += 2
+
+        dropped = len(messages) - kept
+        if dropped:
+            metrics.incr('conversations.trimmed_messages', dropped)
+        metrics.observe('conversations.history_tokens_est', used)
+        recent = [{'role': message['role'], 'content': message['content']} for message in messages[dropped:]]
+        return history + recent, dropped
+
+    def append_turn(self, conversation_id, user_message, assistant_message):
+        """追加一轮对话；超过保存上限时丢弃最旧的消息，回复为空（上游失败或没有返回内容）时不记录"""
+        if not assistant_message:
+            return
+        now = datetime.now().isoformat()
+        with self.lock:
+            conversation = self.db.find_one(self.collection, {'conversation_id': conversation_id})
+            if conversation is None:
+                return
+            messages = list(conversation.get('messages', [])) + [
+                {'role': 'user', 'content': user_message, 'at': now},
+                {'role': 'assistant', 'content': assistant_message, 'at': now}
+            ]
+            if len(messages) > self.max_messages:
+                messages = messages[len(messages) - self.max_messages:]
+            self.db.update_one(self.collection, {'conversation_id': conversation_id}, {'$set': {'messages': messages}})
+
+    def summarize_async(self, conversation_id, count, summarizer):
+        """在后台把最旧的 count 条消息并入摘要；summarizer(旧摘要, 消息列表) 返回新摘要"""
+        with self.lock:
+            if count <= 0 or conversation_id in self.summarizing:
+                return
+            self.summarizing.add(conversation_id)
+        threading.Thread(
+            target=self._summarize, args=(conversation_id, count, summarizer),
+            name='conversation-summary', daemon=True
+        ).start()
+
+    def _summarize(self, conversation_id, count, summarizer):
+        try:
+            conversation = self.db.find_one(self.collection, {'conversation_id': conversation_id})
+            if conversation is None:
+                return
+            old_messages = conversation.get('messages', [])[:count]
+            summary = summarizer(conversation.get('summary', ''), old_messages)
+            if not summary:
+                return
+            with self.lock:
+                # 摘要期间可能追加了新消息，只移除已被摘要覆盖的那部分
+                conversation = self.db.find_one(self.collection, {'conversation_id': conversation_id})
+                messages = conversation.get('messages', [])
+                if messages[:count] != old_messages:
+                    return
+                self.db.update_one(self.collection, {'conversation_id': conversation_id}, {'$set': {
+                    'summary': summary,
+                    'messages': messages[count:]
+                }})
+            metrics.incr('conversations.summaries')
+        except Exception as e:
+            metrics.incr('conversations.summary_failures')
+            logger.warning(f"会话摘要失败 {conversation_id}: {e}")
+        finally:
+            with self.lock:
+                self.summarizing.discard(conversation_id)
+
+
+# 全局会话存储
+conversation_store = ConversationStore()
+
+__all__ = ['conversation_store', 'ConversationStore']
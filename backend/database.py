@@ -14,11 +14,20 @@ class SimpleDatabase:
     def __init__(self, data_dir='data'):
         self.data_dir = data_dir
         self.lock = threading.Lock()
+        self.collection_locks = {}
         os.makedirs(data_dir, exist_ok=True)
     
     def _get_file_path(self, collection):
         return os.path.join(self.data_dir, f'{collection}.json')
     
+    def _collection_lock(self, collection):
+        """每个集合一把锁，读-改-写全程持有，并发更新不会互相覆盖"""
+        with self.lock:
+            lock = self.collection_locks.get(collection)
+            if lock is None:
+                lock = self.collection_locks[collection] = threading.RLock()
+            return lock
+    
     def _load_data(self, collection):
         file_path = self._get_file_path(collection)
         if os.path.exists(file_path):
@@ -30,22 +39,25 @@ class SimpleDatabase:
         return []
     
     def _save_data(self, collection, data):
+        # 先写临时文件再替换，不加锁的读取不会读到写了一半的文件
         file_path = self._get_file_path(collection)
-        with self.lock:
-            try:
-                with open(file_path, 'w', encoding='utf-8') as f:
-                    json.dump(data, f, ensure_ascii=False, indent=2)
-                return True
-            except IOError:
-                return False
+        temp_path = f'{file_path}.tmp'
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, indent=2)
+            os.replace(temp_path, file_path)
+            return True
+        except IOError:
+            return False
     
     def insert(self, collection, document):
         """插入文档"""
-        data = self._load_data(collection)
-        document['_id'] = len(data) + 1
-        document['created_at'] = datetime.now().isoformat()
-        data.append(document)
-        return self._save_data(collection, data)
+        with self._collection_lock(collection):
+            data = self._load_data(collection)
+            document['_id'] = len(data) + 1
+            document['created_at'] = datetime.now().isoformat()
+            data.append(document)
+            return self._save_data(collection, data)
     
     def find(self, collection, query=None, limit=None):
         """查找文档"""
@@ -68,6 +80,13 @@ class SimpleDatabase:
         
         return data
     
+    def find_one(self, collection, query):
+        """按条件查找第一个匹配的文档，不存在返回None"""
+        for doc in self._load_data(collection):
+            if all(key in doc and doc[key] == value for key, value in query.items()):
+                return doc
+        return None
+    
     def count(self, collection, query=None):
         """统计文档数量"""
         return len(self.find(collection, query))
@@ -121,23 +140,41 @@ class SimpleDatabase:
         
         return data
     
+    def update_one(self, collection, filter_query, update_data):
+        """更新单个文档"""
+        with self._collection_lock(collection):
+            data = self._load_data(collection)
+            for doc in data:
+                match = True
+                for key, value in filter_query.items():
+                    if key not in doc or doc[key] != value:
+                        match = False
+                        break
+                if match:
+                    if '$set' in update_data:
+                        doc.update(update_data['$set'])
+                    doc['updated_at'] = datetime.now().isoformat()
+                    return self._save_data(collection, data)
+            return False
+    
     def delete_many(self, collection, query):
         """删除多个文档"""
-        data = self._load_data(collection)
-        original_count = len(data)
-        
-        filtered_data = []
-        for doc in data:
-            match = True
-            for key, value in query.items():
-                if key in doc and doc[key] == value:
-                    match = False
-                    break
-            if match:
-                filtered_data.append(doc)
-        
-        self._save_data(collection, filtered_data)
-        return original_count - len(filtered_data)
+        with self._collection_lock(collection):
+            data = self._load_data(collection)
+            original_count = len(data)
+            
+            filtered_data = []
+            for doc in data:
+                match = True
+                for key, value in query.items():
+                    if key in doc and doc[key] == value:
+                        match = False
+                        break
+                if match:
+                    filtered_data.append(doc)
+            
+            self._save_data(collection, filtered_data)
+            return original_count - len(filtered_data)
 
 # 全局数据库实例
 # 根据配置选择数据库客户端
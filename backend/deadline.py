@@ -0,0 +1,160 @@
+# 请求截止时间
+# 每个请求带一个截止时间（请求头 X-Request-Timeout 或各接口的默认值），通过contextvars向下传递；
+# 排队、上游调用、轮询和重试只使用剩余的时间，时间用完立即停止，线程最长占用时间可预期
+
+import contextvars
+import time
+import logging
+from contextlib import contextmanager
+
+from config import REQUEST_DEADLINE_MAX
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# 客户端用这个请求头指定还愿意等待的秒数
+DEADLINE_HEADER = 'X-Request-Timeout'
+
+
+class DeadlineExceeded(Exception):
+    """请求的截止时间已到，剩余的操作不再执行"""
+
+    def __init__(self, message="请求处理超时，请稍后再试"):
+        super().__init__(message)
+
+
+class Deadline:
+    """绝对截止时间（time.time()时间戳），可以直接写入任务参数持久化"""
+
+    def __init__(self, at):
+        self.at = float(at)
+
+    @classmethod
+    def after(cls, seconds):
+        return cls(time.time() + seconds)
+
+    def remaining(self):
+        return max(0.0, self.at - time.time())
+
+    @property
+    def expired(self):
+        return time.time() >= self.at
+
+    def check(self):
+        """已过截止时间时抛出DeadlineExceeded"""
+        if self.expired:
+            metrics.incr('deadline.exceeded')
+            raise DeadlineExceeded()
+
+
+_current = contextvars.ContextVar('request_deadline', default=None)
+
+
+def current_deadline():
+    """当前上下文的截止时间，没有返回None"""
+    return _current.get()
+
+
+@contextmanager
+def deadline_scope(deadline):
+    """with块内以 deadline 作为当前截止时间；外层已有更早的截止时间时保留外层的
+
+    新线程不会继承contextvars，后台线程需要在线程内自己进入截止时间范围。
+    """
+    previous = _current.get()
+    if deadline is None or (previous is not None and previous.at <= deadline.at):
+        yield previous
+        return
+    _current.set(deadline)
+    try:
+        yield deadline
+    finally:
+        # 生成器中使用时可能在另一个上下文中结束，直接恢复原值而不是reset(token)
+        _current.set(previous)
+
+
+def remaining_timeout(default=None):
+    """当前截止时间下可用的超时时间：不超过 default，没有截止时间返回 default，已过期抛出DeadlineExceeded"""
+    deadline = _current.get()
+    if deadline is None:
+        return default
+    deadline.check()
+    remaining = deadline.remaining()
+    return remaining if default is None else min(default, remaining)
+
+
+def has_time_left(seconds):
+    """当前截止时间前是否还剩至少 seconds 秒，没有截止时间时返回True（用于决定是否还值得重试）"""
+    deadline = _current.get()
+    return deadline is None or deadline.remaining() > seconds
+
+
+def _response_socket(response):
+    """requests流式响应底层的socket，拿不到时返回None"""
+    connection = getattr(getattr(response, 'raw', None), 'connection', None)
+    return getattr(connection, 'sock', None)
+
+
+def cap_read_timeout(response):
+    """把流式响应下一次读取的超时限制在截止时间前，已过期抛出DeadlineExceeded
+
+    只会缩短原来的读取超时；拿不到底层socket时只检查是否过期。
+    """
+    deadline = _current.get()
+    if deadline is None:
+        return
+    deadline.check()
+    sock = _response_socket(response)
+    if sock is None:
+        return
+    remaining = max(deadline.remaining(), 0.001)
+    try:
+        current = sock.gettimeout()
+        sock.settimeout(remaining if current is None else min(current, remaining))
+    except OSError:
+        pass
+
+
+def iter_before_deadline(response, chunks):
+    """逐个产出 chunks（response 的 iter_lines/iter_content），每次读取前用剩余时间限制读取超时
+
+    从另一个线程关闭连接无法中断阻塞中的读取，所以不用定时器，而是让读取自己按时超时；
+    截止时间到达导致读取失败时抛出DeadlineExceeded。
+    """
+    deadline = _current.get()
+    if deadline is None:
+        yield from chunks
+        return
+    iterator = iter(chunks)
+    while True:
+        cap_read_timeout(response)
+        try:
+            chunk = next(iterator)
+        except StopIteration:
+            return
+        except Exception as e:
+            if deadline.expired:
+                metrics.incr('deadline.exceeded')
+                raise DeadlineExceeded() from e
+            raise
+        yield chunk
+
+
+def parse_deadline(value, default, max_seconds=REQUEST_DEADLINE_MAX):
+    """按请求头中的剩余秒数生成截止时间；缺失或不合法时使用 default，超过上限按上限处理"""
+    seconds = default
+    if value:
+        try:
+            seconds = float(value)
+        except (TypeError, ValueError):
+            logger.warning(f"忽略不合法的 {DEADLINE_HEADER}: {value}")
+        else:
+            if seconds != seconds or seconds <= 0:
+                seconds = default
+    return Deadline.after(min(seconds, max_seconds))
+
+
+__all__ = [
+    'Deadline', 'DeadlineExceeded', 'DEADLINE_HEADER', 'current_deadline', 'deadline_scope',
+    'remaining_timeout', 'has_time_left', 'cap_read_timeout', 'iter_before_deadline', 'parse_deadline'
+]
@@ -0,0 +1,160 @@
+# 客户端断开检测
+# 等待上游结果期间客户端关闭了连接时，立即取消上游调用，释放工作线程和上游连接
+
+import selectors
+import socket
+import threading
+import time
+import logging
+from contextlib import contextmanager
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class ClientDisconnected(Exception):
+    """客户端已断开，上游调用被取消"""
+    pass
+
+
+class CancelToken:
+    """取消信号：cancel() 后依次执行注册的回调（如关闭上游响应）"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        self.callbacks = []
+
+    @property
+    def cancelled(self):
+        return self.event.is_set()
+
+    def add_callback(self, callback):
+        """注册取消回调，已取消时立即执行"""
+        with self.lock:
+            if not self.event.is_set():
+                self.callbacks.append(callback)
+                return
+        callback()
+
+    def remove_callback(self, callback):
+        with self.lock:
+            if callback in self.callbacks:
+                self.callbacks.remove(callback)
+
+    def cancel(self):
+        with self.lock:
+            if self.event.is_set():
+                return
+            self.event.set()
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.warning(f"取消回调执行失败: {e}")
+
+    def raise_if_cancelled(self):
+        if self.event.is_set():
+            raise ClientDisconnected("客户端已断开连接")
+
+
+class DisconnectWatcher:
+    """用一个后台线程轮询所有正在等待上游的客户端连接
+
+    连接可读且 MSG_PEEK 读到空数据说明对端已关闭；可读但有数据（如keep-alive
+    下的下一个请求）时无法判断，停止检测该连接。拿不到底层socket的服务器上不做检测。
+    """
+
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        self.lock = threading.Condition()
+        self.watched = {}  # token -> socket
+        self.thread = None
+
+    @staticmethod
+    def _client_socket(environ):
+        return environ.get('werkzeug.socket') or environ.get('gunicorn.socket')
+
+    @contextmanager
+    def watch(self, environ, name=None):
+        """with disconnect_watcher.watch(request.environ, 'chat') as token: ...
+
+        客户端断开时 token 被取消，并按 name 计数。
+        """
+        token = CancelToken()
+        sock = self._client_socket(environ)
+        if name is not None:
+            token.add_callback(lambda: metrics.incr(f'cancelled.{name}'))
+        if sock is None:
+            yield token
+            return
+
+        with self.lock:
+            self.watched[token] = sock
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='disconnect-watcher', daemon=True)
+                self.thread.start()
+            self.lock.notify()
+        try:
+            yield token
+        finally:
+            with self.lock:
+                self.watched.pop(token, None)
+
+    def _run(self):
+        while True:
+            with self.lock:
+                while not self.watched:
+                    self.lock.wait()
+                watched = dict(self.watched)
+
+            # selectors（Linux下为epoll）没有select的FD_SETSIZE上限
+            with selectors.DefaultSelector() as selector:
+                for token, sock in watched.items():
+                    try:
+                        selector.register(sock, selectors.EVENT_READ, token)
+                    except KeyError:
+                        # 同一个连接被多个token登记，已经在检测中
+                        continue
+                    except (OSError, ValueError):
+                        # 连接已关闭（fd无效），按断开处理
+                        self._disconnected(token)
+
+                if not selector.get_map():
+                    continue
+                try:
+                    events = selector.select(self.interval)
+                except OSError as e:
+                    logger.warning(f"断开检测失败: {e}")
+                    time.sleep(self.interval)
+                    continue
+
+            for key, _ in events:
+                sock, token = key.fileobj, key.data
+                try:
+                    data = sock.recv(1, socket.MSG_PEEK)
+                except (BlockingIOError, InterruptedError):
+                    continue
+                except ValueError:
+                    # TLS连接不支持MSG_PEEK，无法检测
+                    data = b'?'
+                except OSError:
+                    data = b''
+                if data:
+                    with self.lock:
+                        self.watched.pop(token, None)
+                else:
+                    self._disconnected(token)
+
+    def _disconnected(self, token):
+        with self.lock:
+            self.watched.pop(token, None)
+        token.cancel()
+
+
+# 全局断开检测器
+disconnect_watcher = DisconnectWatcher()
+
+__all__ = ['disconnect_watcher', 'DisconnectWatcher', 'CancelToken', 'ClientDisconnected']
@@ -0,0 +1,205 @@
+# 可续传的SSE事件流
+# 生成过程在后台线程中运行，事件按序号缓存在内存里；客户端断线后带 Last-Event-ID 重连，
+# 补发错过的事件并继续接收仍在进行的生成，不需要重新调用上游
+
+import threading
+import time
+import uuid
+import logging
+
+from config import SSE_BUFFER_TTL, SSE_RECONNECT_GRACE
+from metrics import metrics
+from disconnect import CancelToken, ClientDisconnected
+
+logger = logging.getLogger(__name__)
+
+
+def parse_event_id(event_id):
+    """把 "<stream_id>:<序号>" 拆成 (stream_id, 序号)，格式不对返回 (None, 0)"""
+    stream_id, sep, seq = (event_id or '').strip().rpartition(':')
+    if not sep or not stream_id or not seq.isdigit():
+        return None, 0
+    return stream_id, int(seq)
+
+
+class EventStream:
+    """一次生成对应的事件缓冲，事件序号从1开始"""
+
+    def __init__(self, stream_id, key=None):
+        self.stream_id = stream_id
+        self.key = key
+        self.cond = threading.Condition()
+        self.events = []
+        self.done = False
+        self.finished_at = None
+        self.subscribers = 0
+        self.cancel_token = CancelToken()
+        self.grace_timer = None
+
+    def event_id(self, seq):
+        return f'{self.stream_id}:{seq}'
+
+    def publish(self, event):
+        with self.cond:
+            self.events.append(event)
+            self.cond.notify_all()
+
+    def close(self):
+        with self.cond:
+            self.done = True
+            self.finished_at = time.time()
+            self.cond.notify_all()
+
+
+class EventStreamRegistry:
+    """管理进行中和刚结束的事件流
+
+    最后一个订阅方断开后，生成继续进行 grace 秒等待重连，期间无人重连才取消上游；
+    生成结束后缓冲再保留 buffer_ttl 秒供断线客户端补取结果。
+    """
+
+    def __init__(self, name, buffer_ttl=SSE_BUFFER_TTL, grace=SSE_RECONNECT_GRACE):
+        self.name = name
+        self.buffer_ttl = buffer_ttl
+        self.grace = grace
+        self.lock = threading.Lock()
+        self.streams = {}
+        self.active_keys = {}  # 合并键 -> 进行中的stream_id
+
+    def start(self, producer, key=None):
+        """在后台线程中运行 producer(cancel_token)，把它产出的事件写入新的事件流并返回该流"""
+        stream = EventStream(uuid.uuid4().hex, key)
+        with self.lock:
+            self._sweep()
+            self.streams[stream.stream_id] = stream
+            if key is not None:
+                self.active_keys[key] = stream.stream_id
+        metrics.incr(f'sse.{self.name}.streams')
+        # 订阅方连上之前同样按宽限期处理，避免请求一开始就断开时后台一直生成
+        self._schedule_grace(stream)
+        threading.Thread(
+            target=self._run, args=(stream, producer), name=f'{self.name}-stream', daemon=True
+        ).start()
+        return stream
+
+    def get(self, stream_id):
+        with self.lock:
+            self._sweep()
+            return self.streams.get(stream_id)
+
+    def find_active(self, key):
+        """返回同一合并键下仍在生成中的事件流"""
+        with self.lock:
+            stream = self.streams.get(self.active_keys.get(key))
+        if stream is None or stream.done or stream.cancel_token.cancelled:
+            return None
+        return stream
+
+    def subscribe(self, stream, after_seq=0, cancel_token=None, keepalive=15):
+        """依次产出 (序号, 事件)；先补发 after_seq 之后的缓存事件，再等待新事件
+
+        超过 keepalive 秒没有新事件时产出 (None, None)，调用方据此发送心跳。
+        cancel_token（当前客户端的断开信号）被取消时结束订阅，但不会取消生成。
+        """
+        with stream.cond:
+            stream.subscribers += 1
+            if stream.grace_timer is not None:
+                stream.grace_timer.cancel()
+                stream.grace_timer = None
+        if after_seq:
+            metrics.incr(f'sse.{self.name}.resumed')
+            metrics.incr(f'sse.{self.name}.replayed_events', max(0, len(stream.events) - after_seq))
+
+        def wake():
+            self._notify(stream)
+
+        if cancel_token is not None:
+            cancel_token.add_callback(wake)
+        try:
+            seq = after_seq
+            while True:
+                with stream.cond:
+                    if seq >= len(stream.events) and not stream.done:
+                        if cancel_token is None or not cancel_token.cancelled:
+                            stream.cond.wait(keepalive)
+                    pending = stream.events[seq:]
+                    done = stream.done
+                if cancel_token is not None and cancel_token.cancelled:
+                    return
+                if not pending and not done:
+                    yield None, None
+                    continue
+                for event in pending:
+                    seq += 1
+                    yield seq, event
+                if done and seq >= len(stream.events):
+                    return
+        finally:
+            if cancel_token is not None:
+                cancel_token.remove_callback(wake)
+            with stream.cond:
+                stream.subscribers -= 1
+                detached = stream.subscribers == 0 and not stream.done
+            if detached:
+                self._schedule_grace(stream)
+
+    def _notify(self, stream):
+        with stream.cond:
+            stream.cond.notify_all()
+
+    def _schedule_grace(self, stream):
+        with stream.cond:
+            if stream.subscribers or stream.done or stream.grace_timer is not None:
+                return
+            stream.grace_timer = threading.Timer(self.grace, self._grace_expired, args=(stream,))
+            stream.grace_timer.daemon = True
+            stream.grace_timer.start()
+
+    def _grace_expired(self, stream):
+        with stream.cond:
+            stream.grace_timer = None
+            abandoned = stream.subscribers == 0 and not stream.done
+        if abandoned:
+            logger.info(f"事件流 {self.name}/{stream.stream_id} 无客户端重连，取消生成")
+            metrics.incr(f'cancelled.{self.name}')
+            stream.cancel_token.cancel()
+
+    def _run(self, stream, producer):
+        try:
+            for event in producer(stream.cancel_token):
+                stream.publish(event)
+        except ClientDisconnected:
+            pass
+        except Exception as e:
+            logger.error(f"事件流 {self.name} 生成失败: {e}")
+            stream.publish({'type': 'error', 'message': f'生成过程中出现错误: {str(e)}'})
+        finally:
+            stream.close()
+            with self.lock:
+                if stream.key is not None and self.active_keys.get(stream.key) == stream.stream_id:
+                    del self.active_keys[stream.key]
+
+    def _sweep(self):
+        """丢弃结束超过 buffer_ttl 的事件流（调用方需持有锁）"""
+        now = time.time()
+        expired = [
+            stream_id for stream_id, stream in self.streams.items()
+            if stream.done and now - stream.finished_at > self.buffer_ttl
+        ]
+        for stream_id in expired:
+            del self.streams[stream_id]
+
+    def get_stats(self):
+        with self.lock:
+            active = sum(1 for stream in self.streams.values() if not stream.done)
+            return {
+                'active': active,
+                'buffered': len(self.streams) - active,
+                'subscribers': sum(stream.subscribers for stream in self.streams.values())
+            }
+
+
+# 学习路径流式生成的事件流
+learning_path_streams = EventStreamRegistry('learning_path_stream')
+
+__all__ = ['learning_path_streams', 'EventStreamRegistry', 'EventStream', 'parse_event_id']
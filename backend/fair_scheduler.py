@@ -0,0 +1,200 @@
+# 按用户公平调度
+# 上游AI调用按用户（登录用户ID，未登录按IP）加权公平排队，避免单个用户占满上游并发名额
+
+import threading
+import time
+import logging
+from contextlib import contextmanager
+
+from config import FAIR_MODELSCOPE_CAPACITY, FAIR_DEEPSEEK_CAPACITY, FAIR_PER_USER_LIMIT
+from metrics import metrics
+from disconnect import ClientDisconnected
+from deadline import remaining_timeout
+
+logger = logging.getLogger(__name__)
+
+# 优先级，数值越小越先调度
+PRIORITY_INTERACTIVE = 0  # 聊天、单张图像等用户正在等待的请求
+PRIORITY_STANDARD = 1  # 学习路径生成/调整
+PRIORITY_BATCH = 2  # 批量图像生成
+
+PRIORITY_NAMES = {
+    PRIORITY_INTERACTIVE: 'interactive',
+    PRIORITY_STANDARD: 'standard',
+    PRIORITY_BATCH: 'batch',
+}
+
+
+class SchedulerTimeoutError(Exception):
+    """排队超时，请求未发往上游"""
+    pass
+
+
+class Ticket:
+    """一次排队申请"""
+
+    def __init__(self, user_key, priority, start_tag, finish_tag, seq, on_granted):
+        self.user_key = user_key
+        self.priority = priority
+        self.start_tag = start_tag
+        self.finish_tag = finish_tag
+        self.seq = seq
+        self.on_granted = on_granted
+        self.enqueued_at = time.perf_counter()
+        self.granted = False
+        self.released = False
+
+
+class FairScheduler:
+    """加权公平队列（start-time fair queuing）
+
+    每个用户的请求按 开始标签 = max(虚拟时间, 该用户上一请求的结束标签)、
+    结束标签 = 开始标签 + cost / weight 排队；有空闲名额时先按优先级、再按结束标签
+    选出下一个请求。单个用户同时占用的名额不超过 per_user_limit，
+    超出的请求留在队列中，不影响其他用户。
+    """
+
+    def __init__(self, name, capacity, per_user_limit=FAIR_PER_USER_LIMIT):
+        self.name = name
+        self.capacity = max(1, capacity)
+        self.per_user_limit = max(1, per_user_limit)
+        self.lock = threading.Lock()
+        self.waiting = []
+        self.in_flight = 0
+        self.user_in_flight = {}
+        self.user_finish_tags = {}
+        self.virtual_time = 0.0
+        self.seq = 0
+
+    def enqueue(self, user_key, priority, on_granted, cost=1.0, weight=1.0):
+        """排队申请一个名额，获得名额时回调 on_granted(ticket)，返回ticket
+
+        获得名额后必须调用 release(ticket) 归还。
+        """
+        with self.lock:
+            start_tag = max(self.virtual_time, self.user_finish_tags.get(user_key, 0.0))
+            finish_tag = start_tag + cost / weight
+            self.user_finish_tags[user_key] = finish_tag
+            self.seq += 1
+            ticket = Ticket(user_key, priority, start_tag, finish_tag, self.seq, on_granted)
+            self.waiting.append(ticket)
+            granted = self._dispatch()
+
+        self._notify(granted)
+        return ticket
+
+    def acquire(self, user_key, priority, timeout=None, cost=1.0, weight=1.0, cancel_token=None):
+        """阻塞直到获得名额，超时抛出SchedulerTimeoutError；排队期间客户端断开抛出ClientDisconnected
+
+        排队时间不超过当前请求截止时间的剩余时间，截止时间先到时抛出DeadlineExceeded。
+        """
+        timeout = remaining_timeout(timeout)
+        event = threading.Event()
+        ticket = self.enqueue(user_key, priority, lambda _: event.set(), cost=cost, weight=weight)
+        if cancel_token is not None:
+            cancel_token.add_callback(event.set)
+        granted = event.wait(timeout)
+        if cancel_token is not None:
+            cancel_token.remove_callback(event.set)
+            if cancel_token.cancelled:
+                if not self.cancel(ticket):
+                    self.release(ticket)
+                raise ClientDisconnected("客户端已断开连接")
+        if not granted and self.cancel(ticket):
+            metrics.incr(f'scheduler.{self.name}.timeouts')
+            remaining_timeout()
+            raise SchedulerTimeoutError(f"{self.name} 服务繁忙，排队超时，请稍后再试")
+        return ticket
+
+    @contextmanager
+    def slot(self, user_key, priority, timeout=None, cancel_token=None):
+        """with scheduler.slot(user_key, priority): ... 期间占用一个名额"""
+        ticket = self.acquire(user_key, priority, timeout=timeout, cancel_token=cancel_token)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    def cancel(self, ticket):
+        """取消尚在排队的申请，已获得名额返回False"""
+        with self.lock:
+            if ticket.granted:
+                return False
+            self.waiting.remove(ticket)
+            self._update_gauges()
+            return True
+
+    def release(self, ticket):
+        """归还名额"""
+        with self.lock:
+            if not ticket.granted or ticket.released:
+                return
+            ticket.released = True
+            self.in_flight -= 1
+            user_key = ticket.user_key
+            self.user_in_flight[user_key] -= 1
+            if not self.user_in_flight[user_key]:
+                del self.user_in_flight[user_key]
+                # 用户不再有排队或进行中的请求，下次从当前虚拟时间重新开始排队
+                if not any(waiting.user_key == user_key for waiting in self.waiting):
+                    self.user_finish_tags.pop(user_key, None)
+            granted = self._dispatch()
+
+        self._notify(granted)
+
+    def _dispatch(self):
+        """把空闲名额分配给排队中的请求，返回新获得名额的ticket（调用方需持有锁）"""
+        granted = []
+        while self.in_flight < self.capacity:
+            candidates = [
+                ticket for ticket in self.waiting
+                if self.user_in_flight.get(ticket.user_key, 0) < self.per_user_limit
+            ]
+            if not candidates:
+                break
+            ticket = min(candidates, key=lambda t: (t.priority, t.finish_tag, t.seq))
+            self.waiting.remove(ticket)
+            ticket.granted = True
+            self.in_flight += 1
+            self.user_in_flight[ticket.user_key] = self.user_in_flight.get(ticket.user_key, 0) + 1
+            self.virtual_time = max(self.virtual_time, ticket.start_tag)
+
+            wait = time.perf_counter() - ticket.enqueued_at
+            metrics.observe(f'scheduler.{self.name}.queue_wait', wait)
+            metrics.observe(f'scheduler.{self.name}.queue_wait.{PRIORITY_NAMES.get(ticket.priority, ticket.priority)}', wait)
+            granted.append(ticket)
+        self._update_gauges()
+        return granted
+
+    def _notify(self, granted):
+        for ticket in granted:
+            try:
+                ticket.on_granted(ticket)
+            except Exception as e:
+                logger.error(f"调度回调执行失败 {self.name}: {e}")
+                self.release(ticket)
+
+    def _update_gauges(self):
+        metrics.set_gauge(f'scheduler.{self.name}.in_flight', self.in_flight)
+        metrics.set_gauge(f'scheduler.{self.name}.queued', len(self.waiting))
+
+    def get_stats(self):
+        with self.lock:
+            queued = {}
+            for ticket in self.waiting:
+                name = PRIORITY_NAMES.get(ticket.priority, ticket.priority)
+                queued[name] = queued.get(name, 0) + 1
+            return {
+                'capacity': self.capacity,
+                'in_flight': self.in_flight,
+                'queued': queued,
+                'active_users': len(self.user_in_flight)
+            }
+
+
+# 每个上游一个调度器
+image_scheduler = FairScheduler('modelscope', FAIR_MODELSCOPE_CAPACITY)
+chat_scheduler = FairScheduler('deepseek', FAIR_DEEPSEEK_CAPACITY)
+
+__all__ = ['image_scheduler', 'chat_scheduler', 'FairScheduler', 'SchedulerTimeoutError',
+           'PRIORITY_INTERACTIVE', 'PRIORITY_STANDARD', 'PRIORITY_BATCH']
@@ -0,0 +1,219 @@
+# 对冲请求
+# 上游迟迟没有返回第一段内容时，再发出一个相同的请求，先返回内容的一方胜出，另一方立即取消，
+# 用少量额外调用换取更低的长尾延迟
+
+import contextvars
+import queue
+import threading
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from config import (
+    HEDGE_ENABLED, HEDGE_PERCENTILE, HEDGE_MIN_DELAY, HEDGE_DEFAULT_DELAY, HEDGE_MIN_SAMPLES,
+    HEDGE_MAX_CONCURRENT, HEDGE_WORKERS
+)
+from metrics import metrics
+from circuit_breaker import retry_budget
+from deadline import remaining_timeout
+from disconnect import CancelToken
+
+logger = logging.getLogger(__name__)
+
+_EMPTY = object()
+# 客户端取消时放入结果队列，唤醒等待中的调用方
+_CANCELLED = object()
+
+
+class HedgePool:
+    """所有Hedger共用的线程池
+
+    原请求和对冲请求都在池中执行，调用方线程只等待结果队列，落败的请求即使阻塞在连接或读取上
+    也不会拖住调用方；同时进行的对冲请求另有上限，占满时不再发出新的对冲请求。
+    """
+
+    def __init__(self, workers=HEDGE_WORKERS, max_hedges=HEDGE_MAX_CONCURRENT):
+        self.hedge_slots = threading.BoundedSemaphore(max(1, max_hedges))
+        self.executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='hedge')
+
+    def reserve_hedge(self):
+        """占用一个对冲名额，已占满时返回False"""
+        return self.hedge_slots.acquire(blocking=False)
+
+    def release_hedge(self):
+        self.hedge_slots.release()
+
+    def submit(self, fn, *args, hedge=False):
+        """在线程池中执行 fn；hedge=True 时执行结束后归还 reserve_hedge 占到的名额"""
+        def run():
+            try:
+                fn(*args)
+            finally:
+                if hedge:
+                    self.hedge_slots.release()
+
+        self.executor.submit(run)
+
+
+class Hedger:
+    """按首段内容耗时的百分位数决定何时发出对冲请求
+
+    原请求和对冲请求都在共用线程池中执行，调用方等待结果队列，取最先拿到首段内容的一方；
+    对冲请求从重试预算中申请，预算不足或对冲名额已满时只等待原请求；每次调用最多发出一个对冲请求。
+    """
+
+    def __init__(self, name, percentile=HEDGE_PERCENTILE, min_delay=HEDGE_MIN_DELAY,
+                 default_delay=HEDGE_DEFAULT_DELAY, min_samples=HEDGE_MIN_SAMPLES,
+                 budget=retry_budget, enabled=HEDGE_ENABLED, pool=None):
+        self.name = name
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.default_delay = default_delay
+        self.min_samples = min_samples
+        self.budget = budget
+        self.enabled = enabled
+        self.pool = pool or hedge_pool
+        self.metric = f'hedge.{name}.first_token'
+
+    def delay(self):
+        """发出对冲请求前等待的秒数，样本不足时使用默认值"""
+        if metrics.sample_count(self.metric) < self.min_samples:
+            return self.default_delay
+        return max(self.min_delay, metrics.percentile(self.metric, self.percentile))
+
+    def stream(self, open_stream, cancel_token=None):
+        """open_stream(cancel_token, hedge) 发起请求并返回内容迭代器，返回最先产出内容的迭代器
+
+        hedge 为True表示对冲请求（不应再向重试预算存入额度）。
+        两个请求都失败时抛出先到的异常；cancel_token 被取消时立即抛出ClientDisconnected并取消所有请求，
+        请求截止时间到达时抛出DeadlineExceeded。
+        """
+        if not self.enabled:
+            return open_stream(cancel_token, False)
+
+        results = queue.Queue()
+        attempts = []
+        lock = threading.Lock()
+        state = {'winner': None, 'closed': False}
+
+        def claim(token):
+            """第一个拿到首段内容的请求胜出，取消其余请求；调用方已放弃等待时不再胜出"""
+            with lock:
+                if state['winner'] is not None or state['closed']:
+                    return False
+                state['winner'] = token
+                losers = [other for other in attempts if other is not token]
+            for other in losers:
+                other.cancel()
+            return True
+
+        def launch(hedge):
+            token = CancelToken()
+            with lock:
+                attempts.append(token)
+            # 调用方的截止时间等上下文随请求带进线程池；同一个Context不能在两个线程中同时进入，每个请求各复制一份
+            context = contextvars.copy_context()
+            self.pool.submit(context.run, self._attempt, open_stream, token, hedge, claim, results, hedge=hedge)
+
+        def cancel_all():
+            with lock:
+                state['closed'] = True
+                tokens = list(attempts)
+            for token in tokens:
+                token.cancel()
+            results.put(_CANCELLED)
+
+        if cancel_token is not None:
+            cancel_token.add_callback(cancel_all)
+        try:
+            launch(False)
+            pending = 1
+            hedge_at = time.monotonic() + self.delay()
+            first_error = None
+            while True:
+                if cancel_token is not None:
+                    cancel_token.raise_if_cancelled()
+                timeout = remaining_timeout()
+                if hedge_at is not None:
+                    wait = max(0.0, hedge_at - time.monotonic())
+                    timeout = wait if timeout is None else min(timeout, wait)
+                try:
+                    outcome = results.get(timeout=timeout)
+                except queue.Empty:
+                    if hedge_at is not None and time.monotonic() >= hedge_at:
+                        hedge_at = None
+                        if self._reserve_hedge():
+                            launch(True)
+                            pending += 1
+                    continue
+                if outcome is _CANCELLED:
+                    continue
+                hedge, first, iterator, error = outcome
+                if error is None:
+                    break
+                pending -= 1
+                first_error = first_error or error
+                if not pending:
+                    raise first_error
+        except BaseException:
+            cancel_all()
+            if cancel_token is not None:
+                cancel_token.remove_callback(cancel_all)
+            raise
+
+        if hedge:
+            metrics.incr(f'hedge.{self.name}.won')
+        return self._follow(first, iterator, cancel_token, cancel_all)
+
+    def _reserve_hedge(self):
+        """先占对冲名额再申请预算，名额已满时不消耗预算"""
+        if not self.pool.reserve_hedge():
+            metrics.incr(f'hedge.{self.name}.denied')
+            return False
+        if not self.budget.try_acquire():
+            self.pool.release_hedge()
+            metrics.incr(f'hedge.{self.name}.denied')
+            return False
+        metrics.incr(f'hedge.{self.name}.sent')
+        return True
+
+    def _attempt(self, open_stream, token, hedge, claim, results):
+        """在线程池中执行一个请求；胜出时把首段内容交给调用方，落败时直接关闭"""
+        start = time.perf_counter()
+        try:
+            # 排队期间其他请求可能已经胜出或客户端已断开
+            token.raise_if_cancelled()
+            iterator = open_stream(token, hedge)
+            first = next(iterator, _EMPTY)
+        except Exception as e:
+            if not token.cancelled:
+                logger.warning(f"{self.name} {'对冲' if hedge else '原始'}请求失败: {e}")
+            results.put((hedge, None, None, e))
+            return
+        metrics.observe(self.metric, time.perf_counter() - start)
+        if claim(token):
+            results.put((hedge, first, iterator, None))
+        else:
+            self._close(iterator)
+
+    @staticmethod
+    def _close(iterator):
+        close = getattr(iterator, 'close', None)
+        if close is not None:
+            close()
+
+    def _follow(self, first, iterator, cancel_token, cancel_all):
+        try:
+            if first is not _EMPTY:
+                yield first
+            yield from iterator
+        finally:
+            self._close(iterator)
+            if cancel_token is not None:
+                cancel_token.remove_callback(cancel_all)
+
+
+# 所有Hedger共用一个线程池
+hedge_pool = HedgePool()
+
+__all__ = ['Hedger', 'HedgePool', 'hedge_pool']
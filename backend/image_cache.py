@@ -0,0 +1,167 @@
+# 生成图像结果缓存
+# 以生成参数的哈希为键，把图像保存在本地磁盘，按LRU和TTL淘汰
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import logging
+from collections import OrderedDict
+
+from config import IMAGE_CACHE_DIR, IMAGE_CACHE_MAX_BYTES, IMAGE_CACHE_TTL
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class ImageCache:
+    """内容寻址的磁盘图像缓存
+
+    索引保存在 index.json 中，重启后仍然有效；访问顺序在内存中维护，
+    总大小超过上限时淘汰最久未访问的条目。
+    """
+
+    def __init__(self, cache_dir=IMAGE_CACHE_DIR, max_bytes=IMAGE_CACHE_MAX_BYTES, ttl=IMAGE_CACHE_TTL):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.index_path = os.path.join(cache_dir, 'index.json')
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> {'size', 'created_at', 'last_access'}
+        self.total_bytes = 0
+        self._dirty_reads = 0
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self._load_index()
+
+    @staticmethod
+    def make_key(optimized_prompt, aspect_ratio, seed, steps, cfg):
+        """根据生成参数计算缓存键"""
+        raw = json.dumps([optimized_prompt, aspect_ratio, seed, steps, cfg], ensure_ascii=False)
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def _file_path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.png')
+
+    def _load_index(self):
+        """加载磁盘索引，丢弃文件已不存在的条目"""
+        if not os.path.exists(self.index_path):
+            return
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (json.JSONDecodeError, IOError) as e:
+            logger.warning(f"图像缓存索引损坏，重新建立: {e}")
+            return
+
+        for key, entry in sorted(data.items(), key=lambda item: item[1].get('last_access', 0)):
+            if os.path.exists(self._file_path(key)):
+                self.entries[key] = entry
+                self.total_bytes += entry.get('size', 0)
+        logger.info(f"图像缓存已加载: {len(self.entries)} 个条目, {self.total_bytes} 字节")
+
+    def _save_index(self):
+        """保存索引（调用方需持有锁）"""
+        tmp_path = self.index_path + '.tmp'
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.entries, f)
+            os.replace(tmp_path, self.index_path)
+            self._dirty_reads = 0
+        except IOError as e:
+            logger.error(f"保存图像缓存索引失败: {e}")
+
+    def _remove(self, key):
+        """删除条目（调用方需持有锁）"""
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        self.total_bytes -= entry.get('size', 0)
+        try:
+            os.remove(self._file_path(key))
+        except OSError:
+            pass
+
+    def get_path(self, key):
+        """命中返回缓存文件路径，未命中返回None"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.time() - entry['created_at'] > self.ttl:
+                self._remove(key)
+                self._save_index()
+                entry = None
+
+            path = self._file_path(key)
+            if entry is not None and not os.path.exists(path):
+                self._remove(key)
+                self._save_index()
+                entry = None
+
+            if entry is None:
+                metrics.incr('image_cache.misses')
+                return None
+
+            entry['last_access'] = time.time()
+            self.entries.move_to_end(key)
+            # 访问时间只影响淘汰顺序，批量落盘即可
+            self._dirty_reads += 1
+            if self._dirty_reads >= 20:
+                self._save_index()
+
+        metrics.incr('image_cache.hits')
+        return path
+
+    def put_file(self, key, src_path):
+        """把已生成的图像文件写入缓存并按容量淘汰"""
+        try:
+            size = os.path.getsize(src_path)
+        except OSError as e:
+            logger.error(f"读取待缓存图像失败: {e}")
+            return
+        if size > self.max_bytes:
+            return
+
+        path = self._file_path(key)
+        tmp_path = path + '.tmp'
+        with self.lock:
+            try:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                try:
+                    os.link(src_path, tmp_path)
+                except OSError:
+                    shutil.copyfile(src_path, tmp_path)
+                os.replace(tmp_path, path)
+            except (IOError, OSError) as e:
+                logger.error(f"写入图像缓存失败: {e}")
+                return
+
+            if key in self.entries:
+                self.total_bytes -= self.entries[key].get('size', 0)
+            now = time.time()
+            self.entries[key] = {'size': size, 'created_at': now, 'last_access': now}
+            self.entries.move_to_end(key)
+            self.total_bytes += size
+
+            while self.total_bytes > self.max_bytes and self.entries:
+                oldest_key = next(iter(self.entries))
+                self._remove(oldest_key)
+                metrics.incr('image_cache.evictions')
+
+            self._save_index()
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.total_bytes,
+                'max_bytes': self.max_bytes
+            }
+
+
+# 全局图像缓存
+image_cache = ImageCache()
+
+__all__ = ['image_cache', 'ImageCache']
@@ -0,0 +1,87 @@
+# 生成图像文件存储
+# 图像以二进制文件保存在本地目录，通过 /download/<filename> 提供访问
+
+import os
+import re
+import shutil
+import logging
+
+from config import IMAGE_STORE_DIR
+
+logger = logging.getLogger(__name__)
+
+# 只允许生成时使用的安全文件名，防止路径穿越
+FILENAME_PATTERN = re.compile(r'^[A-Za-z0-9_\-]+(\.[A-Za-z0-9_\-]+)*\.(png|jpg|jpeg|webp)$')
+
+
+class InvalidFilenameError(ValueError):
+    """文件名不合法"""
+    pass
+
+
+class ImageTooLargeError(Exception):
+    """图像超过大小上限"""
+    pass
+
+
+class ImageStore:
+    def __init__(self, root=IMAGE_STORE_DIR):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path_for(self, filename):
+        """返回文件的存储路径，文件名不合法时抛出InvalidFilenameError"""
+        if not filename or not FILENAME_PATTERN.match(filename):
+            raise InvalidFilenameError(f"非法文件名: {filename}")
+        return os.path.join(self.root, filename)
+
+    def exists(self, filename):
+        try:
+            return os.path.isfile(self.path_for(filename))
+        except InvalidFilenameError:
+            return False
+
+    def write_stream(self, filename, chunks, max_bytes=None):
+        """逐块写入图像数据，内存中只保留当前数据块
+
+        超过max_bytes时删除临时文件并抛出ImageTooLargeError，返回 (存储路径, 写入字节数)
+        """
+        path = self.path_for(filename)
+        tmp_path = path + '.tmp'
+        written = 0
+        try:
+            with open(tmp_path, 'wb') as f:
+                for chunk in chunks:
+                    if not chunk:
+                        continue
+                    written += len(chunk)
+                    if max_bytes and written > max_bytes:
+                        raise ImageTooLargeError(f"图像超过大小上限 {max_bytes} 字节")
+                    f.write(chunk)
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+        return path, written
+
+    def import_file(self, filename, src_path):
+        """把已有文件（如缓存文件）放入存储，同一文件系统下使用硬链接避免复制"""
+        path = self.path_for(filename)
+        tmp_path = path + '.tmp'
+        try:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            os.link(src_path, tmp_path)
+        except OSError:
+            shutil.copyfile(src_path, tmp_path)
+        os.replace(tmp_path, path)
+        return path
+
+
+# 全局图像存储
+image_store = ImageStore()
+
+__all__ = ['image_store', 'ImageStore', 'InvalidFilenameError', 'ImageTooLargeError']
@@ -0,0 +1,110 @@
+# 图像预览变体
+# 按需生成缩小尺寸/WebP等格式的图像，生成一次后保存在原图旁边重复使用
+
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from config import IMAGE_VARIANT_WORKERS, IMAGE_VARIANT_WIDTHS
+from image_store import image_store
+from singleflight import SingleFlight
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# 格式 -> (Pillow格式, 扩展名, MIME类型, 保存参数)
+VARIANT_FORMATS = {
+    'webp': ('WEBP', 'webp', 'image/webp', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', 'jpg', 'image/jpeg', {'quality': 82, 'optimize': True, 'progressive': True}),
+    'png': ('PNG', 'png', 'image/png', {'optimize': True}),
+}
+
+_LANCZOS = getattr(Image, 'Resampling', Image).LANCZOS
+
+
+class InvalidVariantError(ValueError):
+    """不支持的尺寸或格式"""
+    pass
+
+
+class ImageVariants:
+    """变体生成器
+
+    宽度会向上取到允许的档位，避免任意宽度把磁盘写满；
+    Pillow的编码工作放在独立线程池中，同一变体的并发请求只生成一次。
+    """
+
+    def __init__(self, store=image_store, widths=IMAGE_VARIANT_WIDTHS, workers=IMAGE_VARIANT_WORKERS):
+        self.store = store
+        self.widths = sorted(widths)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='image-variant')
+        self.flight = SingleFlight('image_variant')
+
+    def normalize_width(self, width):
+        """把请求宽度取到最近的不小于它的档位"""
+        if width is None:
+            return None
+        if width <= 0:
+            raise InvalidVariantError(f"非法宽度: {width}")
+        for allowed in self.widths:
+            if allowed >= width:
+                return allowed
+        return self.widths[-1]
+
+    def variant_filename(self, filename, width, fmt):
+        stem = os.path.splitext(filename)[0]
+        extension = VARIANT_FORMATS[fmt][1]
+        size_part = f'.w{width}' if width else ''
+        return f'{stem}{size_part}.{extension}'
+
+    def get_variant(self, filename, width=None, fmt='webp', timeout=30):
+        """返回 (变体文件路径, MIME类型)，原图不存在时抛出FileNotFoundError"""
+        if fmt not in VARIANT_FORMATS:
+            raise InvalidVariantError(f"不支持的格式: {fmt}")
+        width = self.normalize_width(width)
+
+        source_path = self.store.path_for(filename)
+        variant_path = self.store.path_for(self.variant_filename(filename, width, fmt))
+        mime_type = VARIANT_FORMATS[fmt][2]
+
+        if os.path.isfile(variant_path):
+            metrics.incr('image_variant.hits')
+            return variant_path, mime_type
+        if not os.path.isfile(source_path):
+            raise FileNotFoundError(filename)
+
+        def render():
+            future = self.executor.submit(self._render, source_path, variant_path, width, fmt)
+            return future.result(timeout)
+
+        self.flight.do(variant_path, render, timeout=timeout)
+        return variant_path, mime_type
+
+    def _render(self, source_path, variant_path, width, fmt):
+        if os.path.isfile(variant_path):
+            return variant_path
+
+        pil_format, _, _, save_options = VARIANT_FORMATS[fmt]
+        with Image.open(source_path) as image:
+            # 只缩小不放大
+            if width and image.width > width:
+                height = max(1, round(image.height * width / image.width))
+                image = image.resize((width, height), _LANCZOS)
+            if pil_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+                image = image.convert('RGB')
+
+            tmp_path = variant_path + '.tmp'
+            image.save(tmp_path, format=pil_format, **save_options)
+        os.replace(tmp_path, variant_path)
+
+        metrics.incr('image_variant.generated')
+        logger.info(f"已生成图像变体: {os.path.basename(variant_path)}")
+        return variant_path
+
+
+# 全局变体生成器
+image_variants = ImageVariants()
+
+__all__ = ['image_variants', 'ImageVariants', 'InvalidVariantError', 'VARIANT_FORMATS']
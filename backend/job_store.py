@@ -0,0 +1,82 @@
+# 生成任务持久化
+# 任务及其上游task_id写入数据库（PostgreSQL的app_data表或本地文件），重启后继续轮询未完成的任务
+
+import time
+import logging
+from datetime import datetime
+
+from config import JOB_RESULT_TTL
+from database import db
+
+logger = logging.getLogger(__name__)
+
+COLLECTION = 'generation_jobs'
+
+UNFINISHED_STATUSES = ('pending', 'running')
+
+
+class JobStore:
+    """任务表读写，数据库异常只记录日志，不影响任务本身执行"""
+
+    def __init__(self, database=db, collection=COLLECTION):
+        self.db = database
+        self.collection = collection
+
+    def save(self, job):
+        """登记新任务"""
+        try:
+            self.db.insert(self.collection, {
+                'job_id': job['job_id'],
+                'kind': job['kind'],
+                'status': job['status'],
+                'params': job['params'],
+                'task_id': None,
+                'result': None,
+                'error': None,
+                'submitted_at': job['created_at']
+            })
+        except Exception as e:
+            logger.error(f"保存任务失败 {job['job_id']}: {e}")
+
+    def update(self, job_id, **fields):
+        try:
+            self.db.update_one(self.collection, {'job_id': job_id}, {'$set': fields})
+        except Exception as e:
+            logger.error(f"更新任务失败 {job_id}: {e}")
+
+    def get(self, job_id):
+        """按ID读取任务记录，不存在返回None"""
+        try:
+            return self.db.find_one(self.collection, {'job_id': job_id})
+        except Exception as e:
+            logger.error(f"读取任务失败 {job_id}: {e}")
+            return None
+
+    def load_unfinished(self):
+        """读取未完成的任务，同时清理过期的已完成任务"""
+        try:
+            documents = self.db.find(self.collection)
+        except Exception as e:
+            logger.error(f"读取未完成任务失败: {e}")
+            return []
+
+        unfinished = []
+        now = time.time()
+        for document in documents:
+            if document.get('status') in UNFINISHED_STATUSES:
+                unfinished.append(document)
+                continue
+            finished_at = document.get('finished_at')
+            try:
+                expired = finished_at and now - datetime.fromisoformat(finished_at).timestamp() > JOB_RESULT_TTL
+            except (TypeError, ValueError):
+                expired = True
+            if expired:
+                self.db.delete_many(self.collection, {'job_id': document.get('job_id')})
+        return unfinished
+
+
+# 全局任务存储
+job_store = JobStore()
+
+__all__ = ['job_store', 'JobStore']
@@ -0,0 +1,379 @@
+# 后台任务管理
+# 图像生成等耗时任务放到有界线程池中执行，HTTP请求只负责提交任务并返回任务ID
+
+import threading
+import time
+import uuid
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from config import IMAGE_JOB_WORKERS, IMAGE_JOB_MAX_PENDING, JOB_RESULT_TTL
+from metrics import metrics
+from job_store import job_store
+from fair_scheduler import image_scheduler, PRIORITY_STANDARD
+
+logger = logging.getLogger(__name__)
+
+# 任务状态
+JOB_PENDING = 'pending'
+JOB_RUNNING = 'running'
+JOB_SUCCEEDED = 'succeeded'
+JOB_FAILED = 'failed'
+
+ACTIVE_STATUSES = (JOB_PENDING, JOB_RUNNING)
+
+
+class JobQueueFullError(Exception):
+    """排队任务过多，拒绝接收新任务"""
+    pass
+
+
+class JobManager:
+    """内存任务表 + 有界线程池
+
+    任务函数签名为 func(job_id, params)，返回值作为任务结果，抛出异常则任务失败。
+    提交时带 dedupe_key 的任务会与同键的在途任务合并，直接返回已有任务ID。
+    persist=True 的任务会写入 store，进程重启后可以恢复。
+    带 user_key 的任务先在 scheduler 中按用户公平排队，拿到名额后才占用工作线程。
+    """
+
+    def __init__(self, max_workers=IMAGE_JOB_WORKERS, max_pending=IMAGE_JOB_MAX_PENDING, result_ttl=JOB_RESULT_TTL,
+                 store=None, scheduler=None):
+        self.store = store
+        self.scheduler = scheduler
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job-worker')
+        self.max_pending = max_pending
+        self.result_ttl = result_ttl
+        self.jobs = {}
+        self.inflight_keys = {}  # dedupe_key -> job_id
+        self.callbacks = {}  # job_id -> [callback(job)]
+        # 任务每次变化都会notify_all，供SSE等长连接等待进度
+        self.lock = threading.Condition()
+
+    def submit(self, kind, func, params, dedupe_key=None, persist=False, job_id=None,
+               user_key=None, priority=PRIORITY_STANDARD):
+        """提交任务，返回 (任务ID, 是否合并到了已有任务)
+
+        job_id 只在恢复重启前的任务时指定，此时任务已在 store 中，不再重复写入。
+        """
+        with self.lock:
+            self._cleanup_expired()
+
+            if dedupe_key is not None:
+                existing_id = self.inflight_keys.get(dedupe_key)
+                existing = self.jobs.get(existing_id)
+                if existing is not None and existing['status'] in ACTIVE_STATUSES:
+                    metrics.incr(f'jobs.{kind}.coalesced')
+                    return existing_id, True
+
+            active_count = sum(1 for job in self.jobs.values() if job['status'] in ACTIVE_STATUSES)
+            if active_count >= self.max_pending:
+                raise JobQueueFullError(f"当前排队任务过多({active_count})，请稍后再试")
+
+            resumed = job_id is not None
+            job_id = job_id or uuid.uuid4().hex
+            self.jobs[job_id] = {
+                'job_id': job_id,
+                'kind': kind,
+                'status': JOB_PENDING,
+                'progress': None,
+                'result': None,
+                'error': None,
+                'created_at': datetime.now().isoformat(),
+                'started_at': None,
+                'finished_at': None,
+                '_finished_ts': None,
+                '_dedupe_key': dedupe_key,
+                '_persist': persist and self.store is not None,
+                '_version': 0
+            }
+            if dedupe_key is not None:
+                self.inflight_keys[dedupe_key] = job_id
+            job = self.jobs[job_id]
+
+        if job['_persist'] and not resumed:
+            self.store.save({**self._snapshot(job), 'params': params})
+
+        if self.scheduler is not None and user_key is not None:
+            self.scheduler.enqueue(
+                user_key, priority,
+                lambda ticket: self.executor.submit(self._run, job_id, func, params, ticket)
+            )
+        else:
+            self.executor.submit(self._run, job_id, func, params)
+        logger.info(f"任务已提交: {kind} {job_id}")
+        return job_id, False
+
+    def create(self, kind, progress=None, persist=False):
+        """登记一个由调用方自行推进的任务（如批量任务），返回任务ID
+
+        persist=True 时写入 store，重启后仍能查询到最后的状态，但不会自动恢复执行。
+        """
+        with self.lock:
+            self._cleanup_expired()
+            job_id = uuid.uuid4().hex
+            now = datetime.now().isoformat()
+            self.jobs[job_id] = {
+                'job_id': job_id,
+                'kind': kind,
+                'status': JOB_RUNNING,
+                'progress': progress,
+                'result': None,
+                'error': None,
+                'created_at': now,
+                'started_at': now,
+                'finished_at': None,
+                '_finished_ts': None,
+                '_dedupe_key': None,
+                '_persist': persist and self.store is not None,
+                '_version': 0
+            }
+            job = self.jobs[job_id]
+        if job['_persist']:
+            self.store.save({**self._snapshot(job), 'params': None})
+        return job_id
+
+    def _run(self, job_id, func, params, ticket=None):
+        """在工作线程中执行任务，结束后归还调度名额"""
+        self.update(job_id, status=JOB_RUNNING, started_at=datetime.now().isoformat())
+        try:
+            result = func(job_id, params)
+        except Exception as e:
+            logger.error(f"任务执行失败 {job_id}: {e}")
+            self._finish(job_id, JOB_FAILED, error=str(e))
+        else:
+            self._finish(job_id, JOB_SUCCEEDED, result=result)
+        finally:
+            if ticket is not None:
+                self.scheduler.release(ticket)
+
+    def _finish(self, job_id, status, result=None, error=None):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return
+            job.update(
+                status=status,
+                result=result,
+                error=error,
+                finished_at=datetime.now().isoformat(),
+                _finished_ts=time.time()
+            )
+            job['_version'] += 1
+            # 任务结束后释放合并键，之后的相同请求会重新提交
+            dedupe_key = job['_dedupe_key']
+            if dedupe_key is not None and self.inflight_keys.get(dedupe_key) == job_id:
+                del self.inflight_keys[dedupe_key]
+            callbacks = self.callbacks.pop(job_id, [])
+            snapshot = self._snapshot(job)
+            persist = job['_persist']
+            self.lock.notify_all()
+
+        if persist:
+            self.store.update(job_id, status=status, result=result, error=error, finished_at=snapshot['finished_at'])
+
+        for callback in callbacks:
+            try:
+                callback(snapshot)
+            except Exception as e:
+                logger.error(f"任务回调执行失败 {job_id}: {e}")
+
+    def complete(self, job_id, result=None, error=None):
+        """结束由调用方推进的任务，error不为空时标记为失败"""
+        if error is not None:
+            self._finish(job_id, JOB_FAILED, result=result, error=error)
+        else:
+            self._finish(job_id, JOB_SUCCEEDED, result=result)
+
+    def add_done_callback(self, job_id, callback):
+        """任务结束后回调 callback(任务快照)；已结束则立即回调，任务不存在返回False"""
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return False
+            if job['status'] in ACTIVE_STATUSES:
+                self.callbacks.setdefault(job_id, []).append(callback)
+                return True
+            snapshot = self._snapshot(job)
+        callback(snapshot)
+        return True
+
+    def update(self, job_id, **fields):
+        """更新任务字段（状态、进度等）"""
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return False
+            job.update(fields)
+            job['_version'] += 1
+            self.lock.notify_all()
+            return True
+
+    def persist_fields(self, job_id, **fields):
+        """把任务执行中产生的关键信息（如上游task_id）写入 store"""
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None or not job['_persist']:
+                return
+        self.store.update(job_id, **fields)
+
+    def wait_for_change(self, job_id, version, timeout):
+        """等待任务版本号超过version，返回 (任务快照, 当前版本号)；任务不存在返回 (None, version)"""
+        deadline = time.time() + timeout
+        with self.lock:
+            while True:
+                job = self.jobs.get(job_id)
+                if job is None:
+                    return None, version
+                if job['_version'] > version:
+                    return self._snapshot(job), job['_version']
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return self._snapshot(job), job['_version']
+                self.lock.wait(remaining)
+
+    @staticmethod
+    def _snapshot(job):
+        return {key: value for key, value in job.items() if not key.startswith('_')}
+
+    def get(self, job_id):
+        """获取任务快照，不存在返回None"""
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            return self._snapshot(job)
+
+    def _cleanup_expired(self):
+        """清理过期的已完成任务（调用方需持有锁）"""
+        now = time.time()
+        expired = [
+            job_id for job_id, job in self.jobs.items()
+            if job['_finished_ts'] and now - job['_finished_ts'] > self.result_ttl
+        ]
+        for job_id in expired:
+            del self.jobs[job_id]
+            self.callbacks.pop(job_id, None)
+
+    def get_stats(self):
+        """任务统计"""
+        with self.lock:
+            stats = {}
+            for job in self.jobs.values():
+                stats[job['status']] = stats.get(job['status'], 0) + 1
+            return stats
+
+
+class BatchRunner:
+    """批量任务：在并发上限内逐个提交子任务，子任务完成后立即更新批量任务的结果
+
+    items 中每一项是 {'task': (kind, func, params, dedupe_key)}，
+    或已经有结果的 {'status': ..., 'result': ...}（如缓存命中）。
+    persist=True 时批量任务和子任务都写入 store。批量任务本身不能在重启后恢复：
+    已提交的子任务各自恢复，尚未提交的子任务丢弃，批量任务标记为中断。
+    """
+
+    def __init__(self, manager, kind, items, concurrency, persist=False, user_key=None, priority=PRIORITY_STANDARD):
+        self.manager = manager
+        self.concurrency = max(1, concurrency)
+        self.persist = persist
+        self.user_key = user_key
+        self.priority = priority
+        self.lock = threading.Lock()
+        self.running = 0
+        self.finished = False
+        self.items = []
+        self.queue = []
+        for index, item in enumerate(items):
+            task = item.get('task')
+            self.items.append({
+                'index': index,
+                'status': item.get('status', JOB_PENDING),
+                'job_id': None,
+                'result': item.get('result'),
+                'error': item.get('error')
+            })
+            if task is not None:
+                self.queue.append((index, task))
+        self.batch_id = manager.create(kind, progress=self._progress(), persist=persist)
+
+    def _progress(self):
+        """批量进度（调用方需持有锁）"""
+        finished = [item for item in self.items if item['status'] not in ACTIVE_STATUSES]
+        return {
+            'total': len(self.items),
+            'completed': len(finished),
+            'failed': sum(1 for item in finished if item['status'] == JOB_FAILED),
+            'running': self.running
+        }
+
+    def start(self):
+        """开始提交子任务，返回批量任务ID"""
+        self._publish()
+        self._launch_next()
+        return self.batch_id
+
+    def _launch_next(self):
+        while True:
+            with self.lock:
+                if self.running >= self.concurrency or not self.queue:
+                    break
+                index, (kind, func, params, dedupe_key) = self.queue.pop(0)
+                self.running += 1
+
+            try:
+                child_id, _ = self.manager.submit(
+                    kind, func, params, dedupe_key=dedupe_key, persist=self.persist,
+                    user_key=self.user_key, priority=self.priority
+                )
+            except JobQueueFullError as e:
+                self._on_child_done(index, {'status': JOB_FAILED, 'result': None, 'error': str(e)})
+                continue
+
+            with self.lock:
+                self.items[index]['job_id'] = child_id
+                self.items[index]['status'] = JOB_RUNNING
+            self._publish()
+            self.manager.add_done_callback(child_id, lambda job, index=index: self._on_child_done(index, job))
+
+    def _on_child_done(self, index, job):
+        with self.lock:
+            item = self.items[index]
+            item['status'] = job['status']
+            item['result'] = job['result']
+            item['error'] = job['error']
+            self.running -= 1
+        self._publish()
+        self._launch_next()
+
+    def _publish(self):
+        """把最新进度写回批量任务，全部完成时结束批量任务
+
+        在持有锁时写回，保证并发完成的子任务按顺序发布进度。
+        """
+        with self.lock:
+            if self.finished:
+                return
+            progress = self._progress()
+            result = {'items': [dict(item) for item in self.items]}
+
+            if progress['completed'] < progress['total']:
+                self.manager.update(self.batch_id, progress=progress, result=result)
+                # 记下子任务ID，重启后仍可以按子任务查询
+                self.manager.persist_fields(self.batch_id, result=result)
+                return
+
+            self.finished = True
+            self.manager.update(self.batch_id, progress=progress)
+            if progress['failed'] == progress['total']:
+                self.manager.complete(self.batch_id, result=result, error='批量任务全部失败')
+            else:
+                self.manager.complete(self.batch_id, result=result)
+
+
+# 全局任务管理器
+job_manager = JobManager(store=job_store, scheduler=image_scheduler)
+
+__all__ = ['job_manager', 'JobManager', 'BatchRunner', 'JobQueueFullError',
+           'JOB_PENDING', 'JOB_RUNNING', 'JOB_SUCCEEDED', 'JOB_FAILED']
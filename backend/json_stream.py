@@ -0,0 +1,150 @@
+# 增量JSON解析
+# 模型流式输出JSON时，每个顶层字段（或指定数组中的每个元素）一结束就解析出来，不必等整段输出完
+
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class JsonStreamScanner:
+    """逐段喂入文本的JSON扫描器
+
+    只跟踪括号深度和字符串/转义状态，字符串中的括号、逗号不会干扰判断。
+    根对象之前的内容（如 ```json 标记）会被跳过。
+
+    feed() 返回本次新完成的事件列表：
+      {'kind': 'field', 'key': 顶层字段名, 'value': 字段值}
+      {'kind': 'item', 'key': 顶层字段名, 'index': 下标, 'value': 元素值}
+    item_keys 中的数组字段会额外按元素产生 item 事件（元素需为对象或数组）。
+    """
+
+    def __init__(self, item_keys=()):
+        self.item_keys = set(item_keys)
+        self.buffer = ''
+        self.pos = 0
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.root_start = None
+        self.root_end = None
+
+        # 根对象（深度1）上的解析状态
+        self.expect_key = True
+        self.key_start = None
+        self.current_key = None
+        self.value_start = None
+        self.value_is_string = False
+        self.item_start = None
+        self.item_index = 0
+
+    @property
+    def done(self):
+        return self.root_end is not None
+
+    def feed(self, text):
+        """追加一段文本，返回新完成的事件"""
+        self.buffer += text
+        events = []
+        buffer = self.buffer
+        while self.pos < len(buffer) and not self.done:
+            char = buffer[self.pos]
+            if self.root_start is None:
+                if char == '{':
+                    self.root_start = self.pos
+                    self.depth = 1
+            elif self.in_string:
+                self._scan_string_char(char, events)
+            else:
+                self._scan_char(char, events)
+            self.pos += 1
+        return events
+
+    def _scan_string_char(self, char, events):
+        if self.escape:
+            self.escape = False
+        elif char == '\\':
+            self.escape = True
+        elif char == '"':
+            self.in_string = False
+            if self.depth == 1:
+                if self.expect_key:
+                    self.current_key = self._loads(self.buffer[self.key_start:self.pos + 1])
+                elif self.value_is_string:
+                    self._emit_field(self.pos + 1, events)
+
+    def _scan_char(self, char, events):
+        index = self.pos
+        if char == '"':
+            self.in_string = True
+            if self.depth == 1:
+                if self.expect_key:
+                    self.key_start = index
+                elif self.value_start is None:
+                    self.value_start = index
+                    self.value_is_string = True
+            return
+
+        if char in '{[':
+            if self.depth == 1 and self.value_start is None and not self.expect_key:
+                self.value_start = index
+            elif self.depth == 2 and self.current_key in self.item_keys:
+                self.item_start = index
+            self.depth += 1
+            return
+
+        if char in '}]':
+            self.depth -= 1
+            if self.depth == 0:
+                # 根对象结束，最后一个字段如果是数字等标量在这里完成
+                if self.value_start is not None:
+                    self._emit_field(index, events)
+                self.root_end = index + 1
+            elif self.depth == 1 and self.value_start is not None:
+                self._emit_field(index + 1, events)
+            elif self.depth == 2 and self.item_start is not None:
+                value = self._loads(self.buffer[self.item_start:index + 1])
+                if value is not None:
+                    events.append({'kind': 'item', 'key': self.current_key, 'index': self.item_index, 'value': value})
+                self.item_index += 1
+                self.item_start = None
+            return
+
+        if self.depth != 1:
+            return
+        if char == ':':
+            self.expect_key = False
+            self.item_index = 0
+        elif char == ',':
+            if self.value_start is not None:
+                self._emit_field(index, events)
+            self.expect_key = True
+        elif self.value_start is None and not self.expect_key and not char.isspace():
+            # 数字、true/false/null 等标量，遇到逗号或根对象结束时完成
+            self.value_start = index
+
+    def _emit_field(self, end, events):
+        value_text = self.buffer[self.value_start:end]
+        # 清空起点，避免随后的逗号重复产生事件
+        self.value_start = None
+        self.value_is_string = False
+        value = self._loads(value_text)
+        if value is not None or value_text.strip() == 'null':
+            events.append({'kind': 'field', 'key': self.current_key, 'value': value})
+
+    @staticmethod
+    def _loads(text):
+        try:
+            return json.loads(text)
+        except ValueError as e:
+            logger.warning(f"流式JSON片段解析失败: {e}")
+            return None
+
+    def result(self):
+        """根对象已完整时返回解析结果，否则返回None"""
+        if not self.done:
+            return None
+        return self._loads(self.buffer[self.root_start:self.root_end])
+
+
+__all__ = ['JsonStreamScanner']
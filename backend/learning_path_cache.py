@@ -0,0 +1,136 @@
+# 学习路径结果缓存
+# 相同（规范化后）的学习需求直接返回已生成的学习路径，按LRU和TTL淘汰
+
+import copy
+import hashlib
+import json
+import re
+import threading
+import time
+import logging
+from collections import OrderedDict
+
+from config import LEARNING_PATH_CACHE_MAX_ENTRIES, LEARNING_PATH_CACHE_TTL
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# 同义词 -> 规范写法（均为规范化后的小写形式）
+LEVEL_SYNONYMS = {
+    'beginner': 'beginner', '初学者': 'beginner', '入门': 'beginner', '新手': 'beginner',
+    '零基础': 'beginner', 'novice': 'beginner', 'newbie': 'beginner',
+    'intermediate': 'intermediate', '中级': 'intermediate', '进阶': 'intermediate', '有一定基础': 'intermediate',
+    'advanced': 'advanced', '高级': 'advanced', '精通': 'advanced', 'expert': 'advanced',
+}
+
+SUBJECT_SYNONYMS = {
+    'python编程': 'python', 'python 编程': 'python', 'python3': 'python', 'py': 'python',
+    'js': 'javascript', 'javascript编程': 'javascript',
+    'ts': 'typescript',
+    'ml': 'machine learning', '机器学习': 'machine learning',
+    'dl': 'deep learning', '深度学习': 'deep learning',
+    'ai': 'artificial intelligence', '人工智能': 'artificial intelligence',
+    '数据分析': 'data analysis',
+    '英语口语': 'spoken english', 'english speaking': 'spoken english',
+}
+
+TIME_SYNONYMS = {
+    'weekend': 'weekend', '仅周末学习': 'weekend', '周末': 'weekend', 'weekends': 'weekend',
+    'flexible': 'flexible', '时间灵活安排': 'flexible', '灵活': 'flexible',
+}
+
+_HOURS_PATTERN = re.compile(r'(\d+(?:\.\d+)?)\s*(?:hours?|hrs?|h(?![a-z])|个?小时)')
+_MINUTES_PATTERN = re.compile(r'(\d+)\s*(?:minutes?|mins?|m(?![a-z])|分钟)')
+_WEEK_PATTERN = re.compile(r'week|周|星期')
+
+
+def _fold(text):
+    """忽略大小写、合并空白、去掉首尾标点"""
+    text = ' '.join(str(text or '').split()).casefold()
+    return text.strip(' .,;:!?，。；：！？、')
+
+
+def normalize_time(time_available):
+    """把 "1hour"、"1 hour/day"、"每天1小时"、"60分钟" 等写法统一成 "60m/day" 的形式"""
+    text = _fold(time_available)
+    if text in TIME_SYNONYMS:
+        return TIME_SYNONYMS[text]
+
+    minutes = None
+    match = _HOURS_PATTERN.search(text)
+    if match:
+        minutes = round(float(match.group(1)) * 60)
+    else:
+        match = _MINUTES_PATTERN.search(text)
+        if match:
+            minutes = int(match.group(1))
+    if minutes is None:
+        return text
+    period = 'week' if _WEEK_PATTERN.search(text) else 'day'
+    return f'{minutes}m/{period}'
+
+
+def normalize_request(subject, level, time_available, goal, preferences=''):
+    """学习路径请求的规范形式，用于缓存键和请求合并键"""
+    subject = _fold(subject)
+    level = _fold(level)
+    return {
+        'subject': SUBJECT_SYNONYMS.get(subject, subject),
+        'level': LEVEL_SYNONYMS.get(level, level),
+        'time_available': normalize_time(time_available),
+        'goal': _fold(goal),
+        'preferences': _fold(preferences),
+    }
+
+
+class LearningPathCache:
+    """内存中的学习路径缓存
+
+    条目数超过上限时淘汰最久未访问的条目，超过TTL的条目在读取时丢弃。
+    读写都返回副本，调用方修改结果不会影响缓存。
+    """
+
+    def __init__(self, max_entries=LEARNING_PATH_CACHE_MAX_ENTRIES, ttl=LEARNING_PATH_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> (created_at, learning_path)
+
+    @staticmethod
+    def make_key(subject, level, time_available, goal, preferences='', template='learning_path'):
+        """根据规范化后的请求计算缓存键；template 为生成时使用的提示词模板，输出格式不同的接口互不共用缓存"""
+        normalized = dict(normalize_request(subject, level, time_available, goal, preferences), template=template)
+        raw = json.dumps(normalized, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """返回缓存的学习路径，未命中或已过期返回None"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.time() - entry[0] > self.ttl:
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                metrics.incr('learning_path_cache.misses')
+                return None
+            self.entries.move_to_end(key)
+        metrics.incr('learning_path_cache.hits')
+        return copy.deepcopy(entry[1])
+
+    def put(self, key, learning_path):
+        with self.lock:
+            self.entries[key] = (time.time(), copy.deepcopy(learning_path))
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                metrics.incr('learning_path_cache.evictions')
+
+    def get_stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'max_entries': self.max_entries}
+
+
+# 全局学习路径缓存
+learning_path_cache = LearningPathCache()
+
+__all__ = ['learning_path_cache', 'LearningPathCache', 'normalize_request']
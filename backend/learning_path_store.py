@@ -0,0 +1,147 @@
+# 学习路径存储
+# 生成的学习路径按ID保存在数据库中，调整时客户端只需提交ID和进度，不再回传整条路径
+
+import copy
+import threading
+import time
+import uuid
+import logging
+from collections import OrderedDict
+from datetime import datetime
+
+from config import LEARNING_PATH_STORE_TTL, LEARNING_PATH_STORE_CLEANUP_INTERVAL
+from database import db
+
+logger = logging.getLogger(__name__)
+
+COLLECTION = 'learning_paths'
+
+
+class LearningPathStore:
+    """学习路径读写，数据库异常只记录日志，不影响生成结果返回
+
+    save 只把文档放入内存队列，由后台线程写入数据库，请求（包括缓存命中）不等待整表重写；
+    写入前的读取和更新直接使用内存中的文档。最后一次写入超过 ttl 的路径由后台线程定期删除。
+    """
+
+    def __init__(self, database=db, collection=COLLECTION, ttl=LEARNING_PATH_STORE_TTL,
+                 cleanup_interval=LEARNING_PATH_STORE_CLEANUP_INTERVAL):
+        self.db = database
+        self.collection = collection
+        self.ttl = ttl
+        self.cleanup_interval = cleanup_interval
+        self.condition = threading.Condition()
+        self.pending = OrderedDict()  # path_id -> 尚未写入数据库的文档
+        # 写入数据库并移出 pending 的过程持有该锁，后台线程和 update 不会重复插入同一文档
+        self.write_lock = threading.Lock()
+        self.last_cleanup = 0
+        self.thread = None
+
+    def save(self, learning_path, request_info=None):
+        """登记学习路径并返回路径ID，实际写入在后台进行"""
+        path_id = uuid.uuid4().hex
+        with self.condition:
+            self.pending[path_id] = {
+                'path_id': path_id,
+                'learning_path': copy.deepcopy(learning_path),
+                'request': request_info or {},
+                'version': 1,
+                'saved_at': time.time()
+            }
+            self._ensure_thread()
+            self.condition.notify()
+        return path_id
+
+    def get(self, path_id):
+        """按ID读取，返回 {'path_id', 'learning_path', 'version', ...}，不存在或已过期返回None"""
+        with self.condition:
+            document = self.pending.get(path_id)
+            if document is not None:
+                return copy.deepcopy(document)
+        try:
+            document = self.db.find_one(self.collection, {'path_id': path_id})
+        except Exception as e:
+            logger.error(f"读取学习路径失败 {path_id}: {e}")
+            return None
+        if document is None or self._expired(document, time.time()):
+            return None
+        return document
+
+    def update(self, path_id, learning_path, version):
+        """保存调整后的学习路径"""
+        self._flush(path_id)
+        try:
+            self.db.update_one(self.collection, {'path_id': path_id}, {'$set': {
+                'learning_path': learning_path,
+                'version': version,
+                'saved_at': time.time(),
+                'adjusted_at': datetime.now().isoformat()
+            }})
+        except Exception as e:
+            logger.error(f"更新学习路径失败 {path_id}: {e}")
+
+    def _flush(self, path_id):
+        """把尚在队列中的文档立即写入数据库"""
+        with self.write_lock:
+            with self.condition:
+                document = self.pending.get(path_id)
+            if document is None:
+                return
+            try:
+                self.db.insert(self.collection, dict(document))
+            except Exception as e:
+                logger.error(f"保存学习路径失败 {path_id}: {e}")
+            with self.condition:
+                self.pending.pop(path_id, None)
+
+    def _ensure_thread(self):
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self._loop, name='learning-path-store', daemon=True)
+            self.thread.start()
+
+    def _loop(self):
+        while True:
+            with self.condition:
+                while not self.pending and time.time() - self.last_cleanup < self.cleanup_interval:
+                    self.condition.wait(max(1, self.cleanup_interval - (time.time() - self.last_cleanup)))
+                path_ids = list(self.pending)
+            for path_id in path_ids:
+                self._flush(path_id)
+            if time.time() - self.last_cleanup >= self.cleanup_interval:
+                self.last_cleanup = time.time()
+                self.cleanup()
+
+    def _expired(self, document, now):
+        saved_at = document.get('saved_at')
+        if not isinstance(saved_at, (int, float)):
+            # 早先保存的文档没有 saved_at，按数据库记录的时间判断
+            try:
+                saved_at = datetime.fromisoformat(document.get('adjusted_at') or document.get('created_at')).timestamp()
+            except (TypeError, ValueError):
+                return True
+        return now - saved_at > self.ttl
+
+    def cleanup(self):
+        """删除超过保留时间的学习路径，返回删除数量"""
+        try:
+            documents = self.db.find(self.collection)
+        except Exception as e:
+            logger.error(f"读取学习路径失败: {e}")
+            return 0
+        now = time.time()
+        removed = 0
+        for document in documents:
+            if self._expired(document, now):
+                try:
+                    removed += self.db.delete_many(self.collection, {'path_id': document.get('path_id')}) or 0
+                except Exception as e:
+                    logger.error(f"删除过期学习路径失败 {document.get('path_id')}: {e}")
+        if removed:
+            logger.info(f"已清理 {removed} 条过期学习路径")
+        return removed
+
+
+# 全局学习路径存储
+learning_path_store = LearningPathStore()
+
+__all__ = ['learning_path_store', 'LearningPathStore']
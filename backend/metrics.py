@@ -0,0 +1,77 @@
+# 进程内性能指标
+# 计数器 + 耗时/大小分布，供 /metrics 端点和各模块内部使用
+
+import threading
+from collections import defaultdict, deque
+
+
+class Metrics:
+    def __init__(self, sample_size=500):
+        self.lock = threading.Lock()
+        self.sample_size = sample_size
+        self.counters = defaultdict(float)
+        self.gauges = {}
+        self.observations = {}
+
+    def incr(self, name, value=1):
+        """累加计数器"""
+        with self.lock:
+            self.counters[name] += value
+
+    def set_gauge(self, name, value):
+        """设置瞬时值"""
+        with self.lock:
+            self.gauges[name] = value
+
+    def observe(self, name, value):
+        """记录一次观测值（耗时、字节数等）"""
+        with self.lock:
+            entry = self.observations.get(name)
+            if entry is None:
+                entry = {'count': 0, 'total': 0.0, 'max': 0.0, 'samples': deque(maxlen=self.sample_size)}
+                self.observations[name] = entry
+            entry['count'] += 1
+            entry['total'] += value
+            entry['max'] = max(entry['max'], value)
+            entry['samples'].append(value)
+
+    def sample_count(self, name):
+        """当前保留的样本数"""
+        with self.lock:
+            entry = self.observations.get(name)
+            return len(entry['samples']) if entry else 0
+
+    def percentile(self, name, percent):
+        """最近样本的百分位数，没有样本时返回None"""
+        with self.lock:
+            entry = self.observations.get(name)
+            if not entry or not entry['samples']:
+                return None
+            samples = sorted(entry['samples'])
+        index = min(len(samples) - 1, int(len(samples) * percent / 100))
+        return samples[index]
+
+    def snapshot(self):
+        """导出全部指标"""
+        with self.lock:
+            observations = {}
+            for name, entry in self.observations.items():
+                samples = sorted(entry['samples'])
+                observations[name] = {
+                    'count': entry['count'],
+                    'avg': round(entry['total'] / entry['count'], 4) if entry['count'] else 0,
+                    'max': round(entry['max'], 4),
+                    'p50': round(samples[len(samples) // 2], 4) if samples else None,
+                    'p95': round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 4) if samples else None
+                }
+            return {
+                'counters': dict(self.counters),
+                'gauges': dict(self.gauges),
+                'observations': observations
+            }
+
+
+# 全局指标实例
+metrics = Metrics()
+
+__all__ = ['metrics', 'Metrics']
@@ -195,6 +195,33 @@ class PostgreSQLClient:
                     session.close()
                 return []
     
+    def find_one(self, collection_name, query):
+        """按条件查找单个文档，不存在返回None（PostgreSQL下使用JSONB包含查询，不读取整个集合）"""
+        if self.use_local:
+            documents = self.find(collection_name, query, limit=1)
+            return documents[0] if documents else None
+        try:
+            session = self.Session()
+            result = session.execute(text("""
+                SELECT document_data FROM app_data
+                WHERE collection_name = :collection
+                AND document_data @> :filter_data
+                LIMIT 1
+            """), {
+                'collection': collection_name,
+                'filter_data': json.dumps(query)
+            })
+            row = result.fetchone()
+            session.close()
+            if row is None:
+                return None
+            return json.loads(row[0]) if isinstance(row[0], str) else row[0]
+        except Exception as e:
+            logger.error(f"查询文档失败: {e}")
+            if 'session' in locals():
+                session.close()
+            return None
+    
     def count(self, collection_name, query=None):
         """统计文档数量"""
         if self.use_local:
@@ -0,0 +1,207 @@
+# 近似重复检测
+# 把提示词/问题编码成字符n-gram哈希向量存入NumPy矩阵，一次矩阵乘法找出最相近的已缓存文本，
+# 只改了标点或多加了个词的请求也能复用缓存结果
+
+import re
+import threading
+import unicodedata
+import zlib
+import logging
+from difflib import SequenceMatcher
+
+import numpy as np
+
+from config import (
+    SIMILARITY_CACHE_ENABLED, SIMILARITY_DIM, SIMILARITY_MAX_ENTRIES,
+    SIMILARITY_IMAGE_THRESHOLD, SIMILARITY_CHAT_THRESHOLD,
+    SIMILARITY_MAX_INSERTED_TOKENS, SIMILARITY_MAX_INSERTED_RATIO
+)
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+# 英文单词/数字作为一个词，其余（中文等）每个字符作为一个词
+_TOKEN_PATTERN = re.compile(r'[a-z0-9]+|[^\x00-\x7f]')
+
+# 插入后会让意思相反或排除某些内容的词，含有这些词的改动不算近似重复
+NEGATION_TOKENS = frozenset(
+    '不没别无非勿未莫否除禁免'
+) | frozenset((
+    'no', 'not', 'non', 'nor', 'none', 'never', 'neither', 'without', 'except', 'excluding',
+    'exclude', 'avoid', 'cannot', 'dont', 'don', 'doesn', 'didn', 'isn', 'aren', 'wasn',
+    'weren', 'won', 'shouldn', 'mustn'
+))
+
+
+def _normalize(text):
+    """统一全半角和大小写，去掉空白和标点"""
+    text = unicodedata.normalize('NFKC', str(text or '')).casefold()
+    return ''.join(ch for ch in text if not ch.isspace() and not unicodedata.category(ch).startswith('P'))
+
+
+def tokenize(text):
+    """规范化后切分成词，用于确认两段文本的差异"""
+    text = unicodedata.normalize('NFKC', str(text or '')).casefold()
+    return [
+        token for token in _TOKEN_PATTERN.findall(text)
+        if not token.isspace() and not unicodedata.category(token[0]).startswith('P')
+    ]
+
+
+def is_additive_edit(a, b, max_inserted_tokens=SIMILARITY_MAX_INSERTED_TOKENS,
+                     max_inserted_ratio=SIMILARITY_MAX_INSERTED_RATIO):
+    """两段文本（词列表）是否只差了少量插入的修饰词
+
+    替换或删除了词、插入的词超过 max_inserted_tokens 个或超过较短一方词数的
+    max_inserted_ratio，或插入了否定/排除词（不、没有、no、without等）都不算。
+    """
+    if len(a) > len(b):
+        a, b = b, a
+    inserted = []
+    for tag, i1, i2, j1, j2 in SequenceMatcher(None, a, b, autojunk=False).get_opcodes():
+        if tag == 'insert':
+            inserted.extend(b[j1:j2])
+        elif tag != 'equal':
+            return False
+    if len(inserted) > min(max_inserted_tokens, max(1, int(len(a) * max_inserted_ratio))):
+        return False
+    return not any(token in NEGATION_TOKENS for token in inserted)
+
+
+class SimilarityIndex:
+    """字符n-gram哈希向量的余弦相似度索引
+
+    每条文本取2、3字符的n-gram，按crc32哈希到 dim 维并带符号累加，再做L2归一化，
+    查询时与全部已存向量做一次点积即得到余弦相似度。余弦相似度对长文本中替换一个词
+    （如 cat -> dog）和插入否定词（如 不、no）不敏感，因此超过阈值的候选还要确认
+    两段文本只差少量插入的修饰词，且插入的不是否定/排除词。
+    条目数达到上限后覆盖最早加入的条目。
+    namespace 用来区分不能互相复用的条目（如图像比例、步数不同）。
+    """
+
+    def __init__(self, name, threshold, dim=SIMILARITY_DIM, max_entries=SIMILARITY_MAX_ENTRIES,
+                 enabled=SIMILARITY_CACHE_ENABLED, ngram_sizes=(2, 3)):
+        self.name = name
+        self.threshold = threshold
+        self.dim = dim
+        self.max_entries = max_entries
+        self.enabled = enabled
+        self.ngram_sizes = ngram_sizes
+        self.lock = threading.Lock()
+        self.vectors = np.zeros((min(64, max_entries), dim), dtype=np.float32)
+        self.namespace_ids = np.zeros(len(self.vectors), dtype=np.int32)
+        self.values = []
+        self.texts = []  # 切分后的词列表，用于确认候选
+        self.rows = {}  # value -> 行号
+        self.namespaces = {}  # namespace -> 编号
+        self.next_row = 0
+
+    def encode(self, text):
+        """规范化后的文本 -> 归一化的哈希向量，文本为空返回None"""
+        if not text:
+            return None
+        padded = f'^{text}$'
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for size in self.ngram_sizes:
+            for i in range(max(1, len(padded) - size + 1)):
+                digest = zlib.crc32(padded[i:i + size].encode('utf-8'))
+                vector[digest % self.dim] += 1.0 if digest & 0x80000000 else -1.0
+        norm = np.linalg.norm(vector)
+        if not norm:
+            return None
+        return vector / norm
+
+    def _namespace_id(self, namespace):
+        key = repr(namespace)
+        if key not in self.namespaces:
+            self.namespaces[key] = len(self.namespaces)
+        return self.namespaces[key]
+
+    def add(self, text, value, namespace=None):
+        """记录文本及其对应的缓存键；同一个value再次加入时覆盖原来的向量"""
+        if not self.enabled:
+            return
+        tokens = tokenize(text)
+        vector = self.encode(_normalize(text))
+        if vector is None:
+            return
+        with self.lock:
+            row = self.rows.get(value)
+            if row is None:
+                row = self._allocate_row()
+                self.rows[value] = row
+            self.vectors[row] = vector
+            self.namespace_ids[row] = self._namespace_id(namespace)
+            if row < len(self.values):
+                self.values[row] = value
+                self.texts[row] = tokens
+            else:
+                self.values.append(value)
+                self.texts.append(tokens)
+
+    def _allocate_row(self):
+        """分配一行：容量不足时翻倍扩容，达到上限后覆盖最早的条目（调用方需持有锁）"""
+        if len(self.values) < self.max_entries:
+            if len(self.values) >= len(self.vectors):
+                capacity = min(self.max_entries, len(self.vectors) * 2)
+                vectors = np.zeros((capacity, self.dim), dtype=np.float32)
+                vectors[:len(self.vectors)] = self.vectors
+                namespace_ids = np.zeros(capacity, dtype=np.int32)
+                namespace_ids[:len(self.namespace_ids)] = self.namespace_ids
+                self.vectors, self.namespace_ids = vectors, namespace_ids
+            return len(self.values)
+
+        row = self.next_row
+        self.next_row = (self.next_row + 1) % self.max_entries
+        self.rows.pop(self.values[row], None)
+        return row
+
+    def nearest(self, text, namespace=None, threshold=None, candidates=5):
+        """返回相似度不低于阈值、且只差少量插入修饰词的最相近条目的value，没有返回None"""
+        if not self.enabled:
+            return None
+        tokens = tokenize(text)
+        vector = self.encode(_normalize(text))
+        if vector is None:
+            return None
+        threshold = self.threshold if threshold is None else threshold
+        with self.lock:
+            count = len(self.values)
+            if not count or repr(namespace) not in self.namespaces:
+                metrics.incr(f'similarity.{self.name}.misses')
+                return None
+            scores = self.vectors[:count] @ vector
+            scores[self.namespace_ids[:count] != self.namespaces[repr(namespace)]] = -1.0
+            top = np.argsort(-scores)[:candidates]
+            matches = [
+                (float(scores[row]), self.texts[row], self.values[row])
+                for row in top if scores[row] >= threshold
+            ]
+            best_score = float(scores[top[0]])
+
+        metrics.observe(f'similarity.{self.name}.best_score', max(best_score, 0.0))
+        for score, candidate, value in matches:
+            if is_additive_edit(tokens, candidate):
+                metrics.incr(f'similarity.{self.name}.hits')
+                return value
+            metrics.incr(f'similarity.{self.name}.rejected')
+        metrics.incr(f'similarity.{self.name}.misses')
+        return None
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'enabled': self.enabled,
+                'entries': len(self.values),
+                'max_entries': self.max_entries,
+                'threshold': self.threshold,
+                'memory_bytes': int(self.vectors.nbytes)
+            }
+
+
+# 图像提示词（按比例、种子、步数、CFG区分）和聊天问题各一个索引
+image_prompt_index = SimilarityIndex('image_prompt', SIMILARITY_IMAGE_THRESHOLD)
+chat_question_index = SimilarityIndex('chat_question', SIMILARITY_CHAT_THRESHOLD)
+
+__all__ = ['image_prompt_index', 'chat_question_index', 'SimilarityIndex', 'is_additive_edit', 'tokenize']
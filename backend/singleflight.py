@@ -0,0 +1,163 @@
+# 请求合并（single-flight）
+# 相同的上游请求同时到达时只真正调用一次，其余请求等待并共享同一个结果
+
+import hashlib
+import json
+import threading
+import logging
+
+from metrics import metrics
+from deadline import remaining_timeout
+
+logger = logging.getLogger(__name__)
+
+
+class SingleFlightTimeout(Exception):
+    """等待合并请求结果超时（只影响当前等待方，上游调用继续进行）"""
+    pass
+
+
+class SingleFlightCancelled(Exception):
+    """发起上游调用的请求被中断，等待方拿不到结果"""
+    pass
+
+
+def normalize_request_key(*parts):
+    """把请求字段规范化后生成合并键：去掉首尾空白、合并连续空白、忽略大小写"""
+    normalized = []
+    for part in parts:
+        if isinstance(part, str):
+            part = ' '.join(part.split()).casefold()
+        normalized.append(part)
+    raw = json.dumps(normalized, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+class _Call:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+        self.participants = 1  # 客户端仍在等待的请求数（发起方 + 等待方）
+        self.upstream_token = None
+        self.listeners = []
+
+
+class SingleFlight:
+    """按键合并并发调用
+
+    第一个到达的调用方执行 func，之后相同键的调用方等待它的结果；
+    func 抛出的异常会同样抛给所有等待方。调用结束后立即移除键，
+    下一次请求会重新调用上游（合并只针对同时在途的请求，不做缓存）。
+
+    传入 cancel_token（当前请求的客户端断开信号）时，等待方断开会立即返回；
+    所有参与方都断开后才取消发起方传入的 upstream_token，
+    只要还有人在等，上游调用就继续进行。
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def do(self, key, func, timeout=None, cancel_token=None, upstream_token=None):
+        """执行或加入合并调用，返回 (结果, 是否复用了其他请求的结果)"""
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                call.upstream_token = upstream_token
+                self.calls[key] = call
+            else:
+                call.waiters += 1
+                call.participants += 1
+
+        # 每个参与方无论怎样结束（完成、断开、超时、截止时间到）都恰好离开一次
+        left = threading.Lock()
+
+        def leave():
+            if left.acquire(blocking=False):
+                self._leave(key, call)
+
+        if cancel_token is not None:
+            cancel_token.add_callback(leave)
+        try:
+            if leader:
+                return self._lead(key, call, func), False
+            return self._wait(call, timeout, cancel_token), True
+        finally:
+            if cancel_token is not None:
+                cancel_token.remove_callback(leave)
+            leave()
+
+    def _wait(self, call, timeout, cancel_token):
+        """等待方等待发起方的结果"""
+        metrics.incr(f'singleflight.{self.name}.shared')
+        # 等待方各自按自己的截止时间放弃等待
+        timeout = remaining_timeout(timeout)
+        if cancel_token is None:
+            finished = call.event.wait(timeout)
+        else:
+            # 用自己的事件等待，调用完成或当前客户端断开都会唤醒
+            woken = threading.Event()
+            with self.lock:
+                if call.event.is_set():
+                    woken.set()
+                else:
+                    call.listeners.append(woken.set)
+            cancel_token.add_callback(woken.set)
+            woken.wait(timeout)
+            cancel_token.remove_callback(woken.set)
+            cancel_token.raise_if_cancelled()
+            finished = call.event.is_set()
+        if not finished:
+            metrics.incr(f'singleflight.{self.name}.wait_timeout')
+            remaining_timeout()
+            raise SingleFlightTimeout(f"等待上游结果超时: {self.name}")
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def _leave(self, key, call):
+        """参与方离开（断开、放弃等待或已拿到结果）；最后一个参与方离开且调用未完成时取消上游"""
+        with self.lock:
+            call.participants -= 1
+            abandoned = call.participants == 0 and not call.event.is_set()
+            if abandoned and self.calls.get(key) is call:
+                # 之后到达的相同请求重新发起调用，不再加入已取消的调用
+                del self.calls[key]
+        if abandoned and call.upstream_token is not None:
+            metrics.incr(f'singleflight.{self.name}.abandoned')
+            call.upstream_token.cancel()
+
+    def _lead(self, key, call, func):
+        metrics.incr(f'singleflight.{self.name}.calls')
+        try:
+            call.result = func()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        except BaseException:
+            # 线程被中断（如生成器关闭），让等待方明确失败而不是一直挂起
+            call.error = SingleFlightCancelled(f"上游调用已取消: {self.name}")
+            raise
+        finally:
+            with self.lock:
+                if self.calls.get(key) is call:
+                    del self.calls[key]
+                call.event.set()
+                listeners, call.listeners = call.listeners, []
+            for listener in listeners:
+                listener()
+            if call.waiters:
+                logger.info(f"合并请求 {self.name}: 1 次上游调用服务了 {call.waiters + 1} 个请求")
+
+    def in_flight(self):
+        with self.lock:
+            return len(self.calls)
+
+
+__all__ = ['SingleFlight', 'SingleFlightTimeout', 'SingleFlightCancelled', 'normalize_request_key']
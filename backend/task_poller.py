@@ -0,0 +1,195 @@
+# ModelScope异步任务统一轮询器
+# 所有进行中的task_id由一个后台线程统一检查，任务结束时唤醒等待方
+
+import heapq
+import random
+import threading
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from config import (
+    TASK_POLL_INITIAL_INTERVAL, TASK_POLL_MAX_INTERVAL, TASK_POLL_BACKOFF,
+    TASK_POLL_JITTER, TASK_POLL_MAX_WAIT, TASK_POLL_WORKERS
+)
+
+logger = logging.getLogger(__name__)
+
+# ModelScope终态
+TASK_SUCCEED = 'SUCCEED'
+TASK_FAILED = 'FAILED'
+# 轮询器内部终态：超过最长等待时间
+TASK_TIMEOUT = 'TIMEOUT'
+
+FINAL_STATUSES = (TASK_SUCCEED, TASK_FAILED, TASK_TIMEOUT)
+
+
+class TaskHandle:
+    """单个上游任务的等待句柄"""
+
+    def __init__(self, task_id):
+        self.task_id = task_id
+        self.status = None
+        self.data = None
+        self.error = None
+        self.checks = 0
+        self.created_at = time.time()
+        self._event = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    @property
+    def done(self):
+        return self._event.is_set()
+
+    def wait(self, timeout=None):
+        """阻塞等待任务结束，返回是否已结束"""
+        return self._event.wait(timeout)
+
+    def add_done_callback(self, callback):
+        """任务结束后回调 callback(handle)，已结束则立即回调"""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def _resolve(self, status, data=None, error=None):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.status = status
+            self.data = data
+            self.error = error
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception as e:
+                logger.error(f"任务回调执行失败 {self.task_id}: {e}")
+
+
+class TaskPoller:
+    """共享轮询器
+
+    每个任务按自适应间隔检查：开始时间隔短，之后指数退避并加入随机抖动，
+    避免大量任务在同一时刻集中请求上游。每轮把所有到期任务一起取出，
+    用小线程池并发查询，查询结果出来后立即唤醒对应的等待方。
+    """
+
+    def __init__(self, fetch_status,
+                 initial_interval=TASK_POLL_INITIAL_INTERVAL,
+                 max_interval=TASK_POLL_MAX_INTERVAL,
+                 backoff=TASK_POLL_BACKOFF,
+                 jitter=TASK_POLL_JITTER,
+                 max_wait=TASK_POLL_MAX_WAIT,
+                 workers=TASK_POLL_WORKERS):
+        # fetch_status(task_id) -> dict，至少包含task_status字段，失败时抛出异常
+        self.fetch_status = fetch_status
+        self.initial_interval = initial_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.jitter = jitter
+        self.max_wait = max_wait
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='task-poll')
+
+        self.handles = {}
+        self.schedule = []  # (下次检查时间, task_id)
+        self.condition = threading.Condition()
+        self.thread = None
+        self.stats = {'checks': 0, 'check_errors': 0, 'succeed': 0, 'failed': 0, 'timeout': 0}
+
+    def watch(self, task_id, max_wait=None):
+        """登记一个task_id，返回TaskHandle；重复登记返回同一个句柄"""
+        with self.condition:
+            handle = self.handles.get(task_id)
+            if handle is not None:
+                return handle
+
+            handle = TaskHandle(task_id)
+            handle.deadline = handle.created_at + (max_wait or self.max_wait)
+            self.handles[task_id] = handle
+            heapq.heappush(self.schedule, (time.time() + self._next_interval(0), task_id))
+            self._ensure_thread()
+            self.condition.notify()
+        return handle
+
+    def _next_interval(self, checks):
+        """第checks次检查后的等待间隔（带抖动）"""
+        interval = min(self.max_interval, self.initial_interval * (self.backoff ** checks))
+        return interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def _ensure_thread(self):
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self._loop, name='task-poller', daemon=True)
+            self.thread.start()
+
+    def _loop(self):
+        while True:
+            with self.condition:
+                while True:
+                    if not self.schedule:
+                        self.condition.wait()
+                        continue
+                    wait_time = self.schedule[0][0] - time.time()
+                    if wait_time <= 0:
+                        break
+                    self.condition.wait(wait_time)
+
+                now = time.time()
+                due = []
+                while self.schedule and self.schedule[0][0] <= now:
+                    _, task_id = heapq.heappop(self.schedule)
+                    handle = self.handles.get(task_id)
+                    if handle is not None and not handle.done:
+                        due.append(handle)
+
+            if due:
+                try:
+                    self._check_batch(due)
+                except Exception as e:
+                    logger.error(f"任务轮询异常: {e}")
+
+    def _check_batch(self, handles):
+        """并发检查一批到期任务"""
+        results = list(self.executor.map(self._check_one, handles))
+        now = time.time()
+        finished = []
+
+        with self.condition:
+            for handle, (data, error) in zip(handles, results):
+                handle.checks += 1
+                self.stats['checks'] += 1
+                if error:
+                    self.stats['check_errors'] += 1
+                status = data.get('task_status') if data else None
+
+                if status in (TASK_SUCCEED, TASK_FAILED):
+                    finished.append((handle, status, data, None))
+                elif now >= handle.deadline:
+                    finished.append((handle, TASK_TIMEOUT, data, error or '等待任务完成超时'))
+                else:
+                    heapq.heappush(self.schedule, (now + self._next_interval(handle.checks), handle.task_id))
+
+            for handle, status, _, _ in finished:
+                self.handles.pop(handle.task_id, None)
+                self.stats[status.lower()] += 1
+
+        # 在锁外唤醒等待方，回调里可以安全地再次登记任务
+        for handle, status, data, error in finished:
+            logger.info(f"任务 {handle.task_id} 结束: {status}，共检查 {handle.checks} 次，"
+                        f"耗时 {time.time() - handle.created_at:.1f}s")
+            handle._resolve(status, data=data, error=error)
+
+    def _check_one(self, handle):
+        try:
+            return self.fetch_status(handle.task_id), None
+        except Exception as e:
+            logger.warning(f"任务状态检查失败 {handle.task_id}: {e}")
+            return None, str(e)
+
+    def get_stats(self):
+        with self.condition:
+            return {**self.stats, 'in_flight': len(self.handles)}
@@ -0,0 +1,50 @@
+import threading
+import time
+
+import pytest
+
+from concurrency_limiter import AdaptiveLimiter, LimiterTimeoutError
+
+
+def make_limiter(**kwargs):
+    options = dict(max_limit=10, initial_limit=4, min_limit=1, queue_timeout=0.2, min_samples=3)
+    options.update(kwargs)
+    return AdaptiveLimiter('test', **options)
+
+
+def test_no_increase_while_a_slot_is_free():
+    limiter = make_limiter()
+    seen = [limiter.acquire() for _ in range(3)]
+    assert seen == [1, 2, 3]
+    for _ in range(20):
+        limiter.record(0.1, False, seen[-1])
+    assert limiter.get_stats()['limit'] == 4
+
+
+def test_increase_when_saturated():
+    limiter = make_limiter()
+    seen = [limiter.acquire() for _ in range(4)]
+    assert seen[-1] == 4
+    # 每次增加 1/当前上限，约一轮满载调用后加一
+    for _ in range(5):
+        limiter.record(0.1, False, seen[-1])
+    assert limiter.get_stats()['limit'] == 5
+
+
+def test_overload_decreases_once_per_window():
+    limiter = make_limiter(initial_limit=8)
+    limiter.record(0.1, True, 1)
+    assert limiter.get_stats()['limit'] == 5
+    limiter.record(0.1, True, 1)
+    assert limiter.get_stats()['limit'] == 5
+
+
+def test_queue_timeout_and_wakeup():
+    limiter = make_limiter(initial_limit=1)
+    limiter.acquire()
+    with pytest.raises(LimiterTimeoutError):
+        limiter.acquire()
+    threading.Timer(0.05, limiter.release).start()
+    start = time.monotonic()
+    assert limiter.acquire(timeout=1) == 1
+    assert time.monotonic() - start < 0.5
@@ -0,0 +1,55 @@
+import socket
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from deadline import Deadline, DeadlineExceeded, deadline_scope, iter_before_deadline
+
+
+def make_response(sock):
+    # 与requests流式响应相同的取socket路径：response.raw.connection.sock
+    return SimpleNamespace(raw=SimpleNamespace(connection=SimpleNamespace(sock=sock)))
+
+
+def read_chunks(sock):
+    while True:
+        data = sock.recv(16)
+        if not data:
+            return
+        yield data
+
+
+def test_blocked_read_stops_at_deadline():
+    server, client = socket.socketpair()
+    client.settimeout(5)
+    try:
+        server.sendall(b'first')
+        start = time.monotonic()
+        chunks = []
+        with deadline_scope(Deadline.after(0.3)):
+            with pytest.raises(DeadlineExceeded):
+                for chunk in iter_before_deadline(make_response(client), read_chunks(client)):
+                    chunks.append(chunk)
+        assert chunks == [b'first']
+        assert time.monotonic() - start < 2
+    finally:
+        server.close()
+        client.close()
+
+
+def test_read_timeout_is_never_extended():
+    server, client = socket.socketpair()
+    client.settimeout(1)
+    try:
+        server.sendall(b'x')
+        server.close()
+        with deadline_scope(Deadline.after(60)):
+            assert list(iter_before_deadline(make_response(client), read_chunks(client))) == [b'x']
+        assert client.gettimeout() <= 1
+    finally:
+        client.close()
+
+
+def test_without_deadline_chunks_pass_through():
+    assert list(iter_before_deadline(make_response(None), iter([b'a', b'b']))) == [b'a', b'b']
@@ -0,0 +1,147 @@
+import socket
+import threading
+import time
+
+import pytest
+
+from deadline import Deadline, DeadlineExceeded, deadline_scope
+from disconnect import CancelToken, ClientDisconnected
+from hedging import Hedger, HedgePool
+
+READ_TIMEOUT = 3
+
+
+class Budget:
+    def __init__(self, allow=True):
+        self.allow = allow
+
+    def try_acquire(self):
+        return self.allow
+
+
+@pytest.fixture
+def server():
+    """回复 'fast' 请求，收到 'slow' 请求后保持连接但不回复"""
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(16)
+    connections = []
+
+    def serve():
+        while True:
+            try:
+                connection, _ = listener.accept()
+            except OSError:
+                return
+            connections.append(connection)
+            if connection.recv(16) == b'fast':
+                connection.sendall(b'fast')
+
+    threading.Thread(target=serve, daemon=True).start()
+    yield listener.getsockname()
+    listener.close()
+    for connection in connections:
+        connection.close()
+
+
+def open_socket_stream(address, token, request):
+    # 与上游调用一样，取消时关闭连接；阻塞中的读取不会因此返回
+    sock = socket.create_connection(address, timeout=READ_TIMEOUT)
+    token.add_callback(sock.close)
+    sock.sendall(request)
+
+    def read():
+        try:
+            data = sock.recv(16)
+            if data:
+                yield data.decode()
+        finally:
+            sock.close()
+
+    return read()
+
+
+def make_hedger(budget=None, delay=0.1):
+    return Hedger('test', min_delay=delay, default_delay=delay, min_samples=10 ** 6,
+                  budget=budget or Budget(), enabled=True, pool=HedgePool(workers=4, max_hedges=2))
+
+
+def test_fast_primary_without_hedge(server):
+    hedger = make_hedger()
+    hedges = []
+
+    def open_stream(token, hedge):
+        hedges.append(hedge)
+        return open_socket_stream(server, token, b'fast')
+
+    assert list(hedger.stream(open_stream)) == ['fast']
+    time.sleep(0.2)
+    assert hedges == [False]
+
+
+def test_hedge_wins_over_primary_blocked_in_read(server):
+    hedger = make_hedger()
+    tokens = {}
+
+    def open_stream(token, hedge):
+        tokens[hedge] = token
+        return open_socket_stream(server, token, b'fast' if hedge else b'slow')
+
+    start = time.monotonic()
+    assert list(hedger.stream(open_stream)) == ['fast']
+    assert time.monotonic() - start < READ_TIMEOUT / 2
+    assert tokens[False].cancelled
+
+
+def test_no_hedge_without_budget(server):
+    hedger = make_hedger(budget=Budget(allow=False), delay=0.05)
+    hedges = []
+
+    def open_stream(token, hedge):
+        hedges.append(hedge)
+        time.sleep(0.2)
+        return open_socket_stream(server, token, b'fast')
+
+    assert list(hedger.stream(open_stream)) == ['fast']
+    assert hedges == [False]
+
+
+def test_first_error_raised_when_both_fail():
+    hedger = make_hedger(delay=0.05)
+
+    def open_stream(token, hedge):
+        if hedge:
+            time.sleep(0.2)
+            raise ValueError('hedge')
+        time.sleep(0.1)
+        raise RuntimeError('primary')
+
+    with pytest.raises(RuntimeError):
+        list(hedger.stream(open_stream))
+
+
+def test_client_cancel_returns_while_attempts_are_blocked(server):
+    hedger = make_hedger()
+    cancel_token = CancelToken()
+
+    def open_stream(token, hedge):
+        return open_socket_stream(server, token, b'slow')
+
+    threading.Timer(0.3, cancel_token.cancel).start()
+    start = time.monotonic()
+    with pytest.raises(ClientDisconnected):
+        list(hedger.stream(open_stream, cancel_token))
+    assert time.monotonic() - start < READ_TIMEOUT / 2
+
+
+def test_deadline_returns_while_primary_is_blocked(server):
+    hedger = make_hedger(budget=Budget(allow=False))
+
+    def open_stream(token, hedge):
+        return open_socket_stream(server, token, b'slow')
+
+    start = time.monotonic()
+    with deadline_scope(Deadline.after(0.3)):
+        with pytest.raises(DeadlineExceeded):
+            list(hedger.stream(open_stream))
+    assert time.monotonic() - start < READ_TIMEOUT / 2
@@ -0,0 +1,47 @@
+import time
+
+from database import SimpleDatabase
+from learning_path_store import LearningPathStore
+
+
+def make_store(tmp_path, **kwargs):
+    return LearningPathStore(database=SimpleDatabase(str(tmp_path)), **kwargs)
+
+
+def wait_written(store, timeout=2):
+    end = time.monotonic() + timeout
+    while store.pending and time.monotonic() < end:
+        time.sleep(0.01)
+    assert not store.pending
+
+
+def test_save_returns_before_write_and_is_readable(tmp_path):
+    store = make_store(tmp_path)
+    path_id = store.save({'overview': 'x'})
+    assert store.get(path_id)['learning_path'] == {'overview': 'x'}
+    wait_written(store)
+    assert store.db.find_one('learning_paths', {'path_id': path_id})['learning_path'] == {'overview': 'x'}
+    assert store.get(path_id)['version'] == 1
+
+
+def test_update_writes_pending_document_once(tmp_path):
+    store = make_store(tmp_path)
+    path_id = store.save({'overview': 'x'})
+    store.update(path_id, {'overview': 'y'}, 2)
+    wait_written(store)
+    documents = store.db.find('learning_paths', {'path_id': path_id})
+    assert len(documents) == 1
+    assert documents[0]['learning_path'] == {'overview': 'y'}
+    assert documents[0]['version'] == 2
+
+
+def test_expired_paths_are_hidden_and_cleaned_up(tmp_path):
+    store = make_store(tmp_path, ttl=60)
+    old_id = store.save({'overview': 'old'})
+    new_id = store.save({'overview': 'new'})
+    wait_written(store)
+    store.db.update_one('learning_paths', {'path_id': old_id}, {'$set': {'saved_at': time.time() - 120}})
+    assert store.get(old_id) is None
+    assert store.cleanup() == 1
+    assert store.db.find_one('learning_paths', {'path_id': old_id}) is None
+    assert store.get(new_id) is not None
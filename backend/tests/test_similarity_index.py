@@ -0,0 +1,61 @@
+from similarity_index import SimilarityIndex, is_additive_edit, tokenize
+
+
+def make_index():
+    return SimilarityIndex('test', threshold=0.85, dim=1024, max_entries=16, enabled=True)
+
+
+def test_punctuation_and_small_additions_match():
+    index = make_index()
+    index.add('如何制定学习计划', 'plan')
+    assert index.nearest('如何制定学习计划？') == 'plan'
+    index.add('how to make a study plan for the final exam', 'exam')
+    assert index.nearest('how to make a good study plan for the final exam') == 'exam'
+
+
+def test_chinese_negation_is_rejected():
+    index = make_index()
+    index.add('如何制定学习计划', 'plan')
+    assert index.nearest('如何不制定学习计划') is None
+
+
+def test_english_negation_is_rejected():
+    index = make_index()
+    index.add('how to make a study plan for the final exam', 'plan')
+    assert index.nearest('how not to make a study plan for the final exam') is None
+    # 反方向（缓存的是否定句）同样不能复用
+    index = make_index()
+    index.add('how not to make a study plan for the final exam', 'negated')
+    assert index.nearest('how to make a study plan for the final exam') is None
+
+
+def test_image_prompt_exclusions_are_rejected():
+    index = make_index()
+    index.add('a cute cat sitting on a sofa, oil painting style', 'cat')
+    assert index.nearest('a cute cat sitting on a sofa, oil painting style, no cat') is None
+    assert index.nearest('a cute cat sitting on a sofa, not oil painting style') is None
+    assert index.nearest('a cute cat sitting on a sofa, oil painting style, without sofa') is None
+
+
+def test_replaced_word_is_rejected():
+    index = make_index()
+    index.add('a cute cat sitting on a sofa', 'cat')
+    assert index.nearest('a cute dog sitting on a sofa') is None
+
+
+def test_inserted_span_is_capped():
+    short = tokenize('a cat on a sofa')
+    assert is_additive_edit(short, tokenize('a cute cat on a sofa'))
+    assert not is_additive_edit(short, tokenize('a cat on a sofa in a sunny room with many plants around'))
+    assert not is_additive_edit(
+        tokenize('a cat on a sofa in a sunny room'),
+        tokenize('a cat on a sofa in a sunny room with many plants around it'),
+        max_inserted_tokens=3
+    )
+
+
+def test_namespaces_do_not_mix():
+    index = make_index()
+    index.add('a cute cat sitting on a sofa', 'square', namespace='1:1')
+    assert index.nearest('a cute cat sitting on a sofa!', namespace='16:9') is None
+    assert index.nearest('a cute cat sitting on a sofa!', namespace='1:1') == 'square'
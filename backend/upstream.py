@@ -0,0 +1,164 @@
+# 上游HTTP客户端
+# 每个上游服务（ModelScope、DeepSeek等）使用独立的长连接池，避免每次请求重新握手
+
+import time
+import weakref
+import logging
+import requests
+from requests.adapters import HTTPAdapter
+
+from config import UPSTREAM_CONNECT_TIMEOUT, UPSTREAM_READ_TIMEOUT
+from metrics import metrics
+from circuit_breaker import retry_budget
+from concurrency_limiter import LimiterTimeoutError
+from deadline import remaining_timeout
+
+logger = logging.getLogger(__name__)
+
+
+class UpstreamError(Exception):
+    """上游服务返回了错误响应"""
+
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+# 全局耗时钩子：hook(provider, method, url, status_code, elapsed, error)
+_global_hooks = []
+
+
+def add_timing_hook(hook):
+    """注册对所有上游客户端生效的耗时钩子"""
+    _global_hooks.append(hook)
+
+
+class UpstreamClient:
+    """带连接池的上游客户端
+
+    timeout 可以传单个数字（作为读超时，连接超时使用默认值）或 (connect, read) 元组。
+    stream=True 时记录的耗时是收到响应头的时间。
+    配置了熔断器时，熔断期间直接抛出CircuitOpenError，不会发出请求。
+    配置了并发限制器时，请求发出前先拿并发名额，排队超时抛出LimiterTimeoutError；
+    stream=True 的响应在关闭（或被回收）时才归还名额，调用方读完后需要关闭响应。
+    当前上下文有请求截止时间时，排队和超时都不超过剩余时间，已过期直接抛出DeadlineExceeded。
+    每次调用默认向重试预算存入额度；轮询、重试和对冲请求传 retry_deposit=False，
+    只有用户请求的首次调用才为重试和对冲攒预算。
+    """
+
+    def __init__(self, name, headers=None, pool_size=10,
+                 connect_timeout=UPSTREAM_CONNECT_TIMEOUT, read_timeout=UPSTREAM_READ_TIMEOUT,
+                 breaker=None, limiter=None):
+        self.name = name
+        self.breaker = breaker
+        self.limiter = limiter
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.hooks = []
+
+        self.session = requests.Session()
+        if headers:
+            self.session.headers.update(headers)
+        # 重试由调用方控制，连接池层面不自动重试
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def add_timing_hook(self, hook):
+        """注册只对当前客户端生效的耗时钩子"""
+        self.hooks.append(hook)
+
+    def _resolve_timeout(self, timeout):
+        if timeout is None:
+            connect, read = self.connect_timeout, self.read_timeout
+        elif isinstance(timeout, (tuple, list)):
+            connect, read = timeout
+        else:
+            connect, read = min(self.connect_timeout, timeout), timeout
+        return (remaining_timeout(connect), remaining_timeout(read))
+
+    def request(self, method, url, timeout=None, retry_deposit=True, **kwargs):
+        if self.limiter is not None:
+            try:
+                in_flight = self.limiter.acquire(timeout=remaining_timeout(self.limiter.queue_timeout))
+            except LimiterTimeoutError:
+                # 排队期间截止时间已到，按请求超时报告
+                remaining_timeout()
+                raise
+        try:
+            # 排队之后再按剩余时间计算超时
+            timeout = self._resolve_timeout(timeout)
+            if self.breaker is not None:
+                self.breaker.before_call()
+        except Exception:
+            if self.limiter is not None:
+                self.limiter.release()
+            raise
+        if retry_deposit:
+            retry_budget.record_request()
+
+        start = time.perf_counter()
+        response = None
+        status_code = None
+        error = None
+        try:
+            response = self.session.request(method, url, timeout=timeout, **kwargs)
+            status_code = response.status_code
+            return response
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            failed = error is not None or status_code == 429 or (status_code or 0) >= 500
+            if self.breaker is not None:
+                self.breaker.record(failed, elapsed)
+            if self.limiter is not None:
+                self.limiter.record(elapsed, failed, in_flight)
+                if response is not None and kwargs.get('stream'):
+                    self._release_on_close(response)
+                else:
+                    self.limiter.release()
+            for hook in _global_hooks + self.hooks:
+                try:
+                    hook(self.name, method, url, status_code, elapsed, error)
+                except Exception as hook_error:
+                    logger.warning(f"上游耗时钩子执行失败: {hook_error}")
+
+    def _release_on_close(self, response):
+        """流式响应关闭时归还并发名额；调用方忘记关闭时在响应被回收时兜底归还"""
+        # finalize对象只会执行一次回调，重复关闭或关闭后再被回收都不会多次归还
+        release = weakref.finalize(response, self.limiter.release)
+        close = response.close
+
+        def close_and_release():
+            try:
+                close()
+            finally:
+                release()
+
+        response.close = close_and_release
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+def record_upstream_metrics(provider, method, url, status_code, elapsed, error):
+    """默认钩子：按服务记录请求数、状态码和耗时"""
+    metrics.incr(f'upstream.{provider}.requests')
+    metrics.observe(f'upstream.{provider}.latency', elapsed)
+    if error is not None:
+        metrics.incr(f'upstream.{provider}.errors')
+    elif status_code is not None:
+        metrics.incr(f'upstream.{provider}.status.{status_code}')
+
+
+add_timing_hook(record_upstream_metrics)
+
+__all__ = ['UpstreamClient', 'UpstreamError', 'add_timing_hook', 'record_upstream_metrics']